@@ -23,4 +23,9 @@ setup(
         'Operating System :: OS Independent',
     ],
     python_requires='>=3.6',
+    entry_points={
+        'console_scripts': [
+            'xami-infer=xami_model.inference.cli:main',
+        ],
+    },
 )
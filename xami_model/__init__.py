@@ -1,7 +1,4 @@
-from .inference import *
-from .dataset import *
-from .model_predictor import *
-from .yolo_predictor import *
-from .train import *
-from .mobile_sam import *
-from .losses import *
\ No newline at end of file
+from ._lazy import lazy_star_exports
+
+# The subpackages are imported on first use, e.g. inference does not load the training and astronomy dependencies
+__getattr__, __dir__ = lazy_star_exports(__name__, ('inference', 'dataset', 'model_predictor', 'yolo_predictor', 'train', 'mobile_sam', 'losses'))
@@ -0,0 +1,31 @@
+import importlib
+
+def lazy_star_exports(package_name, module_names):
+    """
+    Build the module-level `__getattr__` and `__dir__` (PEP 562) of a package whose `__init__` used to 
+    star-import its modules. The modules are only imported when one of their names is first accessed, 
+    so that importing the package does not pull in their (heavy) dependencies.
+
+    Args:
+        package_name (str): The `__name__` of the package.
+        module_names (tuple): The modules (or subpackages) that were star-imported, in import order; 
+                              on name clashes the last one wins, as with the star imports.
+
+    Returns:
+        (__getattr__, __dir__) functions for the package.
+    """
+    def __getattr__(name):
+        if name in module_names:
+            return importlib.import_module(f'.{name}', package_name)
+        if not name.startswith('_'):
+            for module_name in reversed(module_names):
+                module = importlib.import_module(f'.{module_name}', package_name)
+                if hasattr(module, name):
+                    return getattr(module, name)
+        raise AttributeError(f"module {package_name!r} has no attribute {name!r}")
+
+    def __dir__():
+        package = importlib.import_module(package_name)
+        return sorted(set(vars(package)) | set(module_names))
+
+    return __getattr__, __dir__
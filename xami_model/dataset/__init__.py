@@ -1,5 +1,3 @@
-from .voc_annotate_and_Roboflow_export import *
-from .coco_to_yolo_converter import *
-from .dataset_utils import *
-from .augment import *
-from .astronomy_utils import *
\ No newline at end of file
+from .._lazy import lazy_star_exports
+
+__getattr__, __dir__ = lazy_star_exports(__name__, ('voc_annotate_and_Roboflow_export', 'coco_to_yolo_converter', 'dataset_utils', 'augment', 'astronomy_utils'))
@@ -1,15 +1,6 @@
-import matplotlib.pyplot as plt
-from astropy.convolution import convolve
-from astropy.visualization import AsinhStretch, LogStretch, ZScaleInterval, simple_norm
-from astropy.visualization.mpl_normalize import ImageNormalize
-from photutils.background import Background2D, SExtractorBackground, MedianBackground, MMMBackground, ModeEstimatorBackground
-from astropy.stats import biweight_location, mad_std, sigma_clipped_stats, SigmaClip
-from photutils.segmentation import detect_threshold,  deblend_sources, detect_sources, make_2dgaussian_kernel, SourceFinder, SourceCatalog
-from photutils.utils import circular_footprint
 import numpy as np
 import os
 import cv2
-from astropy.io import fits
 
 
 med = r"$\tilde{x}$"
@@ -21,6 +12,8 @@ biw_loc = r"$\zeta_{\text{biloc}}$"
 # !pip install jupyter-bbox-widget
 
 def data_norm(data, n_samples=1000, contrast=0.1, max_reject=0.5, min_npixels=10, krej=2.5, max_iterations=5):
+    from astropy.visualization import ZScaleInterval
+    from astropy.visualization.mpl_normalize import ImageNormalize
     interval = ZScaleInterval(n_samples, contrast, max_reject, min_npixels, krej, max_iterations)
     vmin, vmax = interval.get_limits(data)
     norm = ImageNormalize(vmin=vmin, vmax=vmax)
@@ -42,6 +35,7 @@ def image_stretch(data, stretch='log', factor=1):
 	- numpy.ndarray
 		The stretched image data array.
 	"""
+	from astropy.visualization import AsinhStretch, LogStretch
 
 	positive_mask = data > 0
 	data_log_stretched = data.copy()
@@ -102,82 +96,251 @@ def rescale_flattened_image(image: np.ndarray,
 
     return final_image
 
-def zscale_image(input_path, output_folder, with_image_stretch=False):
-	hdul = fits.open(input_path)
-	image_data = hdul[0].data
-	hdul.close()
+def zscale_limits(data, n_samples=1000, contrast=0.1, max_reject=0.5, min_npixels=10, krej=2.5, max_iterations=5):
+	"""
+	Compute the zscale limits of the positive pixels of an image on a subsample.
+
+	ZScaleInterval only uses `n_samples` evenly strided values, so the image is first subsampled with a 
+	stride and only the sample is filtered, instead of indexing or copying every positive pixel. The 
+	stride is reduced until the sample holds `n_samples` finite positive values (or the whole image 
+	is used), so that mostly empty fields are still sampled densely enough.
+
+	Parameters:
+	- data (numpy.ndarray): The image data (can be a memory-mapped FITS array).
+	- n_samples, contrast, max_reject, min_npixels, krej, max_iterations: ZScaleInterval parameters.
+
+	Returns:
+	- (vmin, vmax) (tuple): The zscale limits.
+	"""
+	from astropy.visualization import ZScaleInterval
+	flat_data = data.ravel()
+	stride = int(max(1.0, flat_data.size / n_samples))
+	while True:
+		samples = np.asarray(flat_data[::stride])
+		samples = samples[np.isfinite(samples) & (samples > 0)]
+		if samples.size >= n_samples or stride == 1:
+			break
+		stride = max(1, stride // 4)
+	interval = ZScaleInterval(n_samples, contrast, max_reject, min_npixels, krej, max_iterations)
 	
-	# Apply zscale normalization only on non-negative data
-	norm = data_norm(image_data[image_data>0])
+	return interval.get_limits(samples)
+
+def zscale_to_uint8(image_data, vmin, vmax, with_image_stretch=False):
+	"""
+	Normalize FITS image data to the zscale limits and convert it to an 8-bit image with the FITS orientation flipped.
+
+	Parameters:
+	- image_data (numpy.ndarray): The image data.
+	- vmin, vmax (float): The zscale limits, as returned by zscale_limits.
+	- with_image_stretch (bool): Whether to apply a log stretch (factor 500) on the normalized data.
+
+	Returns:
+	- numpy.ndarray: The uint8 image.
+	"""
+	from astropy.visualization.mpl_normalize import ImageNormalize
+	norm = ImageNormalize(vmin=vmin, vmax=vmax)
 	normalized_data = norm(image_data)
 	normalized_data = normalized_data.filled(fill_value=-1)
-	
-	os.makedirs(output_folder, exist_ok=True)
-	output_path = os.path.join(output_folder, os.path.basename(input_path).replace('.fits', '.png'))
-	
 	flipped_data = np.flipud(normalized_data)
 	
+	if with_image_stretch:
+		flipped_data = image_stretch(flipped_data, stretch='log', factor=500.0)
+	
 	# clip to 255
-	scaled_data = np.clip((flipped_data * 255), 0, 255).astype(np.uint8)
+	return np.clip((flipped_data * 255), 0, 255).astype(np.uint8)
+
+def zscale_image(input_path, output_folder, with_image_stretch=False):
+	from astropy.io import fits
+	with fits.open(input_path, memmap=True) as hdul:
+		image_data = hdul[0].data
+		
+		# Apply zscale normalization only on non-negative data
+		vmin, vmax = zscale_limits(image_data)
+		scaled_data = zscale_to_uint8(image_data, vmin, vmax, with_image_stretch)
+	
+	os.makedirs(output_folder, exist_ok=True)
+	output_path = os.path.join(output_folder, os.path.basename(input_path).replace('.fits', '.png'))
+	cv2.imwrite(output_path, scaled_data)
 	
 	if with_image_stretch:
-		data_log_stretched = image_stretch(flipped_data, stretch='log', factor=500.0)
-		cv2.imwrite(output_path, np.clip((data_log_stretched * 255), 0, 255).astype(np.uint8))
 		print(f"FITS file saved as PNG with zscale normalization and Log stretch: {output_path}")
 	else:
-		cv2.imwrite(output_path, scaled_data)
 		print(f"FITS file saved as PNG with zscale normalization: {output_path}") 
 
 	return output_path
 
-def detect_and_deblend_sources(data_orig, hw_threshold=0, clip_sigma=3.0, kernel_sigma=3.0, npixels=10, verbose=True):
+def _zscale_fits_to_png(task):
+	"""
+	Worker of zscale_images: convert a single FITS file and return its manifest entry. 
+	A file that cannot be converted gets a 'failed' entry instead of stopping the batch.
+	"""
+	from astropy.io import fits
+	input_path, output_path, with_image_stretch = task
+	
+	try:
+		with fits.open(input_path, memmap=True) as hdul:
+			image_data = hdul[0].data
+			if image_data is None:
+				raise ValueError('The primary HDU has no data')
+			vmin, vmax = zscale_limits(image_data)
+			scaled_data = zscale_to_uint8(image_data, vmin, vmax, with_image_stretch)
+			shape = list(image_data.shape)
+		
+		if not cv2.imwrite(output_path, scaled_data):
+			raise OSError(f'Cannot write {output_path}')
+	except Exception as e:
+		return {'input': input_path, 'output': output_path, 'status': 'failed', 'error': repr(e)}
+	
+	return {'input': input_path, 'output': output_path, 'status': 'converted', 
+		 'vmin': float(vmin), 'vmax': float(vmax), 'shape': shape}
+
+def zscale_images(inputs, output_folder, with_image_stretch=False, num_workers=None, overwrite=False, 
+		  manifest_path=None, max_in_flight=None):
+	"""
+	Convert a set of FITS files to zscale-normalized PNGs with a process pool.
+
+	FITS files are memory-mapped, the zscale limits are computed on a subsample (see zscale_limits), 
+	and at most `max_in_flight` files are being converted at any time to bound memory use. 
+	PNGs newer than their FITS file are skipped unless `overwrite` is set.
+
+	Parameters:
+	- inputs (str or list): A directory (all its .fits files), a glob pattern, or a list of FITS paths.
+	- output_folder (str): The folder where the PNGs are written.
+	- with_image_stretch (bool): Whether to apply a log stretch, as in zscale_image.
+	- num_workers (int, optional): Number of worker processes. Default: os.cpu_count().
+	- overwrite (bool): Convert all files, even if their PNG is up to date.
+	- manifest_path (str, optional): Where to write the JSON manifest. Default: output_folder/manifest.json.
+	- max_in_flight (int, optional): Maximum number of submitted but unfinished conversions. Default: 2 * num_workers.
+
+	Returns:
+	- list: The manifest entries (input, output, status and, for converted files, zscale limits and shape; 
+	  for failed files, the error).
+	"""
+	import glob
+	import json
+	from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+	if isinstance(inputs, str):
+		if os.path.isdir(inputs):
+			input_paths = sorted(glob.glob(os.path.join(inputs, '*.fits')))
+		else:
+			input_paths = sorted(glob.glob(inputs))
+	else:
+		input_paths = list(inputs)
+	
+	num_workers = num_workers or os.cpu_count() or 1
+	max_in_flight = max_in_flight or 2 * num_workers
+	os.makedirs(output_folder, exist_ok=True)
+	
+	manifest, tasks = [], []
+	for input_path in input_paths:
+		output_path = os.path.join(output_folder, os.path.basename(input_path).replace('.fits', '.png'))
+		if not overwrite and os.path.exists(output_path) and os.path.getmtime(output_path) >= os.path.getmtime(input_path):
+			manifest.append({'input': input_path, 'output': output_path, 'status': 'up-to-date'})
+		else:
+			tasks.append((input_path, output_path, with_image_stretch))
+	
+	if num_workers == 1:
+		manifest.extend(_zscale_fits_to_png(task) for task in tasks)
+	else:
+		with ProcessPoolExecutor(max_workers=num_workers) as executor:
+			pending = set()
+			for task in tasks:
+				if len(pending) >= max_in_flight:
+					done, pending = wait(pending, return_when=FIRST_COMPLETED)
+					manifest.extend(future.result() for future in done)
+				pending.add(executor.submit(_zscale_fits_to_png, task))
+			done, _ = wait(pending)
+			manifest.extend(future.result() for future in done)
+	
+	manifest.sort(key=lambda entry: entry['input'])
+	manifest_path = manifest_path or os.path.join(output_folder, 'manifest.json')
+	with open(manifest_path, 'w') as f:
+		json.dump(manifest, f, indent=2)
+	
+	n_converted = sum(entry['status'] == 'converted' for entry in manifest)
+	n_failed = sum(entry['status'] == 'failed' for entry in manifest)
+	print(f"Converted {n_converted} FITS files to PNG ({len(manifest) - n_converted - n_failed} up to date, "
+	      f"{n_failed} failed). Manifest: {manifest_path}")
+
+	return manifest
+
+def subtract_background_and_convolve(data_orig, clip_sigma=3.0, kernel_sigma=3.0, verbose=False):
+	"""
+	Estimate and subtract the 2D background, then smooth the data with a Gaussian kernel.
+
+	Args:
+		data_orig (numpy.ndarray): Input data array (0 where there is no data).
+		clip_sigma (float): Sigma of the background sigma clipping.
+		kernel_sigma (float): Sigma of the smoothing kernel.
+
+	Returns:
+		data_orig (numpy.ndarray): Input data with the regions with no data masked.
+		data (numpy.ndarray): Background-subtracted data.
+		convolved_data (numpy.ndarray): Smoothed background-subtracted data.
+		threshold (numpy.ndarray): Detection threshold (1.2 * background RMS).
+	"""
+	from astropy.convolution import convolve
+	from photutils.background import Background2D, ModeEstimatorBackground
+	from astropy.stats import SigmaClip
+	from photutils.segmentation import make_2dgaussian_kernel
+	# Initialize SigmaClip with desired parameters
+	sigma_clip = SigmaClip(sigma=clip_sigma, 
+					#  sigma_lower=clip_sigma, 
+					#  sigma_upper= clip_sigma+0.5, 
+					 maxiters=10)
+	
+	# this is used to mask the regions with no data
+	coverage_mask = (data_orig == 0)
+
+	# doc here: https://photutils.readthedocs.io/en/stable/api/photutils.background.SExtractorBackground.html
+	bkg_estimator = ModeEstimatorBackground()
+	bkg = Background2D(data_orig, 
+				 box_size=(10, 10), 
+				 filter_size=(5,5), 
+				 sigma_clip=sigma_clip, 
+				 coverage_mask = coverage_mask,
+				 bkg_estimator=bkg_estimator)
+	data_orig = data_orig * (~coverage_mask) # mask the regions with no data
+	data = data_orig - bkg.background  # subtract the background
+	if verbose:
+		print(f"Background: {bkg.background_median}\nBackground RMS: {bkg.background_rms_median}")
+
+	threshold = 1.2 * bkg.background_rms # type: ignore # n-sigma threshold
+	kernel = make_2dgaussian_kernel(kernel_sigma, size=5) # enhance the visibility of significant features while reducing the impact 
+														  # of random noise or small irrelevant details
+	convolved_data = convolve(data, kernel)
+	convolved_data = convolved_data * (~coverage_mask) # mask the regions with no data
+	
+	return data_orig, data, convolved_data, threshold
+
+class NoSourcesError(ValueError):
+	"""Raised by the source detection when the image has no source, as opposed to a failure of the detection."""
+
+def detect_and_deblend_sources(data_orig, hw_threshold=0, clip_sigma=3.0, kernel_sigma=3.0, npixels=10, verbose=True, catalog_only=False, 
+		raise_errors=False):
 	"""
 	Deblends the input data using background subtraction, convolution, and source detection.
 
 	Args:
 		data (numpy.ndarray): Input data array.
+		catalog_only (bool): Skip the SourceFinder pass (segment_map_finder is then None) when only the catalog is needed.
+		raise_errors (bool): Raise the exceptions (NoSourcesError if no source is found) instead of printing them and returning None.
 
 	Returns:
 		segment_map (numpy.ndarray): Segmentation map of the deblended segments.
 		segment_map_finder (numpy.ndarray): Segmentation map of the sources on the segmented image.
 		relevant_sources_tbl (astropy.table.Table): Table containing relevant sources (also based on hw threshold) information.
 	"""
+	import matplotlib.pyplot as plt
+	from photutils.segmentation import deblend_sources, detect_sources, SourceFinder, SourceCatalog
     
 	try: 
-		# Initialize SigmaClip with desired parameters
-		sigma_clip = SigmaClip(sigma=clip_sigma, 
-						#  sigma_lower=clip_sigma, 
-						#  sigma_upper= clip_sigma+0.5, 
-						 maxiters=10)
-		
-		# this is used to mask the regions with no data
-		coverage_mask = (data_orig == 0)
-
-		threshold = np.percentile(data_orig, 90)  
-		bright_source_mask = data_orig > threshold
-
-		# doc here: https://photutils.readthedocs.io/en/stable/api/photutils.background.SExtractorBackground.html
-		bkg_estimator = ModeEstimatorBackground()
-		bkg = Background2D(data_orig, 
-					 box_size=(10, 10), 
-					 filter_size=(5,5), 
-					 sigma_clip=sigma_clip, 
-					#  mask=bright_source_mask, 
-					 coverage_mask = coverage_mask,
-					 bkg_estimator=bkg_estimator)
-		data_orig = data_orig * (~coverage_mask) # mask the regions with no data
-		data = data_orig - bkg.background  # subtract the background
-		# data = data * (~coverage_mask) # mask the regions with no data
-		if verbose:
-			print(f"Background: {bkg.background_median}\nBackground RMS: {bkg.background_rms_median}")
-
-		threshold = 1.2 * bkg.background_rms # type: ignore # n-sigma threshold
-		kernel = make_2dgaussian_kernel(kernel_sigma, size=5) # enhance the visibility of significant features while reducing the impact 
-															  # of random noise or small irrelevant details
-		convolved_data = convolve(data, kernel)
-		convolved_data = convolved_data * (~coverage_mask) # mask the regions with no data
+		data_orig, data, convolved_data, threshold = subtract_background_and_convolve(data_orig, clip_sigma, kernel_sigma, verbose)
 		# npixels = 10  # minimum number of connected pixels, each greater than threshold, that an object must have to be detected
 		segment_map = detect_sources(convolved_data, threshold, npixels=npixels)
+		if segment_map is None:
+			raise NoSourcesError('No sources found in the image.')
 		segm_deblend = deblend_sources(convolved_data, segment_map, npixels=npixels, progress_bar=False)
 
 		# Calculate source density
@@ -202,28 +365,19 @@ def detect_and_deblend_sources(data_orig, hw_threshold=0, clip_sigma=3.0, kernel
 			plt.tight_layout()
 			plt.savefig('./plots/segmentation_1.png')
 
-		finder = SourceFinder(npixels=10, progress_bar=False)
-		segment_map_finder = finder(convolved_data, threshold)
+		segment_map_finder = None
+		if not catalog_only:
+			finder = SourceFinder(npixels=10, progress_bar=False)
+			segment_map_finder = finder(convolved_data, threshold)
 		
 		cat = SourceCatalog(data, segm_deblend, convolved_data=convolved_data)
-		tbl = cat.to_table()
-
-		tbl['xcentroid'].info.format = '.2f' # type: ignore
-		tbl['ycentroid'].info.format = '.2f' # type: ignore
-		tbl['kron_flux'].info.format = '.2f' # type: ignore
-		tbl['kron_fluxerr'].info.format = '.2f' # type: ignore
-		tbl['area'].info.format = '.2f' # type: ignore
-		# print(tbl['bbox_xmax'].value - tbl['bbox_xmin'].value)
-		# print(tbl['bbox_ymax'].value - tbl['bbox_ymin'].value)
-		relevant_sources_tbl = tbl[(abs(tbl['bbox_xmax'].value - tbl['bbox_xmin'].value) > hw_threshold) &  # type: ignore
-							(abs(tbl['bbox_ymax'].value - tbl['bbox_ymin'].value) > hw_threshold)] # type: ignore
-		# print('flux:', relevant_sources_tbl['kron_flux'].value)
+		relevant_sources_tbl = select_relevant_sources(cat, hw_threshold)
 
 		if verbose:
 			fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(10, 12.5))
 			ax1.imshow(data, cmap='Greys_r')
 			ax1.set_title('Sources')
-			ax2.imshow(segment_map_finder, cmap=segm_deblend.cmap, interpolation='nearest')
+			ax2.imshow(segment_map_finder if segment_map_finder is not None else segm_deblend.data, cmap=segm_deblend.cmap, interpolation='nearest')
 			ax2.set_title('Deblended Sources')
 			cat.plot_kron_apertures(ax=ax1, color='white', lw=1.5)
 			cat.plot_kron_apertures(ax=ax2, color='white', lw=1.5)
@@ -231,14 +385,262 @@ def detect_and_deblend_sources(data_orig, hw_threshold=0, clip_sigma=3.0, kernel
 			plt.show()
 			plt.close()
 	except Exception as e:
+		if raise_errors:
+			raise
 		print(e)
 		return None, None, None	
 	return segment_map, segment_map_finder, relevant_sources_tbl
 
+def select_relevant_sources(cat, hw_threshold=0):
+	"""Convert a SourceCatalog to a table and keep the sources whose bbox is larger than hw_threshold in both dimensions."""
+	tbl = cat.to_table()
+
+	tbl['xcentroid'].info.format = '.2f' # type: ignore
+	tbl['ycentroid'].info.format = '.2f' # type: ignore
+	tbl['kron_flux'].info.format = '.2f' # type: ignore
+	tbl['kron_fluxerr'].info.format = '.2f' # type: ignore
+	tbl['area'].info.format = '.2f' # type: ignore
+	relevant_sources_tbl = tbl[(abs(tbl['bbox_xmax'].value - tbl['bbox_xmin'].value) > hw_threshold) &  # type: ignore
+						(abs(tbl['bbox_ymax'].value - tbl['bbox_ymin'].value) > hw_threshold)] # type: ignore
+	
+	return relevant_sources_tbl
+
+def _detect_tile(task):
+	"""Worker of detect_and_deblend_sources_tiled: background subtraction, detection and deblending of one tile."""
+	from photutils.segmentation import deblend_sources, detect_sources
+	tile, clip_sigma, kernel_sigma, npixels = task
+	_, data, convolved_data, threshold = subtract_background_and_convolve(tile, clip_sigma, kernel_sigma)
+	segment_map = detect_sources(convolved_data, threshold, npixels=npixels)
+	
+	if segment_map is None:
+		labels = np.zeros(tile.shape, dtype=np.int32)
+		return data, convolved_data, labels, labels
+	
+	segm_deblend = deblend_sources(convolved_data, segment_map, npixels=npixels, progress_bar=False)
+	return data, convolved_data, segment_map.data.astype(np.int32), segm_deblend.data.astype(np.int32)
+
+def _union_labels_in_overlaps(labels, tile_labels, tile_boxes, neighbours):
+	"""
+	Give the same label to the segments of neighbouring tiles that are the same source, matching them where the tiles overlap.
+
+	Two segments are merged when each is the other's best match (most shared pixels) in the overlap of their tiles, 
+	so that sources deblended in both tiles stay apart even when they touch across the seam.
+
+	Parameters:
+	- labels (numpy.ndarray): The stitched labels of the tile cores (labels of different tiles are distinct).
+	- tile_labels (list): The labels of each whole tile (core and overlap), with the same offsets as in labels.
+	- tile_boxes (list): The (y0, y1, x0, x1) extent of each whole tile in the frame.
+	- neighbours (list): The (i, j) pairs of tiles that overlap.
+	"""
+	pairs = []
+	for i, j in neighbours:
+		(ay0, ay1, ax0, ax1), (by0, by1, bx0, bx1) = tile_boxes[i], tile_boxes[j]
+		y0, y1, x0, x1 = max(ay0, by0), min(ay1, by1), max(ax0, bx0), min(ax1, bx1)
+		if y0 >= y1 or x0 >= x1:
+			continue
+		a = tile_labels[i][y0 - ay0:y1 - ay0, x0 - ax0:x1 - ax0].ravel()
+		b = tile_labels[j][y0 - by0:y1 - by0, x0 - bx0:x1 - bx0].ravel()
+		shared = (a > 0) & (b > 0)
+		if not shared.any():
+			continue
+		
+		overlaps, counts = np.unique(np.stack([a[shared], b[shared]], axis=1), axis=0, return_counts=True)
+		best = []
+		for side in (0, 1):
+			order = np.lexsort((-counts, overlaps[:, side]))
+			_, first = np.unique(overlaps[order, side], return_index=True)
+			best.append(set(map(tuple, overlaps[order[first]])))
+		pairs.extend(best[0] & best[1])
+	if len(pairs) == 0:
+		return labels
+	
+	parent = np.arange(max(labels.max(), max(int(t.max()) for t in tile_labels)) + 1)
+
+	def find(label):
+		while parent[label] != label:
+			parent[label] = parent[parent[label]]
+			label = parent[label]
+		return label
+	
+	for a, b in pairs:
+		root_a, root_b = find(a), find(b)
+		if root_a != root_b:
+			parent[max(root_a, root_b)] = min(root_a, root_b)
+	
+	roots = np.array([find(label) for label in range(len(parent))])
+	return roots[labels]
+
+def detect_and_deblend_sources_tiled(data_orig, hw_threshold=0, clip_sigma=3.0, kernel_sigma=3.0, npixels=10, 
+		tile_size=512, overlap=32, num_workers=None, verbose=False, raise_errors=False):
+	"""
+	Tiled version of detect_and_deblend_sources (catalog only) for large frames.
+
+	The frame is split into tile_size x tile_size cores, each extended by `overlap` pixels on every side. 
+	Background estimation, detection and deblending run per tile in a process pool; the cores of the tiles 
+	are stitched together, and the segments of neighbouring tiles that cover the same pixels in their overlap 
+	are merged before building the catalog.
+
+	Args:
+		data_orig (numpy.ndarray): Input data array.
+		tile_size (int): Size of the tile cores.
+		overlap (int): Context added around each core, so that the background and the smoothing are continuous at the seams, 
+			and that the segments crossing a seam can be matched. It should be larger than the sources cut by the seams.
+		num_workers (int, optional): Number of worker processes. Default: os.cpu_count(). With 1, the tiles are processed in this process.
+		raise_errors (bool): Raise the exceptions (NoSourcesError if no source is found) instead of printing them and returning None.
+
+	Returns:
+		segment_map (SegmentationImage): Merged segmentation map of the detected sources.
+		segment_map_finder (None): Not computed in tiled mode.
+		relevant_sources_tbl (astropy.table.Table): Table containing relevant sources (also based on hw threshold) information.
+	"""
+	from concurrent.futures import ProcessPoolExecutor
+	from photutils.segmentation import SegmentationImage, SourceCatalog
+
+	height, width = data_orig.shape
+	rows, cols = range(0, height, tile_size), range(0, width, tile_size)
+	cores, tile_boxes, tasks = [], [], []
+	for y0 in rows:
+		for x0 in cols:
+			y1, x1 = min(y0 + tile_size, height), min(x0 + tile_size, width)
+			ty0, tx0 = max(y0 - overlap, 0), max(x0 - overlap, 0)
+			ty1, tx1 = min(y1 + overlap, height), min(x1 + overlap, width)
+			cores.append((y0, y1, x0, x1, y0 - ty0, x0 - tx0))
+			tile_boxes.append((ty0, ty1, tx0, tx1))
+			tasks.append((np.ascontiguousarray(data_orig[ty0:ty1, tx0:tx1]), clip_sigma, kernel_sigma, npixels))
+	# Right, bottom and both diagonal neighbours of each tile, as indices in tasks
+	neighbours = [(r * len(cols) + c, (r + dr) * len(cols) + c + dc) for r in range(len(rows)) for c in range(len(cols)) 
+			   for dr, dc in ((0, 1), (1, -1), (1, 0), (1, 1)) if r + dr < len(rows) and 0 <= c + dc < len(cols)]
+	
+	try:
+		num_workers = num_workers or os.cpu_count() or 1
+		if num_workers == 1 or len(tasks) == 1:
+			results = list(map(_detect_tile, tasks))
+		else:
+			with ProcessPoolExecutor(max_workers=num_workers) as executor:
+				results = list(executor.map(_detect_tile, tasks))
+		
+		data = np.zeros(data_orig.shape, dtype=np.float64)
+		convolved_data = np.zeros(data_orig.shape, dtype=np.float64)
+		labels = np.zeros(data_orig.shape, dtype=np.int32)
+		deblend_labels = np.zeros(data_orig.shape, dtype=np.int32)
+		all_labels, all_deblend = [], []
+		label_offset, deblend_offset = 0, 0
+		
+		for (y0, y1, x0, x1, oy, ox), (tile_data, tile_convolved, tile_labels, tile_deblend) in zip(cores, results):
+			core = (slice(oy, oy + y1 - y0), slice(ox, ox + x1 - x0))
+			data[y0:y1, x0:x1] = tile_data[core]
+			convolved_data[y0:y1, x0:x1] = tile_convolved[core]
+			tile_labels = np.where(tile_labels > 0, tile_labels + label_offset, 0)
+			tile_deblend = np.where(tile_deblend > 0, tile_deblend + deblend_offset, 0)
+			labels[y0:y1, x0:x1] = tile_labels[core]
+			deblend_labels[y0:y1, x0:x1] = tile_deblend[core]
+			all_labels.append(tile_labels)
+			all_deblend.append(tile_deblend)
+			label_offset = max(label_offset, int(tile_labels.max()))
+			deblend_offset = max(deblend_offset, int(tile_deblend.max()))
+		
+		labels = _union_labels_in_overlaps(labels, all_labels, tile_boxes, neighbours)
+		deblend_labels = _union_labels_in_overlaps(deblend_labels, all_deblend, tile_boxes, neighbours)
+		if not deblend_labels.any():
+			raise NoSourcesError('No sources found in the image.')
+		
+		segment_map = SegmentationImage(labels)
+		segment_map.relabel_consecutive()
+		segm_deblend = SegmentationImage(deblend_labels)
+		segm_deblend.relabel_consecutive()
+		if verbose:
+			print(f"Number of sources: {segment_map.nlabels}\nNumber of tiles: {len(tasks)}")
+		
+		cat = SourceCatalog(data, segm_deblend, convolved_data=convolved_data)
+		relevant_sources_tbl = select_relevant_sources(cat, hw_threshold)
+	except Exception as e:
+		if raise_errors:
+			raise
+		print(e)
+		return None, None, None
+	return segment_map, None, relevant_sources_tbl
+
+CATALOG_COLUMNS = ['label', 'xcentroid', 'ycentroid', 'bbox_xmin', 'bbox_ymin', 'bbox_xmax', 'bbox_ymax', 'area', 'kron_flux']
+
+def sources_to_boxes(sources_tbl):
+	"""
+	Convert the bbox_* columns of a source table (astropy Table or pandas DataFrame) to prompt boxes.
+
+	Returns:
+	- numpy.ndarray: Boxes of shape [N, 4] in the (x_min, y_min, x_max, y_max) format.
+	"""
+	if sources_tbl is None or len(sources_tbl) == 0:
+		return np.zeros((0, 4))
+	return np.stack([np.asarray(sources_tbl[column], dtype=np.float64) for column in ('bbox_xmin', 'bbox_ymin', 'bbox_xmax', 'bbox_ymax')], axis=1)
+
+def source_catalog_cached(data_2D, cache_dir, file_format='parquet', hw_threshold=0, clip_sigma=3.0, kernel_sigma=3.0, npixels=10, 
+		tile_size=None, num_workers=None):
+	"""
+	Run the source detection on an image and cache the resulting catalog on disk.
+
+	The cache key is a hash of the image bytes and of the detection parameters, so the catalog is reused 
+	as long as neither changes (e.g. when only the SAM checkpoint changes). An image without sources is cached 
+	as an empty catalog; a failed detection is not cached, so that it is retried on the next call.
+
+	Parameters:
+	- data_2D (numpy.ndarray): The image on which the sources are detected.
+	- cache_dir (str): The folder of the cached catalogs.
+	- file_format (str): 'parquet' or 'feather'.
+	- hw_threshold, clip_sigma, kernel_sigma, npixels: Parameters of detect_and_deblend_sources.
+	- tile_size, num_workers: If tile_size is given, detect_and_deblend_sources_tiled is used.
+
+	Returns:
+	- pandas.DataFrame: The catalog with the CATALOG_COLUMNS columns (empty if no sources were found), or None if the detection failed.
+	"""
+	import hashlib
+	import json
+	import pandas as pd
+
+	if file_format not in ('parquet', 'feather'):
+		raise ValueError(f"Unknown catalog format {file_format}. Use 'parquet' or 'feather'.")
+	
+	data_2D = np.ascontiguousarray(data_2D)
+	params = {'hw_threshold': hw_threshold, 'clip_sigma': clip_sigma, 'kernel_sigma': kernel_sigma, 'npixels': npixels, 'tile_size': tile_size}
+	digest = hashlib.sha1(data_2D.tobytes())
+	digest.update(f"{data_2D.shape}{data_2D.dtype}{json.dumps(params, sort_keys=True)}".encode())
+	cache_path = os.path.join(cache_dir, f"{digest.hexdigest()}.{file_format}")
+	
+	if os.path.exists(cache_path):
+		return pd.read_parquet(cache_path) if file_format == 'parquet' else pd.read_feather(cache_path)
+	
+	try:
+		if tile_size is not None and max(data_2D.shape) > tile_size:
+			_, _, sources_tbl = detect_and_deblend_sources_tiled(data_2D, hw_threshold=hw_threshold, clip_sigma=clip_sigma, kernel_sigma=kernel_sigma, 
+														   npixels=npixels, tile_size=tile_size, num_workers=num_workers, raise_errors=True)
+		else:
+			_, _, sources_tbl = detect_and_deblend_sources(data_2D, hw_threshold=hw_threshold, clip_sigma=clip_sigma, kernel_sigma=kernel_sigma, 
+													 npixels=npixels, verbose=False, catalog_only=True, raise_errors=True)
+		catalog = pd.DataFrame({column: np.asarray(sources_tbl[column]) for column in CATALOG_COLUMNS})
+	except NoSourcesError:
+		catalog = pd.DataFrame({column: np.zeros(0) for column in CATALOG_COLUMNS})
+	except Exception as e:
+		print(e)
+		return None
+	
+	os.makedirs(cache_dir, exist_ok=True)
+	# Write to a temporary file first so that concurrent readers never see a partial catalog
+	tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+	if file_format == 'parquet':
+		catalog.to_parquet(tmp_path)
+	else:
+		catalog.to_feather(tmp_path)
+	os.replace(tmp_path, cache_path)
+	
+	return catalog
+
 def mask_with_sigma_clipping(data_2D, sigma=3.0, maxiters=10, sigma_threshold=4.5, footprint_radius=10):
 	'''
 	prints statistics of the image data, excluding the masked regions.
 	'''
+	import matplotlib.pyplot as plt
+	from astropy.stats import biweight_location, mad_std, sigma_clipped_stats, SigmaClip
+	from photutils.segmentation import detect_threshold, detect_sources
+	from photutils.utils import circular_footprint
 	sigma_clip = SigmaClip(sigma=sigma, maxiters=10)
 	
 	threshold = detect_threshold(data_2D, nsigma=sigma_threshold, sigma_clip=sigma_clip)
@@ -265,11 +667,15 @@ def mask_with_sigma_clipping(data_2D, sigma=3.0, maxiters=10, sigma_threshold=4.
 	plt.close()
 	return mask, mean, median, std
 
-def get_normalized_centers(data_2D, hw_threshold=30, clip_sigma=2.5, kernel_sigma=1.5, npixels=10):
-	segment_map, segment_map_finder, sources_tbl_with_hw_threshold = detect_and_deblend_sources(data_2D, hw_threshold=hw_threshold, clip_sigma=clip_sigma, 
-																		  kernel_sigma=kernel_sigma, npixels=npixels, verbose=False)
+def get_normalized_centers(data_2D, hw_threshold=30, clip_sigma=2.5, kernel_sigma=1.5, npixels=10, tile_size=None, num_workers=None):
+	if tile_size is not None and max(data_2D.shape) > tile_size:
+		segment_map, _, sources_tbl_with_hw_threshold = detect_and_deblend_sources_tiled(data_2D, hw_threshold=hw_threshold, clip_sigma=clip_sigma, 
+																		  kernel_sigma=kernel_sigma, npixels=npixels, tile_size=tile_size, num_workers=num_workers)
+	else:
+		segment_map, _, sources_tbl_with_hw_threshold = detect_and_deblend_sources(data_2D, hw_threshold=hw_threshold, clip_sigma=clip_sigma, 
+																		  kernel_sigma=kernel_sigma, npixels=npixels, verbose=False, catalog_only=True)
     
-	if segment_map and segment_map_finder and sources_tbl_with_hw_threshold:
+	if segment_map is not None and sources_tbl_with_hw_threshold:
 		centers_x = [source['xcentroid'] for source in sources_tbl_with_hw_threshold]
 		centers_y = [source['ycentroid'] for source in sources_tbl_with_hw_threshold]
 		
@@ -287,6 +693,7 @@ def get_normalized_centers(data_2D, hw_threshold=30, clip_sigma=2.5, kernel_sigm
 		return None
 
 def clahe_algo_image(IMAGE_PATH, clipLimit=3.0, tileGridSize=(8,8)):
+    import matplotlib.pyplot as plt
 
     image = cv2.imread(IMAGE_PATH.replace(".fits", ".png"))
     image_bw = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
@@ -321,6 +728,7 @@ def clahe_algo_image(IMAGE_PATH, clipLimit=3.0, tileGridSize=(8,8)):
     return final_img
 
 def enhance_contrast_with_adaptive_thresholding(IMAGE_PATH, clipLimit=3.0, tileGridSize=(8,8)):
+    import matplotlib.pyplot as plt
     image = cv2.imread(IMAGE_PATH)
     image_bw = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
@@ -354,6 +762,7 @@ def enhance_contrast_with_adaptive_thresholding(IMAGE_PATH, clipLimit=3.0, tileG
     return final_img
 
 def clahe_algo_image_improved(IMAGE_PATH, clipLimit=1.0, tileGridSize=(4,4), bright_threshold=200):
+    import matplotlib.pyplot as plt
     image = cv2.imread(IMAGE_PATH.replace(".fits", ".png"))
     image_bw = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
@@ -393,6 +802,10 @@ def clahe_algo_image_improved(IMAGE_PATH, clipLimit=1.0, tileGridSize=(4,4), bri
     return final_img
 
 def enhance_astronomical_image(image_path, clipLimit=3.0, tileGridSize=(16,16)):
+    import matplotlib.pyplot as plt
+    from astropy.visualization import simple_norm
+    from astropy.stats import sigma_clipped_stats
+    from astropy.io import fits
     with fits.open(image_path) as hdul:
         image_data = hdul[0].data
     
@@ -423,14 +836,14 @@ def enhance_astronomical_image(image_path, clipLimit=3.0, tileGridSize=(16,16)):
     
     plt.show()
 
-from astropy.stats import sigma_clipped_stats
-from astropy.io import fits
-from astropy.visualization import simple_norm
-import matplotlib.pyplot as plt
 import numpy as np
 import cv2
 
 def selective_clahe_astronomical_image(image_path, clipLimit=3.0, tileGridSize=(1,1)):
+    import matplotlib.pyplot as plt
+    from astropy.visualization import simple_norm
+    from astropy.stats import sigma_clipped_stats
+    from astropy.io import fits
     with fits.open(image_path) as hdul:
         image_data = hdul[0].data
     
@@ -480,6 +893,7 @@ def selective_clahe_astronomical_image(image_path, clipLimit=3.0, tileGridSize=(
     plt.show()
 
 def darken_background(image_path):
+    import matplotlib.pyplot as plt
     # Load the image
     image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
     
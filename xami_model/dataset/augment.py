@@ -6,7 +6,7 @@ from skimage.color import label2rgb
 import random
 import math
 from typing import Dict, List, Any
-from . import dataset_utils
+from . import dataset_utils, coco_merge
 import pycocotools.mask as maskUtils
 
 BOX_COLOR = (255, 0, 0) 
@@ -195,4 +195,122 @@ def update_dataset_with_augms(
     #     data['annotations'].append(new_annotations)
     
     # return data
-        
\ No newline at end of file
+        
+def _augmentation_seed(seed, image_id, copy_idx):
+    # Derived from the image and copy, not from the worker, so that the output doesn't depend on the number of workers
+    return int(np.random.SeedSequence([seed, image_id, copy_idx]).generate_state(1)[0])
+
+def _materialize_shard(worker_id, items, input_dir, output_dir, transform, multiplier, seed, categories, shard_path):
+    """
+    Worker of materialize_augmentations: writes multiplier augmented copies of each (image_info, annotations) item
+    and a COCO annotations shard for them (RLE segmentations, IDs local to the shard).
+    """
+    from .packed_dataset import image_masks
+    import json
+    cv2.setNumThreads(1) # the parallelism is across the worker processes
+
+    images, annotations = [], []
+    for image_info, image_annotations in items:
+        image = cv2.imread(os.path.join(input_dir, image_info['file_name']))
+        if image is None:
+            raise FileNotFoundError(f"Cannot read {os.path.join(input_dir, image_info['file_name'])}")
+        masks = image_masks(image_annotations, image.shape[:2])
+        mask_categories = [category_id for _, category_id, _ in masks]
+        masks = [mask for _, _, mask in masks]
+        bboxes = [cv2.boundingRect(mask) for mask in masks]
+
+        stem, ext = os.path.splitext(os.path.basename(image_info['file_name']))
+        for copy_idx in range(multiplier):
+            augmentation_seed = _augmentation_seed(seed, image_info['id'], copy_idx)
+            random.seed(augmentation_seed)
+            np.random.seed(augmentation_seed % 2**32)
+            if hasattr(transform, 'set_random_seed'):
+                transform.set_random_seed(augmentation_seed)
+            augmented = transform(image=image, masks=masks, bboxes=bboxes, category_id=mask_categories)
+
+            # The image id keeps apart the inputs with the same basename in different subdirectories
+            file_name = f"{stem}_id{image_info['id']}_aug{copy_idx}{ext}"
+            cv2.imwrite(os.path.join(output_dir, file_name), augmented['image'])
+            image_id = len(images)
+            images.append({'id': image_id, 'file_name': file_name, 'height': augmented['image'].shape[0],
+                           'width': augmented['image'].shape[1], 'source_file_name': image_info['file_name']})
+            # The masks keep their order through the pipeline (unlike the bboxes, which can be dropped)
+            for mask, category_id in zip(augmented['masks'], mask_categories):
+                mask = np.asarray(mask, dtype=np.uint8)
+                if not np.any(mask):
+                    continue
+                rle = maskUtils.encode(np.asfortranarray(mask))
+                x, y, w, h = cv2.boundingRect(mask)
+                annotations.append({'id': len(annotations), 'image_id': image_id, 'category_id': category_id,
+                                    'segmentation': {'size': rle['size'], 'counts': rle['counts'].decode()},
+                                    'bbox': [x, y, w, h], 'area': int(np.sum(mask)), 'iscrowd': 0})
+
+    with open(shard_path + '.tmp', 'w') as f:
+        json.dump({'images': images, 'annotations': annotations, 'categories': categories}, f)
+    os.replace(shard_path + '.tmp', shard_path)
+    return worker_id, len(images), len(annotations)
+
+def materialize_augmentations(
+                              input_dir: str,
+                              output_dir: str,
+                              transform,
+                              multiplier: int = 5,
+                              json_name: str = '_annotations.coco.json',
+                              num_workers: int = None,
+                              seed: int = 0,
+                              keep_shards: bool = False):
+    """
+    Writes multiplier augmented copies of every image of a COCO split, in parallel, with their annotations.
+
+    Unlike update_dataset_with_augms (one image at a time, annotations kept in memory), the images are fanned out to a
+    process pool. Each worker writes its augmented images and a COCO annotations shard (RLE segmentations), and the
+    shards are merged into output_dir/json_name at the end. Each augmented copy is seeded from (seed, image id, copy),
+    so the corpus is reproducible and independent of the number of workers.
+
+    Args:
+        input_dir (str): The split directory, with the images and the COCO annotations file.
+        output_dir (str): Where the augmented images and annotations are written.
+        transform: An albumentations pipeline called as transform(image=..., masks=..., bboxes=..., category_id=...),
+            e.g. the combined_augmentations of train_segmentor.main (COCO bboxes with a 'category_id' label field).
+        multiplier (int): The number of augmented copies of each image.
+        json_name (str): The COCO annotations file, in input_dir and in output_dir.
+        num_workers (int, optional): Number of worker processes. Default: os.cpu_count(). With 1, the images are
+            augmented in this process.
+        seed (int): The base seed of the augmentations.
+        keep_shards (bool): Keep the per-worker annotation shards after merging them.
+
+    Returns:
+        str: The path of the merged annotations file.
+    """
+    import json
+    from concurrent.futures import ProcessPoolExecutor
+
+    with open(os.path.join(input_dir, json_name)) as f:
+        data_in = json.load(f)
+    annotations_by_image = {}
+    for annotation in data_in['annotations']:
+        annotations_by_image.setdefault(annotation['image_id'], []).append(annotation)
+    items = [(image_info, annotations_by_image.get(image_info['id'], [])) for image_info in data_in['images']]
+
+    os.makedirs(output_dir, exist_ok=True)
+    num_workers = max(1, min(num_workers or os.cpu_count() or 1, len(items)))
+    # Round-robin, so that every worker gets a similar mix of dense and sparse fields
+    shard_paths = [os.path.join(output_dir, f'{json_name}.shard{worker_id:05d}') for worker_id in range(num_workers)]
+    worker_args = [(worker_id, items[worker_id::num_workers], input_dir, output_dir, transform, multiplier, seed,
+                    data_in['categories'], shard_paths[worker_id]) for worker_id in range(num_workers)]
+
+    if num_workers == 1:
+        results = [_materialize_shard(*args) for args in worker_args]
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(_materialize_shard, *zip(*worker_args)))
+    print(f"Augmented {len(items)} images x {multiplier}: {sum(r[1] for r in results)} images and "
+          f"{sum(r[2] for r in results)} annotations written by {num_workers} workers.")
+
+    output_path = os.path.join(output_dir, json_name)
+    # The augmented copies are all distinct, no need to hash their content
+    coco_merge.merge_coco_files(shard_paths, output_path, dedup=None)
+    if not keep_shards:
+        for shard_path in shard_paths:
+            os.remove(shard_path)
+    return output_path
@@ -0,0 +1,298 @@
+"""
+Streaming merge and validation of COCO annotation files.
+
+dataset_utils.merge_coco_jsons loads two files fully into memory. merge_coco_files takes any number of inputs
+(observation batches, k-fold splits, augmentation shards...) and streams their records: one image or annotation
+is decoded at a time, and the only state kept is a compact map from the old to the new IDs, the image hashes and
+the merged image paths.
+
+    python -m xami_model.dataset.coco_merge batch1/_annotations.coco.json batch2/_annotations.coco.json -o merged.json
+
+The merge:
+  - renumbers the images and annotations from 0, remapping the annotations' image_id,
+  - rewrites the image file names relative to the directory of the merged file,
+  - drops duplicated images (same file content, or same file name with --dedup file_name) and their annotations,
+  - checks that the categories agree (an ID keeps the same name in every input) and that every annotation refers
+    to a known image and category.
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+from array import array
+
+import numpy as np
+
+_WHITESPACE = ' \t\n\r'
+_STRUCTURE_RE = re.compile(r'["\[\]{}]')
+_STRING_TAIL_RE = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"')
+# A value or error this close to the end of the buffer may just be cut by it (e.g. "1." of "1.5", or "tru")
+_TRUNCATION_MARGIN = 32
+
+class _JsonStream:
+    """Incremental reader of one JSON document, on top of json.JSONDecoder.raw_decode over a chunked buffer."""
+    def __init__(self, f, chunk_size=1 << 20):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """The next non-whitespace character (without consuming it), or '' at the end of the file."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self._fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, chars):
+        char = self.peek()
+        if char == '' or char not in chars:
+            raise ValueError(f"Invalid JSON: expected one of {chars!r}, got {char!r}")
+        self.pos += 1
+        return char
+
+    def value(self):
+        """Decode the next complete value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as e:
+                # Only an error at the end of the buffer (or in a string running up to it) can be fixed by more data;
+                # anything else is a malformed record, reported without reading the rest of the file
+                cut = len(self.buffer) - e.pos <= _TRUNCATION_MARGIN or e.msg.startswith('Unterminated string')
+                if cut and self._fill():
+                    continue
+                raise
+            if len(self.buffer) - end <= _TRUNCATION_MARGIN and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def skip_value(self):
+        """Skip the next value, only matching its brackets and strings instead of decoding it."""
+        if self.peek() not in '[{':
+            self.value()
+            return
+        depth = 0
+        while True:
+            match = _STRUCTURE_RE.search(self.buffer, self.pos)
+            if match is None:
+                self.pos = len(self.buffer)
+                if not self._fill():
+                    raise ValueError("Invalid JSON: unexpected end of file")
+                continue
+            self.pos = match.end()
+            char = match.group()
+            if char == '"':
+                match = _STRING_TAIL_RE.match(self.buffer, self.pos)
+                while match is None:
+                    if not self._fill():
+                        raise ValueError("Invalid JSON: unterminated string")
+                    match = _STRING_TAIL_RE.match(self.buffer, self.pos)
+                self.pos = match.end()
+            elif char in '[{':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def array_items(self):
+        """Iterate over the items of the array starting here, decoding one item at a time."""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+
+def iter_coco_sections(path, keys, chunk_size=1 << 20):
+    """
+    Iterate over the records of some top-level arrays ('images', 'annotations', 'categories'...) of a COCO file,
+    without loading the file, in the order of the file.
+
+    Yields:
+        (key, record): The records of the arrays in keys. The other top-level values are skipped without being decoded.
+    """
+    with open(path) as f:
+        stream = _JsonStream(f, chunk_size)
+        stream.expect('{')
+        if stream.peek() == '}':
+            return
+        while True:
+            name = stream.value()
+            stream.expect(':')
+            if name in keys:
+                for record in stream.array_items():
+                    yield name, record
+            else:
+                stream.skip_value()
+            if stream.expect(',}') == '}':
+                return
+
+def iter_coco_records(path, key, chunk_size=1 << 20):
+    """The records of one top-level array of a COCO file, see iter_coco_sections."""
+    for _, record in iter_coco_sections(path, (key,), chunk_size):
+        yield record
+
+class _IdMap:
+    """Old ID -> new ID of the records of one input, as two sorted int64 arrays instead of a dict of Python ints."""
+    def __init__(self):
+        self._old, self._new = array('q'), array('q')
+        self.old_ids, self.new_ids = None, None
+
+    def add(self, old_id, new_id):
+        self._old.append(old_id)
+        self._new.append(new_id)
+
+    def finalize(self, source):
+        old_ids = np.frombuffer(self._old, dtype=np.int64)
+        order = np.argsort(old_ids, kind='stable')
+        self.old_ids, self.new_ids = old_ids[order], np.frombuffer(self._new, dtype=np.int64)[order]
+        duplicated = self.old_ids[1:][self.old_ids[1:] == self.old_ids[:-1]]
+        if len(duplicated) > 0:
+            raise ValueError(f"{source}: the image ID {int(duplicated[0])} is used more than once")
+        self._old, self._new = None, None
+
+    def get(self, old_id):
+        """The new ID, -1 for a dropped (duplicated) image, or None for an unknown ID."""
+        i = np.searchsorted(self.old_ids, old_id)
+        if i < len(self.old_ids) and self.old_ids[i] == old_id:
+            return int(self.new_ids[i])
+        return None
+
+def image_content_hash(path, block_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.digest()
+
+def _add_category(categories, category, path):
+    """Add a category to the merged ones, checking that its ID has the same name in every input."""
+    known = categories.setdefault(category['id'], category)
+    if known['name'] != category['name']:
+        raise ValueError(f"{path}: the category {category['id']} is '{category['name']}', "
+                         f"but '{known['name']}' in a previous input")
+
+def merge_coco_files(inputs, output_path, image_dirs=None, dedup='content', chunk_size=1 << 20):
+    """
+    Merge COCO annotation files in bounded memory. Each input is read twice: once for its images and categories,
+    once for its annotations.
+
+    The merged file_name of an image is its path relative to the directory of output_path, so that images of
+    different inputs with the same file_name stay distinct. Two merged images with the same path are an error.
+
+    Args:
+        inputs (list): The COCO JSON files, in the order of the merged records.
+        output_path (str): The merged file. It is written to a temporary file first, so it is never left partial.
+        image_dirs (list, optional): The image directory of each input, which its file_names are relative to.
+            Defaults to the directory of each JSON file (the Roboflow/XAMI layout).
+        dedup (str or None): 'content' drops the images whose file content was already merged, 'file_name' the ones
+            whose (input) file name was, None keeps all the images.
+        chunk_size (int): Read size of the incremental parser.
+
+    Returns:
+        dict: Counts of the merged and dropped records.
+    """
+    if dedup not in ('content', 'file_name', None):
+        raise ValueError(f"Unknown dedup mode {dedup}")
+    if image_dirs is None:
+        image_dirs = [os.path.dirname(os.path.abspath(path)) for path in inputs]
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+
+    stats = {'inputs': len(inputs), 'images': 0, 'annotations': 0, 'duplicate_images': 0, 'dropped_annotations': 0}
+    categories, seen, merged_paths, id_maps = {}, set(), set(), []
+    tmp_path = output_path + '.tmp'
+    try:
+        with open(tmp_path, 'w') as out:
+            out.write('{"images": [')
+            for path, image_dir in zip(inputs, image_dirs):
+                id_map = _IdMap()
+                for key, record in iter_coco_sections(path, ('images', 'categories'), chunk_size):
+                    if key == 'categories':
+                        _add_category(categories, record, path)
+                        continue
+                    image = record
+                    image_path = os.path.join(image_dir, image['file_name'])
+                    if dedup is not None:
+                        dedup_key = image_content_hash(image_path) if dedup == 'content' else image['file_name']
+                        if dedup_key in seen:
+                            id_map.add(image['id'], -1)
+                            stats['duplicate_images'] += 1
+                            continue
+                        seen.add(dedup_key)
+                    merged_path = os.path.relpath(os.path.abspath(image_path), output_dir)
+                    if merged_path in merged_paths:
+                        raise ValueError(f"{path}: the image {image['id']} is {merged_path}, which is already merged")
+                    merged_paths.add(merged_path)
+                    id_map.add(image['id'], stats['images'])
+                    out.write((', ' if stats['images'] > 0 else '') +
+                              json.dumps(dict(image, id=stats['images'], file_name=merged_path)))
+                    stats['images'] += 1
+                id_map.finalize(path)
+                id_maps.append(id_map)
+
+            out.write('], "annotations": [')
+            for path, id_map in zip(inputs, id_maps):
+                for annotation in iter_coco_records(path, 'annotations', chunk_size):
+                    image_id = id_map.get(annotation['image_id'])
+                    if image_id is None:
+                        raise ValueError(f"{path}: the annotation {annotation.get('id')} refers to the unknown image "
+                                         f"{annotation['image_id']}")
+                    if annotation['category_id'] not in categories:
+                        raise ValueError(f"{path}: the annotation {annotation.get('id')} has the unknown category "
+                                         f"{annotation['category_id']}")
+                    if image_id < 0: # the annotations of a duplicated image are those of its first copy
+                        stats['dropped_annotations'] += 1
+                        continue
+                    out.write((', ' if stats['annotations'] > 0 else '') +
+                              json.dumps(dict(annotation, id=stats['annotations'], image_id=image_id)))
+                    stats['annotations'] += 1
+
+            out.write('], "categories": ' + json.dumps([categories[i] for i in sorted(categories)]) + '}')
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, output_path)
+    return stats
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Merge and validate COCO annotation files, streaming their records.')
+    parser.add_argument('inputs', nargs='+', help='The COCO JSON files to merge.')
+    parser.add_argument('-o', '--output', required=True)
+    parser.add_argument('--image-dirs', nargs='+', default=None,
+                        help='The image directory of each input (default: the directory of each JSON file).')
+    parser.add_argument('--dedup', choices=['content', 'file_name', 'none'], default='content',
+                        help='How duplicated images are found.')
+    args = parser.parse_args(argv)
+    if args.image_dirs is not None and len(args.image_dirs) != len(args.inputs):
+        parser.error('--image-dirs needs one directory per input')
+
+    stats = merge_coco_files(args.inputs, args.output, image_dirs=args.image_dirs,
+                             dedup=None if args.dedup == 'none' else args.dedup)
+    print(f"Merged {stats['inputs']} files into {args.output}: {stats['images']} images, {stats['annotations']} "
+          f"annotations ({stats['duplicate_images']} duplicated images and {stats['dropped_annotations']} of their "
+          f"annotations dropped).")
+
+if __name__ == '__main__':
+    main()
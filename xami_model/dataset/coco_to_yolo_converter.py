@@ -1,21 +1,62 @@
 import json
 import os
 import shutil
-from . import dataset_utils
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
 import numpy as np
 import cv2
 import yaml
 
+def write_yolo_labels(task):
+    """
+    Write the YOLO segmentation label file of one image in a single write.
+    Defined at module level so that it can be dispatched to worker processes.
+
+    Args:
+        task (tuple): (annotation_path, img_w, img_h, img_ann) with img_ann the COCO annotations of the image.
+
+    Returns:
+        (list): The segments written, each as [class, x1, y1, x2, y2, ...] normalized to [0, 1].
+    """
+    annotation_path, img_w, img_h, img_ann = task
+    segments = []
+    
+    for ann in img_ann:
+        cls = ann['category_id']
+        if len(ann["segmentation"]) > 1:
+            s = COCOToYOLOConverter.merge_multi_segment(ann["segmentation"])
+            s = (np.concatenate(s, axis=0) / np.array([img_w, img_h])).reshape(-1).tolist()
+        else:
+            s = [j for i in ann["segmentation"] for j in i]  # all segments concatenated
+            s = (np.array(s).reshape(-1, 2) / np.array([img_w, img_h])).reshape(-1).tolist()
+        segments.append([cls] + s)
+
+    # Write image segmentation (an empty file if the image doesn't have annotations)
+    lines = [("%g " * len(segment)).rstrip() % tuple(segment) + "\n" for segment in segments]
+    with open(annotation_path, 'w') as file_object:
+        file_object.write(''.join(lines))
+    
+    return segments
+
 class COCOToYOLOConverter:
     def __init__(self, input_path, output_path, annotations_file, plot_yolo_masks=False):
         self.input_path = input_path
         self.output_path = output_path
         self.plot_yolo_masks = plot_yolo_masks
+        self.annotations_path = os.path.join(self.input_path, annotations_file)
         
-        with open(os.path.join(self.input_path, annotations_file)) as f:
+        with open(self.annotations_path) as f:
             self._data = json.load(f)
 
+        # Index images and annotations once instead of scanning the lists per image
+        self._img_by_name = {}
+        for img in self._data['images']:
+            self._img_by_name.setdefault(img['file_name'], img)
+        self._ann_by_img_id = defaultdict(list)
+        for ann in self._data['annotations']:
+            self._ann_by_img_id[ann['image_id']].append(ann)
+
         self.file_names = []
         
         # Ensure output directories (will) exist
@@ -28,37 +69,39 @@ class COCOToYOLOConverter:
         if not os.path.exists(self.output_path+'/labels/'):
             os.mkdir(self.output_path+'/labels/')
     
-    def load_images_from_folder(self, folder):
+    def load_images_from_folder(self, folder, incremental=False):
         count = 0
-        filenames_from_json = list(set([file_['file_name'] for file_ in self._data['images']]))
+        filenames_from_json = list(self._img_by_name)
         
         for filename in filenames_from_json:
             if filename.split('.')[-1] in ['jpg', 'jpeg', 'png']: 
                 source = os.path.join(folder, filename)
                 destination = f"{self.output_path}/images/{filename}"
         
-                try:
-                    shutil.copy(source, destination)
-                except shutil.SameFileError:
-                    print("Source and destination represent the same file.")
+                if not (incremental and self.is_up_to_date(destination, [source])):
+                    try:
+                        shutil.copy(source, destination)
+                    except shutil.SameFileError:
+                        print("Source and destination represent the same file.")
         
                 self.file_names.append(filename)
                 count += 1
         return count
 
     def get_img_ann(self, image_id):
-        img_ann = []
-        isFound = False
-        for ann in self._data['annotations']:
-            if ann['image_id'] == image_id:
-                img_ann.append(ann)
-                isFound = True
-        return img_ann if isFound else None
+        img_ann = self._ann_by_img_id.get(image_id)
+        return img_ann if img_ann else None
 
     def get_img(self, filename):
-        for img in self._data['images']:
-            if img['file_name'] == filename:
-                return img
+        return self._img_by_name.get(filename)
+
+    @staticmethod
+    def is_up_to_date(path, sources):
+        """Whether `path` exists and is at least as recent as all of the `sources` files."""
+        if not os.path.exists(path):
+            return False
+        mtime = os.path.getmtime(path)
+        return all(os.path.getmtime(source) <= mtime for source in sources if os.path.exists(source))
             
     def plot_segmentation_contours(self, filename, segments):
         
@@ -98,75 +141,48 @@ class COCOToYOLOConverter:
             plt.title(f'YOLOv8 Segmentation Contours\n{filename.split(".")[0]}')
             plt.show()
 
-    def coco_to_yolo(self):
-        count = 0
+    def coco_to_yolo(self, num_workers=1, incremental=False):
+        """
+        Write one YOLO label file per image.
+
+        Args:
+            num_workers (int): Number of worker processes. With 1 (or when plotting the masks) the 
+                               labels are written in the current process.
+            incremental (bool): Skip images whose label file is newer than both the image and the 
+                                annotations file.
+
+        Returns:
+            (int): The number of label files written.
+        """
+        tasks, task_filenames = [], []
         for filename in self.file_names:
             img = self.get_img(filename)
-            img_id = img['id']          
-            img_w = img['width']
-            img_h = img['height']
             annotation_path = f"{self.output_path}/labels/{'.'.join(filename.split('.')[:-1])}.txt"
-        
-            img_ann = self.get_img_ann(img_id)
-            if img_ann is None:  # the image doesn't have annotations
-                with open(annotation_path, 'w') as f:
-                    pass  # An empty file is created
+            if incremental and self.is_up_to_date(
+                annotation_path, [self.annotations_path, os.path.join(self.input_path, filename)]):
                 continue
+            tasks.append((annotation_path, img['width'], img['height'], self._ann_by_img_id.get(img['id'], [])))
+            task_filenames.append(filename)
 
-            # plt.figure(figsize=(30, 30))
-            # plt.imshow(plt.imread(f"{self.output_path}images/{filename}"))
-            
-            with open(annotation_path, "a") as file_object:
-                segments = []
-                
-                for ann in img_ann:
-                    cls = ann['category_id']
-                    current_category = ann['category_id']
-                    flat_points = ann['segmentation'][0]
-                    # polygon_points = np.array(flat_points).reshape(-1, 2)
-                    mask = dataset_utils.create_mask(flat_points, (img_h, img_w))
-                    bbox = dataset_utils.mask_to_bbox(mask)
-                    x, y, w, h = bbox[0], bbox[1], bbox[2] - bbox[0], bbox[3] - bbox[1]
-                    # dataset_utils.show_mask(mask, plt.gca())
-                    # dataset_utils.show_box([x, y, x+w, y+h], plt.gca())
-
-                    # Calculate and normalize midpoints
-                    x_centre = (x + w / 2) / img_w
-                    y_centre = (y + h / 2) / img_h
-                    w = w / img_w
-                    h = h / img_h
-                    
-                    if len(ann["segmentation"]) > 1:
-                        s = self.merge_multi_segment(ann["segmentation"])
-                        s = (np.concatenate(s, axis=0) / np.array([img_w, img_h])).reshape(-1).tolist()
-                    else:
-                        s = [j for i in ann["segmentation"] for j in i]  # all segments concatenated
-                        s = (np.array(s).reshape(-1, 2) / np.array([img_w, img_h])).reshape(-1).tolist()
-                    s = [cls] + s
-                    segments.append(s)
-                    
-                    # Write bbox
-                    # file_object.write(f"{current_category} {x_centre:.6f} {y_centre:.6f} {w:.6f} {h:.6f}\n")
-
-                    # Write image segmentation
-                    
-                for i in range(len(segments)):
-                    line = (
-                        *(segments[i]),
-                    ) 
-                    file_object.write(("%g " * len(line)).rstrip() % line + "\n")
-                        
-                if self.plot_yolo_masks:
+        if num_workers > 1 and not self.plot_yolo_masks and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                for _ in executor.map(write_yolo_labels, tasks, chunksize=max(1, len(tasks) // (4 * num_workers))):
+                    pass
+        else:
+            for filename, task in zip(task_filenames, tasks):
+                segments = write_yolo_labels(task)
+                if self.plot_yolo_masks and len(segments) > 0:
                     self.plot_segmentation_contours(filename, segments)
 
-            count += 1
+        return len(tasks)
 
-    def convert(self):
-        self.load_images_from_folder(self.input_path)
-        self.coco_to_yolo()
-        print(f"Processed {len(self.file_names)} files.")
+    def convert(self, num_workers=1, incremental=False):
+        self.load_images_from_folder(self.input_path, incremental=incremental)
+        count = self.coco_to_yolo(num_workers=num_workers, incremental=incremental)
+        print(f"Processed {len(self.file_names)} files ({count} label files written).")
         
-    def min_index(self, arr1, arr2): # From the ultralytics converter.py source code: https://github.com/ultralytics/ultralytics/blob/main/ultralytics/data/converter.py#L449
+    @staticmethod
+    def min_index(arr1, arr2): # From the ultralytics converter.py source code: https://github.com/ultralytics/ultralytics/blob/main/ultralytics/data/converter.py#L449
         """
         Find a pair of indexes with the shortest distance between two arrays of 2D points.
 
@@ -180,7 +196,8 @@ class COCOToYOLOConverter:
         dis = ((arr1[:, None, :] - arr2[None, :, :]) ** 2).sum(-1)
         return np.unravel_index(np.argmin(dis, axis=None), dis.shape)
 
-    def merge_multi_segment(self, segments): # From the ultralytics converter.py source code: https://github.com/ultralytics/ultralytics/blob/main/ultralytics/data/converter.py#L449
+    @staticmethod
+    def merge_multi_segment(segments): # From the ultralytics converter.py source code: https://github.com/ultralytics/ultralytics/blob/main/ultralytics/data/converter.py#L449
         """
         Merge multiple segments into one list by connecting the coordinates with the minimum distance between each segment.
         This function connects these coordinates with a thin line to merge all segments into one.
@@ -198,7 +215,7 @@ class COCOToYOLOConverter:
 
         # Record the indexes with min distance between each segment
         for i in range(1, len(segments)):
-            idx1, idx2 = self.min_index(segments[i - 1], segments[i])
+            idx1, idx2 = COCOToYOLOConverter.min_index(segments[i - 1], segments[i])
             idx_list[i - 1].append(idx1)
             idx_list[i].append(idx2)
 
@@ -229,7 +246,7 @@ class COCOToYOLOConverter:
                         s.append(segments[i][nidx:])
         return s
     
-def convert_coco_to_yolo(dir_absolute_path, dataset_path, yolo_dataset_path, convert=True):
+def convert_coco_to_yolo(dir_absolute_path, dataset_path, yolo_dataset_path, convert=True, num_workers=1, incremental=False):
     if not convert:
         return
 
@@ -245,7 +262,7 @@ def convert_coco_to_yolo(dir_absolute_path, dataset_path, yolo_dataset_path, con
         output_path = os.path.join(yolo_dataset_path, mode)
         input_json_train = '_annotations.coco.json'
         converter = COCOToYOLOConverter(input_path, output_path, input_json_train, plot_yolo_masks=False)
-        converter.convert()
+        converter.convert(num_workers=num_workers, incremental=incremental)
 
         if mode == 'valid':  # train and valid folders successfully created
             yaml_path = os.path.join(os.path.dirname(output_path), 'data.yaml')
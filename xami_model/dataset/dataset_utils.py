@@ -1,15 +1,8 @@
-from tkinter import font
 import numpy as np
-import matplotlib.pyplot as plt
 import cv2
 import random
 from typing import Dict, List, Any
-import pycocotools.mask as maskUtils
 import json
-from astropy.io import fits
-from pyparsing import col
-import pywt
-from . import astronomy_utils
 
 BOX_COLOR = (255, 0, 0) 
 TEXT_COLOR = (0, 0, 255) 
@@ -55,11 +48,15 @@ def show_masks(masks, ax, random_color=False, colours=None):
         ax.imshow(mask_image)
 
 def show_box(box, ax):
+    import matplotlib.pyplot as plt
     x0, y0 = box[0], box[1]
     w, h = box[2] - box[0], box[3] - box[1]
     ax.add_patch(plt.Rectangle((x0, y0), w, h, edgecolor='red', facecolor=(0,0,0,0), lw=1))    
 
 def mask_and_plot_image(fits_file, plot_ = False):
+    import matplotlib.pyplot as plt
+    from astropy.io import fits
+    from . import astronomy_utils
     with fits.open(fits_file) as hdul:
         data = hdul[0].data
 
@@ -80,6 +77,7 @@ def mask_and_plot_image(fits_file, plot_ = False):
 
 def plot_bboxes_and_masks(image, bboxes, masks):
     
+    import matplotlib.pyplot as plt
     image_copy = image.copy()
     image_copy = image_copy.astype('uint8')
 
@@ -151,6 +149,7 @@ def visualize_masks(image_path, image, masks, labels, colors, alpha=0.4, is_gt=T
     - colors: A list of colors corresponding to each label.
     - alpha: Transparency of masks.
     """
+    import matplotlib.pyplot as plt
     # Pad the image (when labels are too big and they appear at image corners)
     pad_size = 20  # Padding size
     if len(image.shape) == 3:
@@ -222,6 +221,7 @@ def isolate_background(image, decomposition='db1', level=2, sigma=1):
     - mask:  numpy.ndarray. A binary mask indicating parts of the image close to the background.
     - close_to_background: numpy.ndarray. The parts of the original image that are close to the background.
     """
+    import pywt
     
     # Perform a multi-level wavelet decomposition
     coeffs = pywt.wavedec2(image, decomposition, level=level)
@@ -277,6 +277,7 @@ def get_coords_and_masks_from_json(input_dir, data_in, image_key=None):
     
     For each annotation, it keeps it only if its bounding box size is significant (h,w) > (5,5).
     """
+    import pycocotools.mask as maskUtils
     result_masks, bbox_coords, result_class = {}, {}, {}
     class_categories = {data_in['categories'][a]['id']:data_in['categories'][a]['name'] for a in range(len(data_in['categories']))}
 
@@ -0,0 +1,272 @@
+"""
+Packed, memory-mappable training dataset.
+
+Reading the COCO JSON, rasterizing every polygon and decoding one PNG per image per epoch means millions of small
+file opens on a parallel filesystem. pack_coco_split converts a COCO split once into a few large shards:
+
+  <packed_dir>/index.json                   categories, shard list and file names
+  <packed_dir>/shard-00000.pixels.bin       uint8 RGB pixels of the images, back to back
+  <packed_dir>/shard-00000.images.npy       one IMAGE_DTYPE record per image (pixel offset, size, normalization stats...)
+  <packed_dir>/shard-00000.annotations.npy  one ANNOTATION_DTYPE record per mask (class, XYXY box, RLE location...)
+  <packed_dir>/shard-00000.rles.bin         the compressed COCO RLE counts of the masks, back to back
+
+All shard files are opened with np.memmap / np.load(mmap_mode='r'), so reading an image is a slice of a mapped file.
+
+    python -m xami_model.dataset.packed_dataset ./xami_dataset_coco/ ./xami_dataset_packed/ --image-size 512
+"""
+import argparse
+import json
+import os
+
+import cv2
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from . import dataset_utils
+
+PACKED_VERSION = 1
+
+IMAGE_DTYPE = np.dtype([
+    ('offset', '<i8'), ('height', '<i4'), ('width', '<i4'), ('orig_height', '<i4'), ('orig_width', '<i4'),
+    ('mean', '<f4'), ('std', '<f4'), ('ann_start', '<i8'), ('ann_count', '<i4')])
+
+ANNOTATION_DTYPE = np.dtype([
+    ('category_id', '<i4'), ('mask_index', '<i4'), ('bbox', '<i4', (4,)), ('area', '<i8'),
+    ('rle_offset', '<i8'), ('rle_length', '<i4')])
+
+def pixel_stats(image):
+    """
+    The mean and std of the non-zero pixels, computed as in predictor_utils.transform_image, so that the
+    normalization of a packed image is the same as the one of the image read from disk.
+    """
+    image_tensor = torch.from_numpy(image).float()
+    image_nonzero = image_tensor[image_tensor > 0]
+    return image_nonzero.mean().item(), image_nonzero.std().item()
+
+def image_masks(annotations, image_shape):
+    """
+    Rasterize the annotations of one image, as get_coords_and_masks_from_json does (first polygon of each
+    annotation), also accepting RLE segmentations.
+
+    Returns:
+        list: (mask index, category id, [H, W] uint8 mask) for the non-empty masks. The mask index is the position of
+              the annotation among the ones of the image, as in the '<file_name>_mask<i>' keys used in training.
+    """
+    from pycocotools import mask as maskUtils
+    masks = []
+    for i, annotation in enumerate(annotations):
+        segmentation = annotation['segmentation']
+        if isinstance(segmentation, list) and len(segmentation) > 0 and isinstance(segmentation[0], list):
+            mask = dataset_utils.create_mask(segmentation[0], image_shape)
+        elif isinstance(segmentation, dict) and 'counts' in segmentation and 'size' in segmentation:
+            rle = maskUtils.frPyObjects([segmentation], segmentation['size'][0], segmentation['size'][1])
+            mask = maskUtils.decode(rle)[..., 0]
+        else:
+            continue
+        if mask.any():
+            masks.append((i, annotation['category_id'], mask))
+    return masks
+
+class _ShardWriter:
+    """Writes one shard; the files get their final names only in close(), so a crashed packing leaves no partial shard."""
+    def __init__(self, output_dir, name):
+        self.paths = {kind: os.path.join(output_dir, f'{name}.{kind}') for kind in
+                      ('pixels.bin', 'images.npy', 'annotations.npy', 'rles.bin')}
+        self.name = name
+        self.pixels = open(self.paths['pixels.bin'] + '.tmp', 'wb')
+        self.rles = open(self.paths['rles.bin'] + '.tmp', 'wb')
+        self.images, self.annotations, self.file_names = [], [], []
+        self.pixels_size, self.rles_size = 0, 0
+
+    def add(self, file_name, image, orig_shape, masks):
+        from pycocotools import mask as maskUtils
+        mean, std = pixel_stats(image)
+        self.images.append((self.pixels_size, image.shape[0], image.shape[1], orig_shape[0], orig_shape[1],
+                            mean, std, len(self.annotations), len(masks)))
+        self.file_names.append(file_name)
+        self.pixels.write(np.ascontiguousarray(image, dtype=np.uint8).tobytes())
+        self.pixels_size += image.size
+
+        for mask_index, category_id, mask in masks:
+            rle = maskUtils.encode(np.asfortranarray(mask))
+            bbox = [int(c) for c in dataset_utils.mask_to_bbox(mask)]
+            self.annotations.append((category_id, mask_index, bbox, int(mask.sum()), self.rles_size, len(rle['counts'])))
+            self.rles.write(rle['counts'])
+            self.rles_size += len(rle['counts'])
+
+    def close(self):
+        self.pixels.close()
+        self.rles.close()
+        for kind, records, dtype in (('images.npy', self.images, IMAGE_DTYPE),
+                                     ('annotations.npy', self.annotations, ANNOTATION_DTYPE)):
+            with open(self.paths[kind] + '.tmp', 'wb') as f:
+                np.save(f, np.array(records, dtype=dtype))
+        for path in self.paths.values():
+            os.replace(path + '.tmp', path)
+        return {'name': self.name, 'file_names': self.file_names}
+
+def pack_coco_split(input_dir, output_dir, json_name='_annotations.coco.json', image_size=None, shard_size_mb=1024):
+    """
+    Pack a COCO split (the images of input_dir and their annotations) into memory-mappable shards.
+
+    Args:
+        input_dir (str): The split directory, e.g. './xami_dataset_coco/train/'.
+        output_dir (str): Where to write the shards and index.json.
+        json_name (str): The COCO annotations file in input_dir.
+        image_size (int, optional): Resize the images (and masks) so that their longest side has this length.
+            None keeps the original size.
+        shard_size_mb (float): Approximate size of the pixel data of a shard.
+
+    Returns:
+        dict: The index written to output_dir/index.json.
+    """
+    import tqdm
+    with open(os.path.join(input_dir, json_name)) as f:
+        data_in = json.load(f)
+    annotations_by_image = {}
+    for annotation in data_in['annotations']:
+        annotations_by_image.setdefault(annotation['image_id'], []).append(annotation)
+
+    os.makedirs(output_dir, exist_ok=True)
+    shards, writer = [], None
+    for image_info in tqdm.tqdm(data_in['images'], desc=f'Packing {input_dir}'):
+        image = cv2.imread(os.path.join(input_dir, image_info['file_name']))
+        if image is None:
+            raise FileNotFoundError(f"Cannot read {os.path.join(input_dir, image_info['file_name'])}")
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        orig_shape = image.shape[:2]
+        masks = image_masks(annotations_by_image.get(image_info['id'], []), orig_shape)
+
+        if image_size is not None and max(orig_shape) != image_size:
+            scale = image_size / max(orig_shape)
+            new_w, new_h = int(round(orig_shape[1] * scale)), int(round(orig_shape[0] * scale))
+            interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+            image = cv2.resize(image, (new_w, new_h), interpolation=interpolation)
+            masks = [(i, c, cv2.resize(mask, (new_w, new_h), interpolation=cv2.INTER_NEAREST)) for i, c, mask in masks]
+            masks = [(i, c, mask) for i, c, mask in masks if mask.any()]
+
+        if writer is None:
+            writer = _ShardWriter(output_dir, f'shard-{len(shards):05d}')
+        writer.add(image_info['file_name'], image, orig_shape, masks)
+        if writer.pixels_size >= shard_size_mb * 2**20:
+            shards.append(writer.close())
+            writer = None
+    if writer is not None:
+        shards.append(writer.close())
+
+    index = {
+        'version': PACKED_VERSION,
+        'image_size': image_size,
+        'categories': {str(category['id']): category['name'] for category in data_in['categories']},
+        'shards': shards,
+    }
+    with open(os.path.join(output_dir, 'index.json.tmp'), 'w') as f:
+        json.dump(index, f)
+    os.replace(os.path.join(output_dir, 'index.json.tmp'), os.path.join(output_dir, 'index.json'))
+    return index
+
+class PackedImageDataset(Dataset):
+    """
+    load_dataset.ImageDataset over a directory written by pack_coco_split: the items are the same transform_image
+    dicts, but the images are slices of the memory-mapped shards and their normalization stats are precomputed.
+
+    The ground truth for XAMI.train_validate_step is given by gt_annotations (no polygon rasterization) and the
+    images it reads back by read_image (pass it as image_reader).
+    """
+    def __init__(self, packed_dir, model=None, transform=None, device='cpu'):
+        self.packed_dir = packed_dir
+        self.model = model
+        self.transform = transform
+        self.device = device
+        with open(os.path.join(packed_dir, 'index.json')) as f:
+            self.index = json.load(f)
+        if self.index['version'] != PACKED_VERSION:
+            raise ValueError(f"Unsupported packed dataset version {self.index['version']} in {packed_dir}")
+        self.categories = {int(k): v for k, v in self.index['categories'].items()}
+        self.file_names, self._locations = [], []
+        for shard_idx, shard in enumerate(self.index['shards']):
+            self.file_names.extend(shard['file_names'])
+            self._locations.extend((shard_idx, row) for row in range(len(shard['file_names'])))
+        self._positions = {file_name: idx for idx, file_name in enumerate(self.file_names)}
+        self._shards = {}
+
+    def __getstate__(self):
+        # The memory maps are reopened in each DataLoader worker
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def _shard(self, shard_idx):
+        if shard_idx not in self._shards:
+            prefix = os.path.join(self.packed_dir, self.index['shards'][shard_idx]['name'])
+            self._shards[shard_idx] = {
+                'pixels': np.memmap(prefix + '.pixels.bin', dtype=np.uint8, mode='r'),
+                'images': np.load(prefix + '.images.npy', mmap_mode='r'),
+                'annotations': np.load(prefix + '.annotations.npy', mmap_mode='r'),
+                'rles': np.memmap(prefix + '.rles.bin', dtype=np.uint8, mode='r'),
+            }
+        return self._shards[shard_idx]
+
+    def __len__(self):
+        return len(self.file_names)
+
+    def _record(self, idx):
+        shard_idx, row = self._locations[idx]
+        shard = self._shard(shard_idx)
+        return shard, shard['images'][row]
+
+    def get_image(self, idx):
+        """The RGB uint8 image (a copy, so that it can be modified)."""
+        shard, record = self._record(idx)
+        h, w = int(record['height']), int(record['width'])
+        return np.array(shard['pixels'][record['offset']:record['offset'] + h * w * 3]).reshape(h, w, 3)
+
+    def read_image(self, file_name):
+        """The image as cv2.imread would return it (BGR), for XAMI.train_validate_step(image_reader=...)."""
+        return np.ascontiguousarray(self.get_image(self._positions[file_name])[..., ::-1])
+
+    def gt_annotations(self):
+        """
+        Returns:
+            The (masks, bboxes, classes, class_categories) dicts of dataset_utils.get_coords_and_masks_from_json, with
+            the masks as COCO RLEs.
+        """
+        result_masks, bbox_coords, result_class = {}, {}, {}
+        for idx, file_name in enumerate(self.file_names):
+            shard, record = self._record(idx)
+            start = int(record['ann_start'])
+            for annotation in shard['annotations'][start:start + int(record['ann_count'])]:
+                key = f"{file_name}_mask{int(annotation['mask_index'])}"
+                counts_start = int(annotation['rle_offset'])
+                result_masks[key] = {
+                    'size': [int(record['height']), int(record['width'])],
+                    'counts': shard['rles'][counts_start:counts_start + int(annotation['rle_length'])].tobytes()}
+                bbox_coords[key] = annotation['bbox'].tolist()
+                result_class[key] = int(annotation['category_id'])
+        return result_masks, bbox_coords, result_class, dict(self.categories)
+
+    def __getitem__(self, idx):
+        from ..model_predictor import predictor_utils
+        _, record = self._record(idx)
+        return predictor_utils.transform_image(
+            self.model, self.transform, self.get_image(idx), self.file_names[idx], self.device,
+            pixel_stats=(float(record['mean']), float(record['std'])))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pack the train and valid COCO splits into memory-mappable shards.')
+    parser.add_argument('input_dir', help='The COCO dataset directory, with the train/ and valid/ splits.')
+    parser.add_argument('output_dir')
+    parser.add_argument('--splits', nargs='+', default=['train', 'valid'])
+    parser.add_argument('--image-size', type=int, default=None, help='Resize the longest image side to this length.')
+    parser.add_argument('--shard-size-mb', type=float, default=1024)
+    args = parser.parse_args(argv)
+
+    for split in args.splits:
+        index = pack_coco_split(os.path.join(args.input_dir, split), os.path.join(args.output_dir, split),
+                                image_size=args.image_size, shard_size_mb=args.shard_size_mb)
+        num_images = sum(len(shard['file_names']) for shard in index['shards'])
+        print(f"{split}: {num_images} images in {len(index['shards'])} shards")
+
+if __name__ == '__main__':
+    main()
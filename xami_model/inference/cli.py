@@ -0,0 +1,244 @@
+"""
+xami-infer: batch inference over many images, resumable and shardable.
+
+  xami-infer "data/*.png" -o results --format coco --detr-checkpoint rtdetr.pt --sam-checkpoint mobile_sam.pt --shard 0/4
+
+Results are checkpointed to <output_dir>/<name>.jsonl as they are produced, one line per image. An interrupted run
+started again with the same arguments skips the images already in it. Images that cannot be read are checkpointed
+as failed (a line with an "error"), so they are not retried unless --retry-failed is given. When all images of the shard are done,
+the results are also written in the requested format (COCO JSON or Parquet; for rle-jsonl the checkpoint file
+is the result).
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+
+import torch
+
+RESULT_FORMATS = ('coco', 'rle-jsonl', 'parquet')
+
+def parse_shard(shard):
+  """Parse 'i/n' into (i, n), with 0 <= i < n."""
+  try:
+    index, count = (int(part) for part in shard.split('/'))
+  except ValueError:
+    raise argparse.ArgumentTypeError(f"Expected --shard i/n, got {shard}")
+  if not 0 <= index < count:
+    raise argparse.ArgumentTypeError(f"The shard index must be in [0, {count}), got {index}")
+  return index, count
+
+def list_inputs(patterns=(), manifest=None):
+  """
+  Collect the input images from glob patterns and/or a manifest file (one path per line, or a JSON list of paths).
+  Relative manifest entries are relative to the manifest. The result is sorted and without duplicates, so that
+  every node sees the same list.
+  """
+  paths = []
+  for pattern in patterns:
+    matches = glob.glob(pattern, recursive=True)
+    paths.extend(matches if matches else [pattern] if os.path.isfile(pattern) else [])
+  if manifest is not None:
+    with open(manifest) as f:
+      if manifest.endswith('.json'):
+        entries = json.load(f)
+      else:
+        entries = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    base = os.path.dirname(os.path.abspath(manifest))
+    paths.extend(entry if os.path.isabs(entry) else os.path.join(base, entry) for entry in entries)
+  return sorted(set(os.path.normpath(path) for path in paths))
+
+def shard_inputs(paths, index, count):
+  """Round-robin split, so that each shard gets a similar mix of the (sorted) inputs."""
+  return paths[index::count]
+
+def load_done(checkpoint_path, include_failed=True):
+  """
+  Read the images already processed from a checkpoint file. A last line cut by an interruption is removed from
+  the file, so that new results can be appended after it.
+
+  Args:
+    include_failed (bool): Also return the images checkpointed as failed.
+
+  Returns:
+    set: The image paths in the checkpoint.
+  """
+  done, failed = set(), set()
+  if not os.path.exists(checkpoint_path):
+    return done
+  valid_size = 0
+  with open(checkpoint_path, 'rb') as f:
+    for line in f:
+      if not line.endswith(b'\n'):
+        break
+      try:
+        record = json.loads(line)
+        (failed if 'error' in record else done).add(record['path'])
+      except (ValueError, KeyError):
+        break
+      valid_size += len(line)
+  if valid_size < os.path.getsize(checkpoint_path):
+    with open(checkpoint_path, 'r+b') as f:
+      f.truncate(valid_size)
+  return done | failed if include_failed else done
+
+def image_record(path, image_shape, output, class_names):
+  """One checkpoint line: the image and its predicted instances, with COCO RLE masks."""
+  from pycocotools import mask as mask_utils
+  from ..mobile_sam.mobile_sam.utils.amg import masks_to_rles
+  rles = masks_to_rles(output['masks'])
+  annotations = []
+  for rle, cls, score, box in zip(rles, output['classes'].tolist(), output['scores'].tolist(), output['boxes'].tolist()):
+    annotations.append({
+      'segmentation': rle,
+      'category_id': int(cls),
+      'category_name': class_names[int(cls)],
+      'score': float(score),
+      'bbox': [box[0], box[1], box[2] - box[0], box[3] - box[1]], # XYWH as in COCO
+      'area': int(mask_utils.area(dict(rle, counts=rle['counts'].encode()))),
+    })
+  return {'path': path, 'file_name': os.path.basename(path), 'height': int(image_shape[0]), 'width': int(image_shape[1]),
+          'annotations': annotations}
+
+def read_records(checkpoint_path):
+  """The successful image records of a checkpoint file (without the failed images)."""
+  records = []
+  with open(checkpoint_path) as f:
+    for line in f:
+      if line.strip():
+        record = json.loads(line)
+        if 'error' not in record:
+          records.append(record)
+  return records
+
+def write_coco(records, classes, output_path):
+  images, annotations = [], []
+  for image_id, record in enumerate(records):
+    images.append({'id': image_id, 'file_name': record['file_name'], 'path': record['path'],
+                   'height': record['height'], 'width': record['width']})
+    for annotation in record['annotations']:
+      annotations.append(dict(annotation, id=len(annotations), image_id=image_id, iscrowd=0))
+  categories = [{'id': class_id, 'name': name} for class_id, name in sorted(classes.items())]
+
+  tmp_path = output_path + '.tmp'
+  with open(tmp_path, 'w') as f:
+    json.dump({'images': images, 'annotations': annotations, 'categories': categories}, f)
+  os.replace(tmp_path, output_path)
+
+def write_parquet(records, output_path):
+  import pandas as pd
+  rows = []
+  for record in records:
+    for annotation in record['annotations']:
+      rows.append({
+        'path': record['path'], 'height': record['height'], 'width': record['width'],
+        'category_id': annotation['category_id'], 'category_name': annotation['category_name'],
+        'score': annotation['score'], 'x': annotation['bbox'][0], 'y': annotation['bbox'][1],
+        'w': annotation['bbox'][2], 'h': annotation['bbox'][3], 'area': annotation['area'],
+        'rle_counts': annotation['segmentation']['counts']})
+  columns = ['path', 'height', 'width', 'category_id', 'category_name', 'score', 'x', 'y', 'w', 'h', 'area', 'rle_counts']
+  pd.DataFrame(rows, columns=columns).to_parquet(output_path + '.tmp', index=False)
+  os.replace(output_path + '.tmp', output_path)
+
+def run_inference(model, paths, checkpoint_path, batch_size=4, conf=0.2, show_progress=True, retry_failed=False):
+  """
+  Run the model on the paths not yet in the checkpoint, appending one line per image as soon as its batch is done.
+  Unreadable images get a failed line ({"path", "error"}), and are only tried again with retry_failed.
+
+  Returns:
+    int: The number of images processed in this run.
+  """
+  import cv2
+  import tqdm
+  done = load_done(checkpoint_path, include_failed=not retry_failed)
+  todo = [path for path in paths if path not in done]
+  if len(done) > 0:
+    print(f"Resuming: {len(paths) - len(todo)} of {len(paths)} images already done.")
+
+  class_names = {class_id: name for class_id, (name, _) in model.classes.items()}
+  with open(checkpoint_path, 'a') as checkpoint, tqdm.tqdm(total=len(todo), disable=not show_progress) as progress:
+    for start in range(0, len(todo), batch_size):
+      batch_paths = todo[start:start+batch_size]
+      images = [cv2.imread(path) for path in batch_paths]
+      readable = [i for i, image in enumerate(images) if image is not None]
+      for i in sorted(set(range(len(images))) - set(readable)):
+        print(f"Cannot read {batch_paths[i]}, skipped.", file=sys.stderr)
+        checkpoint.write(json.dumps({'path': batch_paths[i], 'error': 'Cannot read the image'}) + '\n')
+
+      outputs = model.run_predict_batch([images[i] for i in readable], yolo_conf=conf) if readable else []
+      for i, output in zip(readable, outputs):
+        record = image_record(batch_paths[i], images[i].shape, output, class_names)
+        checkpoint.write(json.dumps(record) + '\n')
+      # Make the batch durable before moving on, so an interruption loses at most one batch
+      checkpoint.flush()
+      os.fsync(checkpoint.fileno())
+      progress.update(len(batch_paths))
+  return len(todo)
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog='xami-infer', description='XAMI batch inference, resumable and shardable.')
+  parser.add_argument('inputs', nargs='*', help='Input images or glob patterns (quote them to let xami-infer expand them).')
+  parser.add_argument('--manifest', help='File with one image path per line, or a JSON list of paths.')
+  parser.add_argument('-o', '--output-dir', required=True)
+  parser.add_argument('--format', choices=RESULT_FORMATS, default='rle-jsonl', help='The results format.')
+  parser.add_argument('--name', default='predictions', help='Base name of the output files.')
+  parser.add_argument('--shard', type=parse_shard, default=(0, 1), help='Process the i-th of n shards of the inputs, as i/n.')
+  parser.add_argument('--detr-checkpoint', required=True)
+  parser.add_argument('--sam-checkpoint', required=True)
+  parser.add_argument('--model-type', default='vit_t')
+  parser.add_argument('--use-detr-masks', action='store_true')
+  parser.add_argument('--device', default='cuda:0' if torch.cuda.is_available() else 'cpu')
+  parser.add_argument('--batch-size', type=int, default=4)
+  parser.add_argument('--conf', type=float, default=0.2, help='Detector confidence threshold.')
+  parser.add_argument('--embedding-cache-dir', default=None, help='Persist the SAM image embeddings here (see EmbeddingCache).')
+  parser.add_argument('--retry-failed', action='store_true', help='Try again the images checkpointed as unreadable.')
+  parser.add_argument('--quiet', action='store_true')
+  args = parser.parse_args(argv)
+
+  paths = list_inputs(args.inputs, args.manifest)
+  if len(paths) == 0:
+    parser.error('No input images found.')
+  shard_index, shard_count = args.shard
+  paths = shard_inputs(paths, shard_index, shard_count)
+
+  os.makedirs(args.output_dir, exist_ok=True)
+  stem = args.name if shard_count == 1 else f"{args.name}.shard{shard_index:05d}-of-{shard_count:05d}"
+  checkpoint_path = os.path.join(args.output_dir, stem + '.jsonl')
+  final_path = {'coco': checkpoint_path[:-len('.jsonl')] + '.json', 'parquet': checkpoint_path[:-len('.jsonl')] + '.parquet',
+                'rle-jsonl': checkpoint_path}[args.format]
+
+  todo = len(paths) - len(load_done(checkpoint_path, include_failed=not args.retry_failed) & set(paths))
+  if todo == 0 and os.path.exists(final_path):
+    print(f"All {len(paths)} images of the shard are done: {final_path}")
+    return 0
+
+  model = None
+  if todo > 0:
+    from .xami_inference import InferXami
+    model = InferXami(
+      args.device,
+      args.detr_checkpoint,
+      args.sam_checkpoint,
+      model_type=args.model_type,
+      use_detr_masks=args.use_detr_masks,
+      warmup_batch_sizes=(args.batch_size,),
+      embedding_cache_size=0 if args.embedding_cache_dir is None else args.batch_size,
+      embedding_cache_dir=args.embedding_cache_dir)
+    run_inference(model, paths, checkpoint_path, batch_size=args.batch_size, conf=args.conf, show_progress=not args.quiet,
+                  retry_failed=args.retry_failed)
+
+  if args.format != 'rle-jsonl':
+    wanted = set(paths)
+    records = [record for record in read_records(checkpoint_path) if record['path'] in wanted]
+    if args.format == 'coco':
+      from .xami_inference import CLASSES
+      classes = {class_id: name for class_id, (name, _) in (model.classes if model is not None else CLASSES).items()}
+      write_coco(records, classes, final_path)
+    else:
+      write_parquet(records, final_path)
+  print(f"Results of {len(paths)} images written to {final_path}")
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
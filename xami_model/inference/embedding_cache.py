@@ -0,0 +1,106 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+def checkpoint_fingerprint(checkpoint_path):
+  """
+  Identify a checkpoint file by its absolute path, size and modification time, which is much cheaper than hashing
+  its content for every image and changes whenever the file is overwritten.
+  """
+  if checkpoint_path is None:
+    return 'none'
+  stat = os.stat(checkpoint_path)
+  return f"{os.path.abspath(checkpoint_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+class EmbeddingCache:
+  """
+  Content-addressed cache of SAM image embeddings: an in-memory LRU, optionally backed by an on-disk store of
+  .npy files that are memory-mapped when read back.
+
+  The key covers the image bytes, the SAM checkpoint and the preprocessing parameters, so re-running the
+  detector with another confidence, checkpoint or prompts on the same image only runs the mask decoder.
+  """
+  def __init__(self, max_items=32, cache_dir=None):
+    """
+    Args:
+      max_items (int): Maximum number of embeddings kept in memory. 0 keeps none (disk store only).
+      cache_dir (str, optional): Directory of the on-disk store. None disables it.
+    """
+    self.max_items = max_items
+    self.cache_dir = cache_dir
+    self._embeddings = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    if cache_dir is not None:
+      os.makedirs(cache_dir, exist_ok=True)
+
+  @staticmethod
+  def make_key(image, checkpoint_path, **preprocess_params):
+    """
+    Args:
+      image (np.ndarray): The image as given to the preprocessing (e.g. uint8 BGR from cv2.imread).
+      checkpoint_path (str): The SAM checkpoint.
+      **preprocess_params: Anything else that changes the embedding (image size, model type, encoder options...).
+
+    Returns:
+      str: The hex digest used as key.
+    """
+    image = np.ascontiguousarray(image)
+    h = hashlib.sha1()
+    h.update(f"{image.shape}|{image.dtype.str}|".encode())
+    h.update(memoryview(image).cast('B'))
+    h.update(checkpoint_fingerprint(checkpoint_path).encode())
+    h.update(repr(sorted(preprocess_params.items())).encode())
+    return h.hexdigest()
+
+  def _path(self, key):
+    return os.path.join(self.cache_dir, f"{key}.npy")
+
+  def _remember(self, key, embedding):
+    if self.max_items <= 0:
+      return
+    self._embeddings[key] = embedding
+    self._embeddings.move_to_end(key)
+    while len(self._embeddings) > self.max_items:
+      self._embeddings.popitem(last=False)
+
+  def get(self, key, device=None):
+    """
+    Returns:
+      torch.Tensor or None: The cached [1, 256, 64, 64] embedding on `device`, or None on a miss.
+    """
+    embedding = self._embeddings.get(key)
+    if embedding is not None:
+      self._embeddings.move_to_end(key)
+    elif self.cache_dir is not None and os.path.exists(self._path(key)):
+      stored = np.load(self._path(key), mmap_mode='r')
+      embedding = torch.from_numpy(np.array(stored))
+      self._remember(key, embedding)
+
+    if embedding is None:
+      self.misses += 1
+      return None
+    self.hits += 1
+    return embedding.to(device) if device is not None else embedding
+
+  def put(self, key, embedding):
+    # A copy, so that an embedding sliced from a batch doesn't keep the whole batch alive in the cache
+    embedding = embedding.detach().clone()
+    self._remember(key, embedding)
+    if self.cache_dir is not None and not os.path.exists(self._path(key)):
+      # Write to a temporary file first so that concurrent readers never see a partial array
+      tmp_path = f"{self._path(key)}.{os.getpid()}.tmp"
+      stored = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=tuple(embedding.shape))
+      stored[...] = embedding.float().cpu().numpy()
+      stored.flush()
+      del stored
+      os.replace(tmp_path, self._path(key))
+
+  def clear(self):
+    self._embeddings.clear()
+
+  def __len__(self):
+    return len(self._embeddings)
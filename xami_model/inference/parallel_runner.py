@@ -0,0 +1,197 @@
+import os
+import queue
+import time
+
+import torch
+import torch.multiprocessing as mp
+
+def _inference_worker(worker_id, device, num_threads, model_kwargs, batch_size, conf, task_queue, result_queue):
+  """
+  Worker process: holds its own detector and SAM on `device`, pulls image paths from the shared task queue
+  (up to batch_size at a time) and sends back one result message per image.
+  """
+  import cv2
+  if num_threads is not None:
+    torch.set_num_threads(num_threads)
+    cv2.setNumThreads(num_threads)
+  if device.startswith('cuda'):
+    torch.cuda.set_device(device)
+
+  from .xami_inference import InferXami
+  try:
+    model = InferXami(device, **model_kwargs)
+  except Exception as e:
+    result_queue.put(('failed', worker_id, repr(e)))
+    return
+  result_queue.put(('ready', worker_id, None))
+
+  finished = False
+  while not finished:
+    # Block for the first task, then take whatever else is already queued to fill the batch
+    tasks = [task_queue.get()]
+    while len(tasks) < batch_size and tasks[-1] is not None:
+      try:
+        tasks.append(task_queue.get_nowait())
+      except queue.Empty:
+        break
+    if tasks[-1] is None:
+      tasks.pop()
+      finished = True
+    if len(tasks) == 0:
+      break
+
+    start = time.time()
+    images = [cv2.imread(path) for _, path in tasks]
+    readable = [i for i, image in enumerate(images) if image is not None]
+    outputs, error = [None] * len(tasks), None
+    try:
+      for i, output in zip(readable, model.run_predict_batch([images[i] for i in readable], yolo_conf=conf) if readable else []):
+        outputs[i] = output
+    except Exception as e:
+      error = repr(e)
+    elapsed = time.time() - start
+
+    for i, (index, path) in enumerate(tasks):
+      if error is None and outputs[i] is None:
+        task_error = f"Cannot read {path}"
+      else:
+        task_error = error
+      result_queue.put(('result', worker_id, (index, path, outputs[i], task_error, elapsed / len(tasks))))
+
+  result_queue.put(('done', worker_id, None))
+
+class ParallelInferenceRunner:
+  """
+  Data-parallel InferXami inference: one worker process per GPU (or N CPU workers with a fixed number of threads
+  each), each holding its own detector and SAM instance. The image paths are distributed from a shared queue, so
+  fast workers take more images (dense and sparse fields don't need to be balanced by hand), and the results are
+  returned in the input order.
+
+  Example:
+    runner = ParallelInferenceRunner(
+      dict(detr_checkpoint=detr_checkpoint, sam_checkpoint=sam_checkpoint, model_type='vit_t'),
+      devices=['cuda:0', 'cuda:1'])
+    for path, output in runner.run(image_paths):
+      ...
+    print(runner.worker_stats)
+  """
+  def __init__(self, model_kwargs, devices=None, num_cpu_workers=None, threads_per_worker=None, batch_size=1, conf=0.2,
+               max_pending=None):
+    """
+    Args:
+      model_kwargs (dict): InferXami arguments besides the device (detr_checkpoint, sam_checkpoint, ...).
+      devices (list, optional): The devices of the workers, e.g. ['cuda:0', 'cuda:1']. A device can be listed more
+        than once to run several workers on it. Defaults to all the visible GPUs, or to num_cpu_workers CPU workers.
+      num_cpu_workers (int, optional): Number of CPU workers when devices is not given and there is no GPU. Default 1.
+      threads_per_worker (int, optional): Intra-op threads per CPU worker. Defaults to the CPU count divided by the
+        number of CPU workers, so that the workers don't oversubscribe the cores.
+      batch_size (int): Maximum number of images per run_predict_batch call in a worker.
+      conf (float): Detector confidence threshold.
+      max_pending (int, optional): Maximum number of results waiting to be put back in order, which bounds the memory
+        used when one image is much slower than the following ones. Defaults to 8 batches per worker.
+    """
+    if devices is None:
+      if torch.cuda.is_available():
+        devices = [f'cuda:{i}' for i in range(torch.cuda.device_count())]
+      else:
+        devices = ['cpu'] * (num_cpu_workers or 1)
+    self.devices = list(devices)
+    num_cpu = sum(1 for device in self.devices if device == 'cpu')
+    if threads_per_worker is None and num_cpu > 0:
+      threads_per_worker = max(1, (os.cpu_count() or 1) // num_cpu)
+    self.threads_per_worker = threads_per_worker
+    self.model_kwargs = dict(model_kwargs)
+    self.model_kwargs.setdefault('warmup_batch_sizes', (batch_size,))
+    self.batch_size = batch_size
+    self.conf = conf
+    self.max_pending = max_pending if max_pending is not None else 8 * batch_size * len(self.devices)
+    self.worker_stats = {}
+    self.errors = []
+
+  def _new_stats(self, worker_id):
+    return {'device': self.devices[worker_id], 'images': 0, 'errors': 0, 'busy_seconds': 0.0, 'ready': False}
+
+  def run(self, paths):
+    """
+    Run the model on all paths.
+
+    Yields:
+      (path, output): In the order of paths. output is the run_predict_batch dict of the image, or None if the image
+        could not be read or processed (the error is then in self.errors).
+    """
+    paths = list(paths)
+    context = mp.get_context('spawn')
+    task_queue, result_queue = context.Queue(), context.Queue()
+    self.worker_stats = {worker_id: self._new_stats(worker_id) for worker_id in range(len(self.devices))}
+    self.errors = []
+
+    workers = []
+    for worker_id, device in enumerate(self.devices):
+      num_threads = self.threads_per_worker if device == 'cpu' else None
+      worker = context.Process(
+        target=_inference_worker,
+        args=(worker_id, device, num_threads, self.model_kwargs, self.batch_size, self.conf, task_queue, result_queue),
+        daemon=True)
+      worker.start()
+      workers.append(worker)
+
+    # Tasks are fed lazily so that the reorder buffer stays bounded
+    next_task, next_output, pending = 0, 0, {}
+    def feed():
+      nonlocal next_task
+      while next_task < len(paths) and next_task - next_output < self.max_pending:
+        task_queue.put((next_task, paths[next_task]))
+        next_task += 1
+    feed()
+    sentinels_sent = False
+
+    try:
+      while next_output < len(paths):
+        if next_task == len(paths) and not sentinels_sent:
+          for _ in workers:
+            task_queue.put(None)
+          sentinels_sent = True
+        try:
+          kind, worker_id, payload = result_queue.get(timeout=1.0)
+        except queue.Empty:
+          dead = [i for i, worker in enumerate(workers) if not worker.is_alive() and worker.exitcode not in (0, None)]
+          if dead:
+            raise RuntimeError(f"Inference workers {dead} ({[self.devices[i] for i in dead]}) exited unexpectedly.")
+          continue
+
+        stats = self.worker_stats[worker_id]
+        if kind == 'ready':
+          stats['ready'] = True
+        elif kind == 'failed':
+          raise RuntimeError(f"Inference worker {worker_id} ({self.devices[worker_id]}) failed to load the models: {payload}")
+        elif kind == 'result':
+          index, path, output, error, elapsed = payload
+          stats['images'] += 1
+          stats['busy_seconds'] += elapsed
+          if error is not None:
+            stats['errors'] += 1
+            self.errors.append((path, error))
+          pending[index] = (path, output)
+
+        # Reorder buffer: release the results that are next in the input order
+        while next_output in pending:
+          yield pending.pop(next_output)
+          next_output += 1
+        feed()
+    finally:
+      if not sentinels_sent:
+        for _ in workers:
+          task_queue.put(None)
+      for worker in workers:
+        worker.join(timeout=10)
+        if worker.is_alive():
+          worker.terminate()
+
+  def summary(self):
+    """Per-worker throughput, as a printable string."""
+    lines = []
+    for worker_id, stats in sorted(self.worker_stats.items()):
+      rate = stats['images'] / stats['busy_seconds'] if stats['busy_seconds'] > 0 else 0.0
+      lines.append(f"worker {worker_id} ({stats['device']}): {stats['images']} images, {stats['errors']} errors, "
+                   f"{stats['busy_seconds']:.1f} s busy, {rate:.2f} images/s")
+    return '\n'.join(lines)
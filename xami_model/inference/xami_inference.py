@@ -2,28 +2,90 @@ import sys
 import torch
 import cv2
 import numpy as np
-import matplotlib.pyplot as plt
 import time
-from ultralytics import YOLO, RTDETR
-from segment_anything.utils.transforms import ResizeLongestSide
+from ..mobile_sam.mobile_sam.utils.transforms import ResizeLongestSide
 import tqdm
 import os
-from ..dataset import dataset_utils
 from ..model_predictor import predictor_utils
+from .embedding_cache import EmbeddingCache
 from ..mobile_sam.mobile_sam import sam_model_registry, SamPredictor 
 
+# Class id -> (name, RGB colour used in the plots)
+CLASSES = {0:('central-ring', (1,252,214)), 
+           1:('other', (255,128,1)),
+           2:('read-out-streak', (20, 77, 158)), 
+           3:('smoke-ring', (159,21,100)),
+           4:('star-loop', (255, 188, 248))}
+
+WARMUP_IMAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'warmup_image.png')
+
+def set_compile_cache_dir(cache_dir):
+  """
+  Persist the torch.compile (Inductor) and Triton caches in `cache_dir`, so that other processes 
+  compiling the same models at the same shapes reuse the artifacts instead of recompiling. 
+  Must be called before the first compilation in the process.
+  """
+  os.makedirs(cache_dir, exist_ok=True)
+  os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.join(cache_dir, 'inductor'))
+  os.environ.setdefault('TRITON_CACHE_DIR', os.path.join(cache_dir, 'triton'))
+  os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+  os.environ.setdefault('TORCHINDUCTOR_AUTOGRAD_CACHE', '1')
+
 class InferXami:
-  def __init__(self, device, detr_checkpoint, sam_checkpoint, model_type='vit_t', use_detr_masks=False):
+  def __init__(
+    self, 
+    device, 
+    detr_checkpoint, 
+    sam_checkpoint, 
+    model_type='vit_t', 
+    use_detr_masks=False, 
+    warmup_batch_sizes=(1,), 
+    warmup_prompt_counts=(1,), 
+    warmup_runs=3,
+    compile_mode=None, 
+    compile_cache_dir=None,
+    prepare_encoder=False,
+    quantize=None,
+    calibration_image_paths=None,
+    embedding_cache_size=0,
+    embedding_cache_dir=None):
+    """
+    Args:
+      device: The device of the models.
+      detr_checkpoint (str): The detector (RT-DETR, or YOLO with use_detr_masks) checkpoint.
+      sam_checkpoint (str): The MobileSAM checkpoint.
+      model_type (str): The SAM model type.
+      use_detr_masks (bool): Whether to use the YOLO masks for faint sources.
+      warmup_batch_sizes (tuple): Image batch sizes the models are warmed up (and compiled) for.
+      warmup_prompt_counts (tuple): Numbers of box prompts per image the mask decoder is warmed up (and compiled) for.
+      warmup_runs (int): Number of warmup runs per shape. 0 disables the warmup.
+      compile_mode (str, optional): If given, the SAM image encoder and mask decoder are compiled with torch.compile 
+        in this mode ('default', 'reduce-overhead' to also capture CUDA graphs for the warmed up shapes, 'max-autotune').
+      compile_cache_dir (str, optional): Where to persist the compile caches across processes (see set_compile_cache_dir).
+      prepare_encoder (bool): Convert the SAM image encoder to its inference-only form (fused Conv2d+BN, 
+        frozen attention biases and scaled_dot_product_attention, see Sam.prepare_for_inference).
+      quantize (str, optional): 'dynamic' or 'static' int8 quantization of the SAM linear layers, for CPU inference 
+        only (see mobile_sam.utils.quantization).
+      calibration_image_paths (list, optional): Sample images used to calibrate the static quantization and to report 
+        the mask IoU drift of the quantized model against the fp32 one.
+      embedding_cache_size (int): Number of SAM image embeddings kept in memory, keyed by the image content, the 
+        SAM checkpoint and the preprocessing. Re-runs on the same images then only run the mask decoder. 0 disables it.
+      embedding_cache_dir (str, optional): Also store the embeddings on disk in this directory, to share them 
+        across runs and processes.
+    """
+    if quantize is not None and torch.device(device).type != 'cpu':
+      raise ValueError(f"The quantized SAM model only runs on CPU, got device {device}.")
+
+    from ultralytics import YOLO, RTDETR
     print("Initializing the model...")
+    
+    if compile_cache_dir is not None:
+      set_compile_cache_dir(compile_cache_dir)
 
     self.device = device
     self.detr_checkpoint = detr_checkpoint
     self.sam_checkpoint = sam_checkpoint
-    self.classes = {0:('central-ring', (1,252,214)), 
-                    1:('other', (255,128,1)),
-                    2:('read-out-streak', (20, 77, 158)), 
-                    3:('smoke-ring', (159,21,100)),
-                    4:('star-loop', (255, 188, 248))}
+    self.classes = dict(CLASSES)
 
     self.use_detr_masks = use_detr_masks # whether to use YOLO masks for faint sources
 
@@ -34,51 +96,130 @@ class InferXami:
       
     self.detector.to(self.device)
     # Step 2: Instance segmentation with SAM on detected objects
-    self.mobile_sam_model, self.model_predictor = self.load_sam_model(model_type)
+    self.mobile_sam_model, self.model_predictor = self.load_sam_model(model_type, quantize, calibration_image_paths)
     self.transform = ResizeLongestSide(self.mobile_sam_model.image_encoder.img_size)
     
-    # Warmup is beneficial for completing system-level optimizations
-    self.model_warmup()
+    if prepare_encoder:
+      self.mobile_sam_model.prepare_for_inference()
+    if compile_mode is not None:
+      self.mobile_sam_model.image_encoder.compile(mode=compile_mode, dynamic=False)
+      self.mobile_sam_model.mask_decoder.compile(mode=compile_mode, dynamic=False)
+    
+    self.embedding_cache = None
+    if embedding_cache_size > 0 or embedding_cache_dir is not None:
+      self.embedding_cache = EmbeddingCache(embedding_cache_size, embedding_cache_dir)
+    # Everything besides the image and the checkpoint that changes the embeddings
+    self._embedding_key_params = {
+      'model_type': model_type, 
+      'img_size': self.mobile_sam_model.image_encoder.img_size, 
+      'prepare_encoder': prepare_encoder, 
+      'quantize': quantize}
+    
+    # Warmup is beneficial for completing system-level optimizations (and compiling/capturing the models at these shapes)
+    self.model_warmup(warmup_runs, batch_sizes=warmup_batch_sizes, prompt_counts=warmup_prompt_counts)
 
-  def load_sam_model(self, model_type="vit_t"):
+  def load_sam_model(self, model_type="vit_t", quantize=None, calibration_image_paths=None):
     
     mobile_sam_model = sam_model_registry[model_type](checkpoint=self.sam_checkpoint)
+    if quantize is not None:
+      from ..mobile_sam.mobile_sam.utils.quantization import quantize_sam
+      # BGR as read by cv2.imread, and normalized per image like in get_image_embedding: 
+      # the calibration and the drift report see the encoder inputs of the inference
+      calibration_images = [cv2.imread(path) for path in calibration_image_paths or []]
+      transform = ResizeLongestSide(mobile_sam_model.image_encoder.img_size)
+      mobile_sam_model = quantize_sam(
+        mobile_sam_model, mode=quantize, calibration_images=calibration_images, inplace=not calibration_images, 
+        preprocess=lambda sam, image: predictor_utils.set_mean_and_transform(image, sam, transform, 'cpu'))
+    self.quantization_report = getattr(mobile_sam_model, 'quantization_report', None)
     mobile_sam_model.to(self.device);
     mobile_sam_model.eval();
     predictor = SamPredictor(mobile_sam_model)
     
     return mobile_sam_model, predictor
   
-  def model_warmup(self, number_of_runs=3):
+  @torch.no_grad()
+  def model_warmup(self, number_of_runs=3, batch_sizes=(1,), prompt_counts=(1,)):
     """
-    Warm up the YOLO and SAM models by running them with random input multiple times.
+    Warm up the YOLO and SAM models by running them multiple times at the shapes used for inference.
 
     Args:
-      number_of_runs (int): The number of times to run the models with random input. Default is 3.
+      number_of_runs (int): The number of times to run the models per shape. Default is 3.
+      batch_sizes (tuple): The image batch sizes to warm up.
+      prompt_counts (tuple): The numbers of box prompts per image to warm up the mask decoder with.
 
     Returns:
       None
     """
+    if number_of_runs == 0:
+      return
+    warmup_image = cv2.imread(WARMUP_IMAGE_PATH)
+    
     # Warm up YOLO model
-    for _ in tqdm.tqdm(range(number_of_runs), desc="Warming up YOLO model", bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}'):
-      _ = self.detector.predict('./xami_model/inference/warmup_image.png', verbose=False, conf=0.2) 
+    for batch_size in batch_sizes:
+      for _ in tqdm.tqdm(range(number_of_runs), desc=f"Warming up YOLO model (batch size {batch_size})", bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}'):
+        _ = self.detector.predict([warmup_image] * batch_size, verbose=False, conf=0.2) 
 
     # Warm up SAM model
-    for _ in tqdm.tqdm(range(number_of_runs), desc="Warming up SAM model", bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}'):
-      _ = self.run_sam_model(
-        torch.randn(1, 3, 1024, 1024).to(self.device),
-        torch.tensor([[0, 0, 512, 512]]).to(self.device)
-      )
+    for batch_size in batch_sizes:
+      for _ in tqdm.tqdm(range(number_of_runs), desc=f"Warming up SAM model (batch size {batch_size})", bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}'):
+        image_embeddings = self.mobile_sam_model.image_encoder(torch.randn(batch_size, 3, 1024, 1024).to(self.device))
+        for prompt_count in prompt_counts:
+          _ = self.decode_sam_masks(
+            image_embeddings[:1],
+            torch.tensor([[0, 0, 512, 512]], dtype=torch.float64).repeat(prompt_count, 1).to(self.device) # same dtype as the transformed boxes
+          )
       
   @torch.no_grad()
   def run_predict(self, image_path, yolo_conf=0.2, show_masks=False):
 
-    start_time_all = time.time()
     image = cv2.imread(image_path)
-    obj_results = self.detector.predict(image_path, verbose=False, conf=yolo_conf) 
+    return self.run_predict_array(image, yolo_conf=yolo_conf, show_masks=show_masks, image_name=image_path)
 
-    # set a specific mean for each image
-    input_image = predictor_utils.set_mean_and_transform(image, self.mobile_sam_model, self.transform, self.device)
+  @torch.no_grad()
+  def run_predict_fits(self, fits_path, yolo_conf=0.2, with_image_stretch=False, show_masks=False):
+    """
+    Run the detector and SAM directly on a FITS file, without writing and decoding a PNG.
+
+    The primary HDU is memory-mapped and converted in memory exactly as astronomy_utils.zscale_image 
+    does (zscale normalization and optional log stretch), so the models see the same 8-bit image.
+
+    Args:
+      fits_path (str): Path to the FITS file.
+      yolo_conf (float): Detector confidence threshold.
+      with_image_stretch (bool): Whether to apply the log stretch after zscale normalization.
+      show_masks (bool): Whether to plot and save the predicted masks.
+
+    Returns:
+      The same outputs as run_predict.
+    """
+    from ..dataset import astronomy_utils
+    from astropy.io import fits
+    
+    with fits.open(fits_path, memmap=True) as hdul:
+      image_data = hdul[0].data.astype(np.float32, copy=False)
+      vmin, vmax = astronomy_utils.zscale_limits(image_data)
+      image = astronomy_utils.zscale_to_uint8(image_data, vmin, vmax, with_image_stretch)
+
+    image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR) # as cv2.imread loads the PNG
+    image_name = os.path.basename(fits_path).replace('.fits', '.png')
+    return self.run_predict_array(image, yolo_conf=yolo_conf, show_masks=show_masks, image_name=image_name)
+
+  @torch.no_grad()
+  def run_predict_array(self, image, yolo_conf=0.2, show_masks=False, image_name='image.png'):
+    """
+    Run the detector and SAM on an in-memory image.
+
+    Args:
+      image (np.ndarray): uint8 BGR image of shape (H, W, 3), as returned by cv2.imread.
+      yolo_conf (float): Detector confidence threshold.
+      show_masks (bool): Whether to plot and save the predicted masks.
+      image_name (str): Name used for the saved plot.
+
+    Returns:
+      The same outputs as run_predict.
+    """
+    start_time_all = time.time()
+    obj_results = self.detector.predict(image, verbose=False, conf=yolo_conf) 
              
     if len(obj_results[0]) == 0: # type: ignore
       print("No objects detected. Check model configuration or input image.")
@@ -96,7 +237,7 @@ class InferXami:
       for i in range(len(non_resized_masks)):
         yolo_masks.append(cv2.resize(non_resized_masks[i], image.shape[:2][::-1], interpolation=cv2.INTER_LINEAR)) 
     
-    low_res_masks, iou_predictions = self.run_sam_model(input_image, input_boxes)
+    low_res_masks, iou_predictions = self.decode_sam_masks(self.get_image_embedding(image), input_boxes)
 
     print('Number of object detected:', len(iou_predictions))
     for predicted_class in predicted_classes.unique():
@@ -132,6 +273,8 @@ class InferXami:
       return None
 
     if show_masks:
+      import matplotlib.pyplot as plt
+      from ..dataset import dataset_utils
       fig, axes = plt.subplots(1, 3, figsize=(20, 8)) 
       image_copy = image.copy()
 
@@ -155,7 +298,7 @@ class InferXami:
       dataset_utils.show_masks(sam_masks_numpy, axes[2], random_color=False, colours=colours)
       axes[2].set_title('Yolo-SAM predicted masks')
       plt.tight_layout() 
-      plt.savefig(f'./{image_path.split("/")[-1].replace(".png", "_predicted.png")}')
+      plt.savefig(f'./{image_name.split("/")[-1].replace(".png", "_predicted.png")}')
       plt.show()
       
     return sam_mask_pre, obj_results, inference_time, 0 # obj_results for further inference 
@@ -167,7 +310,132 @@ class InferXami:
     ):
     
     image_embedding = self.mobile_sam_model.image_encoder(input_image) # [1, 256, 64, 64]
-           
+    
+    return self.decode_sam_masks(image_embedding, input_boxes)
+
+  def embedding_key(self, image):
+    return EmbeddingCache.make_key(image, self.sam_checkpoint, **self._embedding_key_params)
+
+  def get_image_embedding(self, image):
+    """
+    Preprocess an image and run the SAM image encoder on it, or take its embedding from the embedding cache.
+
+    Args:
+      image (np.ndarray): uint8 BGR image of shape (H, W, 3).
+
+    Returns:
+      torch.Tensor: The image embedding of shape [1, 256, 64, 64].
+    """
+    key = None
+    if self.embedding_cache is not None:
+      key = self.embedding_key(image)
+      image_embedding = self.embedding_cache.get(key, self.device)
+      if image_embedding is not None:
+        return image_embedding
+    
+    # set a specific mean for each image
+    input_image = predictor_utils.set_mean_and_transform(image, self.mobile_sam_model, self.transform, self.device)
+    image_embedding = self.mobile_sam_model.image_encoder(input_image) # [1, 256, 64, 64]
+    if key is not None:
+      self.embedding_cache.put(key, image_embedding)
+    return image_embedding
+
+  def get_image_embeddings(self, images):
+    """
+    Batched get_image_embedding: the images that are not in the embedding cache are encoded in a single batch.
+
+    Args:
+      images (list): uint8 BGR images of shape (H, W, 3).
+
+    Returns:
+      list: The image embeddings of shape [1, 256, 64, 64], in the order of images.
+    """
+    image_embeddings, keys = [None] * len(images), [None] * len(images)
+    if self.embedding_cache is not None:
+      for i, image in enumerate(images):
+        keys[i] = self.embedding_key(image)
+        image_embeddings[i] = self.embedding_cache.get(keys[i], self.device)
+    to_encode = [i for i in range(len(images)) if image_embeddings[i] is None]
+    if len(to_encode) > 0:
+      input_images = torch.cat([
+        predictor_utils.set_mean_and_transform(images[i], self.mobile_sam_model, self.transform, self.device) for i in to_encode])
+      encoded = self.mobile_sam_model.image_encoder(input_images) # [B, 256, 64, 64]
+      for image_embedding, i in zip(encoded, to_encode):
+        image_embeddings[i] = image_embedding.unsqueeze(0)
+        if keys[i] is not None:
+          self.embedding_cache.put(keys[i], image_embeddings[i])
+    
+    return image_embeddings
+
+  @torch.no_grad()
+  def run_predict_batch(self, images, yolo_conf=0.2):
+    """
+    Run the detector and SAM on a batch of in-memory images, with a single detector call and a single image 
+    encoder call for the whole batch.
+
+    Args:
+      images (list): uint8 BGR images of shape (H, W, 3), as returned by cv2.imread.
+      yolo_conf (float): Detector confidence threshold.
+
+    Returns:
+      list: One dict per image with the binary 'masks' (np.ndarray [N, H, W] bool), the 'classes' (np.ndarray [N] int), 
+        the detector 'scores' (np.ndarray [N]) and the 'boxes' (np.ndarray [N, 4], XYXY). N is 0 if nothing was detected.
+    """
+    obj_results = self.detector.predict(list(images), verbose=False, conf=yolo_conf) 
+    
+    outputs = [{
+      'masks': np.zeros((0,) + image.shape[:2], dtype=bool), 
+      'classes': np.zeros(0, dtype=np.int64), 
+      'scores': np.zeros(0, dtype=np.float32), 
+      'boxes': np.zeros((0, 4), dtype=np.float32)} for image in images]
+    detected = [i for i in range(len(images)) if len(obj_results[i]) > 0]
+    if len(detected) == 0:
+      return outputs
+    
+    image_embeddings = self.get_image_embeddings([images[i] for i in detected])
+    for image_embedding, i in zip(image_embeddings, detected):
+      image, obj_result = images[i], obj_results[i]
+      boxes_numpy = obj_result.boxes.xyxy.cpu().numpy()
+      input_boxes = self.model_predictor.transform.apply_boxes(boxes_numpy, image.shape[:-1])
+      input_boxes = torch.from_numpy(input_boxes).to(self.device)
+      low_res_masks, _ = self.decode_sam_masks(image_embedding, input_boxes)
+      
+      if self.use_detr_masks:
+        non_resized_masks = obj_result.masks.data.cpu().numpy()
+        yolo_masks = [cv2.resize(mask, image.shape[:2][::-1], interpolation=cv2.INTER_LINEAR) for mask in non_resized_masks]
+        low_res_masks = self.model_predictor.model.postprocess_masks(low_res_masks, (1024, 1024), image.shape[:-1]).to(self.device)
+        low_res_masks = predictor_utils.process_faint_masks(
+          image, 
+          low_res_masks, 
+          yolo_masks, 
+          obj_result.boxes.cls, 
+          self.device,
+          wt_threshold=0.6, 
+          wt_classes=[1.0, 2.0, 4.0])
+        masks = self.threshold_sam_masks(low_res_masks, None)
+      else:
+        masks = self.threshold_sam_masks(low_res_masks, image.shape[:-1])
+      
+      outputs[i] = {
+        'masks': masks.squeeze(1).bool().cpu().numpy(), 
+        'classes': obj_result.boxes.cls.cpu().numpy().astype(np.int64), 
+        'scores': obj_result.boxes.conf.cpu().numpy(), 
+        'boxes': boxes_numpy}
+    
+    return outputs
+  
+  def decode_sam_masks(self, image_embedding, input_boxes):
+    """
+    Decode the masks of the box prompts of one image from its image embedding, keeping the mask with the highest predicted IoU per box.
+
+    Args:
+      image_embedding (torch.Tensor): Image embedding of shape [1, 256, 64, 64].
+      input_boxes (torch.Tensor): Boxes of shape [N, 4], already transformed to the SAM input frame.
+
+    Returns:
+      low_res_masks (torch.Tensor): [N, 1, 256, 256] mask logits.
+      iou_predictions (torch.Tensor): [N, 1] predicted IoUs.
+    """
     sparse_embeddings, dense_embeddings = self.mobile_sam_model.prompt_encoder(
         points=None,
         boxes=input_boxes,
@@ -195,15 +463,89 @@ class InferXami:
     
     return low_res_masks, iou_predictions
   
+  def threshold_sam_masks(self, low_res_masks, image_shape):
+    """
+    Upscale the SAM logits to the image size, smooth them with a Gaussian filter and threshold them to binary masks.
+    With image_shape None, the logits are taken to be at the image size already.
+    """
+    if image_shape is not None:
+      low_res_masks=self.model_predictor.model.postprocess_masks(low_res_masks, (1024, 1024), image_shape).to(self.device)
+    
+    # Apply Gaussian filter on logits
+    kernel_size, sigma = 5, 2
+    gaussian_kernel = predictor_utils.create_gaussian_kernel(kernel_size, sigma).to(self.device)
+    pred_masks = torch.nn.functional.conv2d(low_res_masks, gaussian_kernel, padding=kernel_size//2)
+    threshold_masks = torch.sigmoid(10 * (pred_masks - self.mobile_sam_model.mask_threshold)) # sigmoid with steepness
+    
+    return (threshold_masks > 0.5)*1.0
+  
+  @torch.no_grad()
+  def run_source_extractor_batch(
+    self, 
+    image_paths, 
+    detection_data=None, 
+    batch_size=4, 
+    cache_dir=None, 
+    cache_format='parquet', 
+    **detection_params):
+    """
+    Source extractor -> XAMI pipeline over many images: detect the sources, prompt SAM with their boxes 
+    and decode the masks, encoding the images in batches.
+
+    Args:
+      image_paths (list): Paths of the images (as read by cv2.imread).
+      detection_data (list, optional): 2D arrays on which the sources are detected, in the frame of the images 
+        (e.g. the flipped FITS data). Default: the grayscale images.
+      batch_size (int): Number of images per image encoder batch.
+      cache_dir (str, optional): If given, the source catalogs are cached there (see astronomy_utils.source_catalog_cached), 
+        so re-running with another SAM checkpoint does not re-run the source extraction.
+      cache_format (str): 'parquet' or 'feather'.
+      **detection_params: Parameters of the source detection (hw_threshold, clip_sigma, kernel_sigma, npixels, tile_size, num_workers).
+
+    Returns:
+      list: One (sam_mask_pre, boxes_numpy) pair per image; sam_mask_pre is None if no source was found.
+    """
+    from ..dataset import astronomy_utils
+    images = [cv2.imread(image_path) for image_path in image_paths]
+    if detection_data is None:
+      detection_data = [cv2.cvtColor(image, cv2.COLOR_BGR2GRAY).astype(np.float64) for image in images]
+    
+    all_boxes = []
+    for data_2D in detection_data:
+      if cache_dir is not None:
+        sources = astronomy_utils.source_catalog_cached(data_2D, cache_dir, file_format=cache_format, **detection_params)
+      else:
+        tile_size = detection_params.get('tile_size')
+        params = {k: v for k, v in detection_params.items() if k not in ('tile_size', 'num_workers')}
+        if tile_size is not None and max(data_2D.shape) > tile_size:
+          _, _, sources = astronomy_utils.detect_and_deblend_sources_tiled(data_2D, tile_size=tile_size, num_workers=detection_params.get('num_workers'), **params)
+        else:
+          _, _, sources = astronomy_utils.detect_and_deblend_sources(data_2D, verbose=False, catalog_only=True, **params)
+      all_boxes.append(astronomy_utils.sources_to_boxes(sources))
+    
+    results = [(None, boxes_numpy) for boxes_numpy in all_boxes]
+    to_segment = [i for i in range(len(images)) if len(all_boxes[i]) > 0]
+    
+    for start in range(0, len(to_segment), batch_size):
+      batch_indices = to_segment[start:start+batch_size]
+      
+      image_embeddings = dict(zip(batch_indices, self.get_image_embeddings([images[i] for i in batch_indices])))
+      
+      for i in batch_indices:
+        input_boxes = self.model_predictor.transform.apply_boxes(all_boxes[i], images[i].shape[:-1])
+        input_boxes = torch.from_numpy(input_boxes).to(self.device)
+        low_res_masks, _ = self.decode_sam_masks(image_embeddings[i], input_boxes)
+        results[i] = (self.threshold_sam_masks(low_res_masks, images[i].shape[:-1]), all_boxes[i])
+    
+    return results
+  
   @torch.no_grad()    
-  def process_source_extractor_prompts(self, image_path, boxes_numpy, show_masks = False):
+  def process_source_extractor_prompts(self, image_path, boxes_numpy, show_masks = False, image=None):
       
-      image = cv2.imread(image_path)
+      if image is None:
+        image = cv2.imread(image_path)
       start_time_all = time.time()
 
-      # set a specific mean for each image
-      input_image = predictor_utils.set_mean_and_transform(image, self.mobile_sam_model, self.transform, self.device)
-              
       if len(boxes_numpy) == 0: # type: ignore
         print("No objects detected. Check model configuration or input image.")
         return None
@@ -212,15 +554,8 @@ class InferXami:
       input_boxes = torch.from_numpy(input_boxes).to(self.device)
       sam_mask = []
      
-      low_res_masks, iou_predictions = self.run_sam_model(input_image, input_boxes)
-      low_res_masks=self.model_predictor.model.postprocess_masks(low_res_masks, (1024, 1024), image.shape[:-1]).to(self.device)
-      
-      # Apply Gaussian filter on logits
-      kernel_size, sigma = 5, 2
-      gaussian_kernel = predictor_utils.create_gaussian_kernel(kernel_size, sigma).to(self.device)
-      pred_masks = torch.nn.functional.conv2d(low_res_masks, gaussian_kernel, padding=kernel_size//2)
-      threshold_masks = torch.sigmoid(10 * (pred_masks - self.mobile_sam_model.mask_threshold)) # sigmoid with steepness
-      sam_mask_pre = (threshold_masks > 0.5)*1.0
+      low_res_masks, iou_predictions = self.decode_sam_masks(self.get_image_embedding(image), input_boxes)
+      sam_mask_pre = self.threshold_sam_masks(low_res_masks, image.shape[:-1])
       inference_time = (time.time()-start_time_all)*1000
       sam_mask.append(sam_mask_pre.squeeze(1))
       sam_masks_numpy = sam_mask[0].detach().cpu().numpy()
@@ -230,6 +565,8 @@ class InferXami:
         return None
 
       if show_masks:
+        import matplotlib.pyplot as plt
+        from ..dataset import dataset_utils
         fig, axes = plt.subplots(1, 3, figsize=(20, 8)) 
         image_copy = image.copy()
 
@@ -1 +1,3 @@
-from .loss_utils import *
\ No newline at end of file
+from .._lazy import lazy_star_exports
+
+__getattr__, __dir__ = lazy_star_exports(__name__, ('loss_utils',))
@@ -1,8 +1,6 @@
 import torch
-from scipy.optimize import linear_sum_assignment
 import torch.nn.functional as F
 import numpy as np
-import matplotlib.pyplot as plt
 from ..model_predictor import predictor_utils
 
 def iou_single(pred_mask, gt_mask):
@@ -71,6 +69,25 @@ def compute_dice_loss(pred_mask, gt_mask):
 
     return 1 - dice_coefficient
 
+def process_faint_matched_masks(image, pred_masks, yolo_masks, all_pred_classes, pred_indices, wt_threshold, wt_classes):
+    """Apply predictor_utils.process_faint_masks to the matched predictions at once, with the wavelet mask of the image computed once."""
+    pred_indices = list(pred_indices)
+    if len(pred_indices) == 0:
+        return []
+    
+    wt_mask = predictor_utils.wavelet_background_mask(image, pred_masks.device)
+    combined_preds = predictor_utils.process_faint_masks(
+        image, 
+        pred_masks[pred_indices].detach().clone(), 
+        [yolo_masks[pred_idx] for pred_idx in pred_indices], 
+        [all_pred_classes[pred_idx] for pred_idx in pred_indices], 
+        pred_masks.device,
+        wt_threshold,
+        wt_classes,
+        wt_mask=wt_mask)
+    
+    return list(combined_preds.cpu().numpy())
+
 def segm_loss_match_hungarian(
     use_yolo_masks,
 	pred_masks,
@@ -85,6 +102,7 @@ def segm_loss_match_hungarian(
     wt_threshold=None):
 
     # Compute IoU matrix for all pairs
+    from scipy.optimize import linear_sum_assignment
     iou_matrix = compute_iou_matrix(pred_masks, gt_masks)  
     preds = []
     gts = []
@@ -110,21 +128,13 @@ def segm_loss_match_hungarian(
         #     dice_loss *= mask_areas[gt_idx]/sum(mask_areas) # weighted loss given mask size
         #     focal_loss *= mask_areas[gt_idx]/sum(mask_areas) # weighted loss given mask size
             
-        if use_yolo_masks:
-            if yolo_masks is not None and wt_threshold is not None and wt_classes is not None and image is not None:
-                combined_preds.append(predictor_utils.process_faint_masks(
-                    image, 
-                    [pred_masks[pred_idx]], 
-                    [yolo_masks[pred_idx]], 
-                    [all_pred_classes[pred_idx]], 
-                    pred_masks.device,
-                    wt_threshold,
-                    wt_classes
-                    )[0].detach().cpu().numpy())
-            
         total_dice_loss += dice_loss
         total_focal_loss += focal_loss
             
+    if use_yolo_masks:
+        if yolo_masks is not None and wt_threshold is not None and wt_classes is not None and image is not None:
+            combined_preds = process_faint_matched_masks(image, pred_masks, yolo_masks, all_pred_classes, row_ind, wt_threshold, wt_classes)
+            
     # Normalize the losses
     mean_dice_loss = total_dice_loss / len(row_ind)
     mean_focal_loss = total_focal_loss / len(row_ind)
@@ -173,17 +183,10 @@ def segm_loss_match_iou_based(
         if mask_areas is not None:
             total_dice_loss += (dice_loss * mask_areas[gt_idx]/sum(mask_areas)) # weighted loss given mask size
             total_focal_loss += (focal_loss * mask_areas[gt_idx]/sum(mask_areas)) # weighted loss given mask size
-        if use_yolo_masks:
-            if yolo_masks is not None and wt_threshold is not None and wt_classes is not None and image is not None:
-                combined_preds.append(predictor_utils.process_faint_masks(
-                    image, 
-                    [pred_masks[pred_idx]], 
-                    [yolo_masks[pred_idx]], 
-                    [all_pred_classes[pred_idx]], 
-                    pred_masks.device,
-                    wt_threshold,
-                    wt_classes
-                    )[0].detach().cpu().numpy())
+            
+    if use_yolo_masks:
+        if yolo_masks is not None and wt_threshold is not None and wt_classes is not None and image is not None:
+            combined_preds = process_faint_matched_masks(image, pred_masks, yolo_masks, all_pred_classes, range(iou_matrix.shape[0]), wt_threshold, wt_classes)
             
     # Normalize the losses
     mean_dice_loss = total_dice_loss / len(gts)
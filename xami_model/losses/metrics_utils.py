@@ -2,9 +2,6 @@ from torch import tensor
 from pprint import pprint
 import torch
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib import rcParams
-import seaborn as sns
 
 def flatten_ious_areas(pred_classes, all_iou_scores, mask_areas=None):
     all_ious_flatten = []
@@ -21,6 +18,60 @@ def flatten_ious_areas(pred_classes, all_iou_scores, mask_areas=None):
     else:
         return all_ious_flatten
         
+def _masks_to_bool_tensor(masks):
+    """Stack one image's masks into a [N, H, W] bool tensor. Masks may be dense arrays or COCO RLE dicts."""
+    if len(masks) > 0 and isinstance(masks[0], dict):
+        from pycocotools import mask as mask_utils  # type: ignore
+        masks = [mask_utils.decode(rle) for rle in masks]
+    masks = np.array([np.asarray(mask) for mask in masks], dtype=bool)
+    if masks.ndim == 4: # [N, 1, H, W]
+        masks = masks[:, 0]
+    return tensor(masks, dtype=torch.bool)
+
+class StreamingMAP:
+    """
+    Streams predictions into a torchmetrics `MeanAveragePrecision` (iou_type='segm') one image at a time.
+
+    `MeanAveragePrecision` RLE-encodes segmentation masks when it is updated, so feeding it per image while
+    validation runs keeps memory proportional to the RLEs instead of every full-resolution mask of the split.
+    The result is computed once and cached until the next update.
+    """
+    def __init__(self, map_metric):
+        self.map_metric = map_metric
+        self._result = None
+
+    def update(self, pred_masks, gt_masks, pred_classes, gt_classes, iou_scores):
+        """
+        Add the predictions and ground truths of one image.
+
+        Args:
+        - pred_masks: Predicted masks of shape [N, H, W] (or [N, 1, H, W]), or a list of N COCO RLE dicts.
+        - gt_masks: Ground truth masks of shape [M, H, W] (or [M, 1, H, W]), or a list of M COCO RLE dicts.
+        - pred_classes: N predicted class ids.
+        - gt_classes: M ground truth class ids.
+        - iou_scores: N predicted scores (e.g. SAM IoU predictions), one per predicted mask.
+        """
+        img_preds_dict = dict(
+            masks=_masks_to_bool_tensor(pred_masks),
+            scores=tensor(np.asarray(iou_scores).reshape(-1)),
+            labels=tensor(np.array(pred_classes, dtype=np.int8), dtype=torch.int16),
+          )
+        img_gts_dict = dict(
+            masks=_masks_to_bool_tensor(gt_masks),
+            labels=tensor(np.array(gt_classes, dtype=np.int8), dtype=torch.int16),
+          )
+        self.map_metric.update([img_preds_dict], [img_gts_dict])
+        self._result = None
+
+    def compute(self):
+        if self._result is None:
+            self._result = self.map_metric.compute()
+        return self._result
+
+    def reset(self):
+        self.map_metric.reset()
+        self._result = None
+
 def mAP_metrics(map_metric,
                 preds,
                 gts, 
@@ -30,40 +81,20 @@ def mAP_metrics(map_metric,
                 mask_areas,
 			    show_metrics=False):
     
-    all_preds, all_gts, all_ious = [], [], []
+    evaluator = StreamingMAP(map_metric)
     for i in range(len(preds)):
-        gt_i = np.array([gts[i][j][0] for j in range(len(gts[i]))])
-        pred_i = np.array([preds[i][j] for j in range(len(preds[i]))])
-        ious_i = np.array([all_iou_scores[i][j][0] for j in range(len(all_iou_scores[i]))])
-        all_gts.append(gt_i)    
-        all_preds.append(pred_i)  
-        all_ious.append(ious_i)
-        
-    all_gt_classes = [np.array(gt_classes[i], dtype=np.int8) for i in range(len(gt_classes))]
-    all_pred_classes = [np.array(pred_classes[i], dtype=np.int8) for i in range(len(pred_classes))]
-    
-    preds_per_image = []
-    gts_per_image = []
+        evaluator.update(
+            [preds[i][j] for j in range(len(preds[i]))],
+            [gts[i][j][0] for j in range(len(gts[i]))],
+            pred_classes[i],
+            gt_classes[i],
+            [all_iou_scores[i][j][0] for j in range(len(all_iou_scores[i]))])
     
-    for img_i in range(len(all_preds)):
-        img_preds_dict = dict(
-            masks=tensor(all_preds[img_i], dtype=torch.bool),
-            scores=tensor(all_ious[img_i]),
-            labels=tensor(all_pred_classes[img_i], dtype=torch.int16),
-          )
-        img_gts_dict = dict(
-            masks=tensor(all_gts[img_i], dtype=torch.bool),
-            labels=tensor(all_gt_classes[img_i], dtype=torch.int16),
-          )
-        
-        preds_per_image.append(img_preds_dict)
-        gts_per_image.append(img_gts_dict)
-
-    map_metric.update(preds_per_image, gts_per_image)
+    metrics = evaluator.compute()
     if show_metrics:
-        pprint(map_metric.compute())
+        pprint(metrics)
 		
-    return map_metric.compute()
+    return metrics
 
 def ious_pred_vs_gt(gts, preds):
     all_ious_pred_vs_gt_flatten = []
@@ -81,81 +112,124 @@ def ious_pred_vs_gt(gts, preds):
         
     return all_ious_pred_vs_gt_flatten, all_ious_pred_vs_gt
 
-def compute_metrics_with_range(gt_masks, pred_masks, image=None):
-    """Compute the True Positive, False Positive, and False Negative BINARY masks for multiple segmentations."""
-    
-    try: # the pred_mask array is empty
-        combined_gt_mask = np.zeros_like(gt_masks[0][0], dtype=bool) 
-        combined_pred_mask = combined_gt_mask.copy()
-    except: # the gt array is empty
-        combined_pred_mask = np.zeros_like(pred_masks[0], dtype=bool)
-        combined_gt_mask = combined_pred_mask.copy()
-        
-    for gt_mask in gt_masks:
-        combined_gt_mask = np.logical_or(combined_gt_mask, gt_mask) # all gt masks combined
+def to_bool_masks(masks, backend='numpy', device=None):
+    if backend == 'torch':
+        if not isinstance(masks, torch.Tensor):
+            masks = torch.as_tensor(np.asarray(masks))
+        return masks.to(device=device if device is not None else masks.device, dtype=torch.bool)
+    elif backend == 'numpy':
+        if isinstance(masks, torch.Tensor):
+            masks = masks.detach().cpu().numpy()
+        return np.asarray(masks).astype(bool, copy=False)
+    else:
+        raise ValueError(f"Unknown backend {backend}. Use 'numpy' or 'torch'.")
 
-    for pred_mask in pred_masks:
-        combined_pred_mask = np.logical_or(combined_pred_mask, pred_mask.astype(bool)) # all pred masks combined
+def union_mask(masks, backend='numpy', device=None):
+    """
+    Combine a stack of binary masks into a single mask with one reduction over the first axis.
 
-    intersection = np.sum(np.logical_and(combined_gt_mask, combined_pred_mask))
-    union = np.sum(np.logical_or(combined_gt_mask, combined_pred_mask))
+    Args:
+    - masks: Masks of shape [N, ...] (NumPy array, torch tensor or list of equally shaped masks).
+    - backend (str): 'numpy' or 'torch'. The torch backend keeps the result on `device` (default: the masks' device).
 
-    iou = intersection/union if union > 0 else 0
-    
-    true_positive_mask = np.logical_and(combined_gt_mask, combined_pred_mask)
-    false_negative_mask = np.logical_and(combined_gt_mask, np.logical_not(combined_pred_mask))
-    false_positive_mask = np.logical_and(combined_pred_mask, np.logical_not(combined_gt_mask))
+    Returns:
+    - The combined mask of shape [...], or None if there are no masks.
+    """
+    if len(masks) == 0:
+        return None
+    masks = to_bool_masks(masks, backend, device)
+    return masks.any(dim=0) if backend == 'torch' else masks.any(axis=0)
 
-    return true_positive_mask, false_positive_mask, false_negative_mask, iou
+def mask_iou_matrix(pred_masks, gt_masks, backend='numpy', device=None):
+    """
+    Compute the [P, G] IoU matrix between predicted and GT masks with a single matrix product.
 
-def compute_metrics(gt_masks, pred_masks, iou_threshold, image=None):
+    The masks are flattened to [N, H*W]; intersections are the product of the flattened masks 
+    and unions follow from the mask areas, so no per-pair Python loop is needed.
+
+    Args:
+    - pred_masks: Predicted masks of shape [P, ...].
+    - gt_masks: GT masks of shape [G, ...] with the same number of pixels per mask as pred_masks.
+    - backend (str): 'numpy' or 'torch'. The torch backend runs on `device` (default: the masks' device).
+
+    Returns:
+    - iou_matrix: [P, G] array (or tensor for the torch backend). Pairs with an empty union have IoU 0.
+    """
+    num_pred, num_gt = len(pred_masks), len(gt_masks)
+    if backend == 'torch':
+        if num_pred == 0 or num_gt == 0:
+            return torch.zeros((num_pred, num_gt), device=device)
+        pred = to_bool_masks(pred_masks, backend, device).reshape(num_pred, -1)
+        gt = to_bool_masks(gt_masks, backend, pred.device).reshape(num_gt, -1)
+        dtype = torch.float32 if pred.shape[1] < 2**24 else torch.float64 # exact integer counts
+        pred, gt = pred.to(dtype), gt.to(dtype)
+        intersection = pred @ gt.T
+        union = pred.sum(dim=1)[:, None] + gt.sum(dim=1)[None, :] - intersection
+        return torch.where(union > 0, intersection / union.clamp(min=1), torch.zeros_like(union))
+    
+    if num_pred == 0 or num_gt == 0:
+        return np.zeros((num_pred, num_gt))
+    pred = to_bool_masks(pred_masks, backend).reshape(num_pred, -1)
+    gt = to_bool_masks(gt_masks, backend).reshape(num_gt, -1)
+    dtype = np.float32 if pred.shape[1] < 2**24 else np.float64 # exact integer counts
+    pred, gt = pred.astype(dtype), gt.astype(dtype)
+    intersection = pred @ gt.T
+    union = pred.sum(axis=1)[:, None] + gt.sum(axis=1)[None, :] - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+def compute_metrics_with_range(gt_masks, pred_masks, image=None, backend='numpy', device=None):
     """Compute the True Positive, False Positive, and False Negative BINARY masks for multiple segmentations."""
     
-    # if image is not None:
-        # plt.imshow(image)
-        # for mask in gt_masks:
-        #     dataset_utils.show_mask(mask[0], plt.gca())
-        # plt.show()
-        # plt.close()
+    combined_gt_mask = union_mask(gt_masks, backend, device) # all gt masks combined
+    combined_pred_mask = union_mask(pred_masks, backend, device) # all pred masks combined
+    if combined_gt_mask is None: # the gt array is empty
+        combined_gt_mask = combined_pred_mask.clone() if backend == 'torch' else combined_pred_mask.copy()
+        combined_gt_mask[...] = False
+    if combined_pred_mask is None: # the pred array is empty
+        combined_pred_mask = combined_gt_mask.clone() if backend == 'torch' else combined_gt_mask.copy()
+        combined_pred_mask[...] = False
     
-        # plt.imshow(image)
-        # for mask in pred_masks:
-        #     dataset_utils.show_mask(mask, plt.gca())
-        # plt.show()
-        # plt.close()
-        
-    combined_gt_mask = np.zeros_like(gt_masks[0][0], dtype=bool)
-    combined_pred_mask = np.zeros_like(pred_masks[0], dtype=bool)
-    filtered_pred_masks = np.zeros_like(pred_masks, dtype=bool)
-    combined_filtered_pred_masks = np.zeros_like(pred_masks[0], dtype=bool)
+    true_positive_mask = combined_gt_mask & combined_pred_mask
+    false_negative_mask = combined_gt_mask & ~combined_pred_mask
+    false_positive_mask = combined_pred_mask & ~combined_gt_mask
+
+    intersection = true_positive_mask.sum()
+    union = (combined_gt_mask | combined_pred_mask).sum()
+    iou = intersection/union if union > 0 else 0
+
+    return true_positive_mask, false_positive_mask, false_negative_mask, iou
+
+def filter_masks_by_iou(gt_masks, pred_masks, iou_threshold, backend='numpy', device=None):
+    """Return a boolean selector of the predicted masks whose best IoU with any GT mask is above iou_threshold."""
+    iou_matrix = mask_iou_matrix(pred_masks, gt_masks, backend, device)
+    if iou_matrix.shape[1] == 0: # nothing to match, nothing kept
+        return iou_matrix.sum(1) > 0
+    max_iou = iou_matrix.max(dim=1).values if backend == 'torch' else iou_matrix.max(axis=1)
+    return max_iou > iou_threshold # take IoUs above threshold
+
+def compute_metrics(gt_masks, pred_masks, iou_threshold, image=None, backend='numpy', device=None):
+    """Compute the True Positive, False Positive, and False Negative BINARY masks for multiple segmentations."""
     
     # print(gt_masks.shape, pred_masks.shape) # (N, 1, H, W), (N, H, W)
-    for i, pred_mask in enumerate(pred_masks):
-        max_iou = 0  
-        
-        for gt_mask in gt_masks:
-            intersection = np.logical_and(gt_mask[0], pred_mask)
-            union = np.logical_or(gt_mask[0], pred_mask)
-            iou_score = np.sum(intersection)/np.sum(union) if np.sum(union) > 0 else 0
-            max_iou = max(max_iou, iou_score)  
-
-        if max_iou > iou_threshold: # take IoUs above threshold
-            filtered_pred_masks[i] = pred_mask
-
-    for gt_mask in gt_masks:
-        combined_gt_mask = np.logical_or(combined_gt_mask, gt_mask.astype(bool))
-    for pred_mask in filtered_pred_masks:
-        combined_filtered_pred_masks = np.logical_or(combined_filtered_pred_masks, pred_mask.astype(bool))
-    for pred_mask in pred_masks:
-        combined_pred_mask = np.logical_or(combined_pred_mask, pred_mask.astype(bool))
-
-    true_positive_mask = np.logical_and(combined_gt_mask, combined_filtered_pred_masks)
-    false_negative_mask = np.logical_and(combined_gt_mask, np.logical_not(combined_filtered_pred_masks))
-    false_positive_mask = np.logical_and(combined_pred_mask, np.logical_not(combined_gt_mask))
+    pred_masks = to_bool_masks(pred_masks, backend, device)
+    keep = filter_masks_by_iou(gt_masks, pred_masks, iou_threshold, backend, device)
+
+    combined_gt_mask = union_mask(gt_masks, backend, device)
+    combined_pred_mask = union_mask(pred_masks, backend, device)
+    combined_filtered_pred_masks = union_mask(pred_masks[keep], backend, device)
+    if combined_filtered_pred_masks is None:
+        combined_filtered_pred_masks = combined_pred_mask & False
+
+    true_positive_mask = combined_gt_mask & combined_filtered_pred_masks
+    false_negative_mask = combined_gt_mask & ~combined_filtered_pred_masks
+    false_positive_mask = combined_pred_mask & ~combined_gt_mask
 
     return true_positive_mask, false_positive_mask, false_negative_mask
 
 def plot_ious(train_all_ious_pred_vs_gt, valid_all_ious_pred_vs_gt, box_anchor=(0.63, 0.21)):
+    import matplotlib.pyplot as plt
+    from matplotlib import rcParams
+    import seaborn as sns
     rcParams.update({
         'font.size': 14, 'axes.labelsize': 16, 'axes.titlesize': 18,
         'xtick.labelsize': 12, 'ytick.labelsize': 12, 'legend.fontsize': 14,
@@ -5,7 +5,9 @@
 # LICENSE file in the root directory of this source tree.
 
 import numpy as np
+import os
 import torch
+from concurrent.futures import ThreadPoolExecutor
 from torchvision.ops.boxes import batched_nms, box_area  # type: ignore
 
 from typing import Any, Dict, List, Optional, Tuple
@@ -14,18 +16,21 @@ from .modeling import Sam
 from .predictor import SamPredictor
 from .utils.amg import (
     MaskData,
-    area_from_rle,
+    areas_from_rles,
     batch_iterator,
     batched_mask_to_box,
     box_xyxy_to_xywh,
     build_all_layer_point_grids,
+    build_point_grid,
     calculate_stability_score,
     coco_encode_rle,
     generate_crop_boxes,
+    generate_source_crop_boxes,
     is_box_near_crop_edge,
     mask_to_rle_pytorch,
     remove_small_regions,
     rle_to_mask,
+    rles_to_masks,
     uncrop_boxes_xyxy,
     uncrop_masks,
     uncrop_points,
@@ -48,7 +53,9 @@ class SamAutomaticMaskGenerator:
         crop_n_points_downscale_factor: int = 1,
         point_grids: Optional[List[np.ndarray]] = None,
         min_mask_region_area: int = 0,
-        output_mode: str = "binary_mask"
+        output_mode: str = "binary_mask",
+        crops_per_batch: Optional[int] = None,
+        background_points_per_side: int = 8,
 	) -> None:
         """
         Using a SAM model, generates masks for the entire image.
@@ -93,6 +100,13 @@ class SamAutomaticMaskGenerator:
             'uncompressed_rle', or 'coco_rle'. 'coco_rle' requires pycocotools.
             For large resolutions, 'binary_mask' may consume large amounts of
             memory.
+          crops_per_batch (int or None): The number of image crops encoded
+            together in one forward pass of the image encoder. If None, all
+            the crops of an image are encoded at once.
+          background_points_per_side (int): When generate is given source
+            points, the number of points along one side of the sparse grid
+            added to them on the whole image, to also catch what the
+            source catalog missed. 0 disables it.
         """
 
         assert (points_per_side is None) != (
@@ -132,14 +146,24 @@ class SamAutomaticMaskGenerator:
         self.crop_n_points_downscale_factor = crop_n_points_downscale_factor
         self.min_mask_region_area = min_mask_region_area
         self.output_mode = output_mode
+        self.crops_per_batch = crops_per_batch
+        self.background_points_per_side = background_points_per_side
 
     @torch.no_grad()
-    def generate(self, image: np.ndarray) -> List[Dict[str, Any]]:
+    def generate(
+        self, image: np.ndarray, source_points: Optional[np.ndarray] = None
+    ) -> List[Dict[str, Any]]:
         """
         Generates masks for the given image.
 
         Arguments:
           image (np.ndarray): The image to generate masks for, in HWC uint8 format.
+          source_points (np.ndarray or None): Nx2 positions of detected
+            sources in pixels, in (X, Y) format (e.g. the centroids of a
+            source catalog). If given, they replace the dense point grids:
+            the whole image is prompted with the sources plus a sparse
+            background grid, and the crop layers are only generated around
+            clusters of sources, prompted with the sources they contain.
 
         Returns:
            list(dict(str, any)): A list over records for masks. Each record is
@@ -160,7 +184,7 @@ class SamAutomaticMaskGenerator:
         """
 
         # Generate masks
-        mask_data = self._generate_masks(image)
+        mask_data = self._generate_masks(image, source_points)
 
         # Filter small disconnected regions and holes in masks
         if self.min_mask_region_area > 0:
@@ -174,16 +198,17 @@ class SamAutomaticMaskGenerator:
         if self.output_mode == "coco_rle":
             mask_data["segmentations"] = [coco_encode_rle(rle) for rle in mask_data["rles"]]
         elif self.output_mode == "binary_mask":
-            mask_data["segmentations"] = [rle_to_mask(rle) for rle in mask_data["rles"]]
+            mask_data["segmentations"] = list(rles_to_masks(mask_data["rles"]))
         else:
             mask_data["segmentations"] = mask_data["rles"]
 
         # Write mask records
+        areas = areas_from_rles(mask_data["rles"]).tolist()
         curr_anns = []
         for idx in range(len(mask_data["segmentations"])):
             ann = {
                 "segmentation": mask_data["segmentations"][idx],
-                "area": area_from_rle(mask_data["rles"][idx]),
+                "area": areas[idx],
                 "bbox": box_xyxy_to_xywh(mask_data["boxes"][idx]).tolist(),
                 "predicted_iou": mask_data["iou_preds"][idx].item(),
                 "point_coords": [mask_data["points"][idx].tolist()],
@@ -194,17 +219,56 @@ class SamAutomaticMaskGenerator:
 
         return curr_anns
 
-    def _generate_masks(self, image: np.ndarray) -> MaskData:
+    def _source_crop_points(
+        self, crop_boxes: List[List[int]], layer_idxs: List[int], source_points: np.ndarray
+    ) -> List[np.ndarray]:
+        # The prompts of each crop, in pixels in the crop frame
+        crop_points = []
+        for (x0, y0, x1, y1), layer_idx in zip(crop_boxes, layer_idxs):
+            inside = (
+                (source_points[:, 0] >= x0)
+                & (source_points[:, 0] < x1)
+                & (source_points[:, 1] >= y0)
+                & (source_points[:, 1] < y1)
+            )
+            points = source_points[inside] - np.array([[x0, y0]])
+            if layer_idx == 0 and self.background_points_per_side > 0:
+                background = build_point_grid(self.background_points_per_side)
+                points = np.concatenate([points, background * np.array([[x1 - x0, y1 - y0]])])
+            crop_points.append(points)
+        return crop_points
+
+    def _generate_masks(self, image: np.ndarray, source_points: Optional[np.ndarray] = None) -> MaskData:
         orig_size = image.shape[:2]
-        crop_boxes, layer_idxs = generate_crop_boxes(
-            orig_size, self.crop_n_layers, self.crop_overlap_ratio
-        )
+        if source_points is None:
+            crop_boxes, layer_idxs = generate_crop_boxes(
+                orig_size, self.crop_n_layers, self.crop_overlap_ratio
+            )
+            crop_points = [None] * len(crop_boxes)
+        else:
+            source_points = np.asarray(source_points, dtype=np.float64).reshape(-1, 2)
+            crop_boxes, layer_idxs = generate_source_crop_boxes(
+                orig_size, source_points, self.crop_n_layers, self.crop_overlap_ratio
+            )
+            crop_points = self._source_crop_points(crop_boxes, layer_idxs, source_points)
+            if len(crop_points[0]) == 0:
+                raise ValueError("No prompts: no source points were given and background_points_per_side is 0.")
 
-        # Iterate over image crops
+        # Iterate over image crops, encoding several crops at once
         data = MaskData()
-        for crop_box, layer_idx in zip(crop_boxes, layer_idxs):
-            crop_data = self._process_crop(image, crop_box, layer_idx, orig_size)
-            data.cat(crop_data)
+        crops_per_batch = self.crops_per_batch or len(crop_boxes)
+        for batch_crop_boxes, batch_layer_idxs, batch_points in batch_iterator(
+            crops_per_batch, crop_boxes, layer_idxs, crop_points
+        ):
+            self.predictor.set_images([image[y0:y1, x0:x1, :] for x0, y0, x1, y1 in batch_crop_boxes])
+            for image_index, (crop_box, layer_idx, points) in enumerate(
+                zip(batch_crop_boxes, batch_layer_idxs, batch_points)
+            ):
+                crop_data = self._process_crop(
+                    image, crop_box, layer_idx, orig_size, image_index=image_index, points_for_image=points
+                )
+                data.cat(crop_data)
+            self.predictor.reset_image()
 
         # Remove duplicate masks between crops
         if len(crop_boxes) > 1:
@@ -228,24 +292,30 @@ class SamAutomaticMaskGenerator:
         crop_box: List[int],
         crop_layer_idx: int,
         orig_size: Tuple[int, ...],
+        image_index: Optional[int] = None,
+        points_for_image: Optional[np.ndarray] = None,
     ) -> MaskData:
-        # Crop the image and calculate embeddings
+        # Crop the image and calculate embeddings, unless the crop was
+        # already encoded with the predictor's set_images (image_index)
         x0, y0, x1, y1 = crop_box
         cropped_im = image[y0:y1, x0:x1, :]
         cropped_im_size = cropped_im.shape[:2]
-        self.predictor.set_image(cropped_im)
+        if image_index is None:
+            self.predictor.set_image(cropped_im)
 
-        # Get points for this crop
-        points_scale = np.array(cropped_im_size)[None, ::-1]
-        points_for_image = self.point_grids[crop_layer_idx] * points_scale
+        # Get points for this crop, unless given in pixels in the crop frame
+        if points_for_image is None:
+            points_scale = np.array(cropped_im_size)[None, ::-1]
+            points_for_image = self.point_grids[crop_layer_idx] * points_scale
 
         # Generate masks for this crop in batches
         data = MaskData()
         for (points,) in batch_iterator(self.points_per_batch, points_for_image):
-            batch_data = self._process_batch(points, cropped_im_size, crop_box, orig_size)
+            batch_data = self._process_batch(points, cropped_im_size, crop_box, orig_size, image_index)
             data.cat(batch_data)
             del batch_data
-        self.predictor.reset_image()
+        if image_index is None:
+            self.predictor.reset_image()
 
         # Remove duplicates within this crop.
         keep_by_nms = batched_nms(
@@ -269,6 +339,7 @@ class SamAutomaticMaskGenerator:
         im_size: Tuple[int, ...],
         crop_box: List[int],
         orig_size: Tuple[int, ...],
+        image_index: Optional[int] = None,
     ) -> MaskData:
         orig_h, orig_w = orig_size
 
@@ -276,11 +347,15 @@ class SamAutomaticMaskGenerator:
         transformed_points = self.predictor.transform.apply_coords(points, im_size)
         in_points = torch.as_tensor(transformed_points, device=self.predictor.device)
         in_labels = torch.ones(in_points.shape[0], dtype=torch.int, device=in_points.device)
+        image_indices = None
+        if image_index is not None:
+            image_indices = torch.full_like(in_labels, image_index, dtype=torch.long)
         masks, iou_preds, _ = self.predictor.predict_torch(
             in_points[:, None, :],
             in_labels[:, None],
             multimask_output=True,
             return_logits=True,
+            image_indices=image_indices,
         )
 
         # Serialize predictions and store in MaskData
@@ -320,9 +395,20 @@ class SamAutomaticMaskGenerator:
 
         return data
 
+    @staticmethod
+    def _remove_small_regions_rle(rle: Dict[str, Any], min_area: int) -> Tuple[np.ndarray, bool]:
+        mask = rle_to_mask(rle)
+
+        mask, changed = remove_small_regions(mask, min_area, mode="holes")
+        unchanged = not changed
+        mask, changed = remove_small_regions(mask, min_area, mode="islands")
+        unchanged = unchanged and not changed
+
+        return mask, unchanged
+
     @staticmethod
     def postprocess_small_regions(
-        mask_data: MaskData, min_area: int, nms_thresh: float
+        mask_data: MaskData, min_area: int, nms_thresh: float, num_workers: Optional[int] = None
     ) -> MaskData:
         """
         Removes small disconnected regions and holes in masks, then reruns
@@ -330,22 +416,27 @@ class SamAutomaticMaskGenerator:
 
         Edits mask_data in place.
 
-        Requires open-cv as a dependency.
+        Requires open-cv as a dependency. The masks are processed by a
+        pool of num_workers threads (OpenCV releases the GIL), defaulting to
+        the number of CPUs; results are gathered in the input order, so the
+        output doesn't depend on the number of workers.
         """
         if len(mask_data["rles"]) == 0:
             return mask_data
 
         # Filter small disconnected regions and holes
+        if num_workers is None:
+            num_workers = min(8, os.cpu_count() or 1)
+        clean = lambda rle: SamAutomaticMaskGenerator._remove_small_regions_rle(rle, min_area)
+        if num_workers > 1 and len(mask_data["rles"]) > 1:
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                results = list(executor.map(clean, mask_data["rles"]))
+        else:
+            results = [clean(rle) for rle in mask_data["rles"]]
+
         new_masks = []
         scores = []
-        for rle in mask_data["rles"]:
-            mask = rle_to_mask(rle)
-
-            mask, changed = remove_small_regions(mask, min_area, mode="holes")
-            unchanged = not changed
-            mask, changed = remove_small_regions(mask, min_area, mode="islands")
-            unchanged = unchanged and not changed
-
+        for mask, unchanged in results:
             new_masks.append(torch.as_tensor(mask).unsqueeze(0))
             # Give score=0 to changed masks and score=1 to unchanged masks
             # so NMS will prefer ones that didn't need postprocessing
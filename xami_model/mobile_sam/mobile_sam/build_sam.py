@@ -11,40 +11,46 @@ from functools import partial
 from .modeling import ImageEncoderViT, MaskDecoder, PromptEncoder, Sam, TwoWayTransformer, TinyViT
 
 
-def build_sam_vit_h(checkpoint=None):
+def build_sam_vit_h(checkpoint=None, quantize=None, calibration_images=None):
     return _build_sam(
         encoder_embed_dim=1280,
         encoder_depth=32,
         encoder_num_heads=16,
         encoder_global_attn_indexes=[7, 15, 23, 31],
         checkpoint=checkpoint,
+        quantize=quantize,
+        calibration_images=calibration_images,
     )
 
 
 build_sam = build_sam_vit_h
 
 
-def build_sam_vit_l(checkpoint=None):
+def build_sam_vit_l(checkpoint=None, quantize=None, calibration_images=None):
     return _build_sam(
         encoder_embed_dim=1024,
         encoder_depth=24,
         encoder_num_heads=16,
         encoder_global_attn_indexes=[5, 11, 17, 23],
         checkpoint=checkpoint,
+        quantize=quantize,
+        calibration_images=calibration_images,
     )
 
 
-def build_sam_vit_b(checkpoint=None):
+def build_sam_vit_b(checkpoint=None, quantize=None, calibration_images=None):
     return _build_sam(
         encoder_embed_dim=768,
         encoder_depth=12,
         encoder_num_heads=12,
         encoder_global_attn_indexes=[2, 5, 8, 11],
         checkpoint=checkpoint,
+        quantize=quantize,
+        calibration_images=calibration_images,
     )
 
 
-def build_sam_vit_t(checkpoint=None):
+def build_sam_vit_t(checkpoint=None, quantize=None, calibration_images=None):
     prompt_embed_dim = 256
     image_size = 1024
     vit_patch_size = 16
@@ -88,8 +94,10 @@ def build_sam_vit_t(checkpoint=None):
     mobile_sam.eval()
     if checkpoint is not None:
         with open(checkpoint, "rb") as f:
-            state_dict = torch.load(f)
+            state_dict = torch.load(f, map_location="cpu")
         mobile_sam.load_state_dict(state_dict)
+    if quantize is not None:
+        mobile_sam = _quantize(mobile_sam, quantize, calibration_images)
     return mobile_sam
 
 
@@ -108,6 +116,8 @@ def _build_sam(
     encoder_num_heads,
     encoder_global_attn_indexes,
     checkpoint=None,
+    quantize=None,
+    calibration_images=None,
 ):
     prompt_embed_dim = 256
     image_size = 1024
@@ -152,8 +162,17 @@ def _build_sam(
     sam.eval()
     if checkpoint is not None:
         with open(checkpoint, "rb") as f:
-            state_dict = torch.load(f)
+            state_dict = torch.load(f, map_location="cpu")
         sam.load_state_dict(state_dict)
+    if quantize is not None:
+        sam = _quantize(sam, quantize, calibration_images)
     return sam
 
 
+def _quantize(sam, mode, calibration_images=None):
+    # Int8 CPU variant of the model ('dynamic' or 'static'), see utils.quantization
+    from .utils.quantization import quantize_sam
+
+    return quantize_sam(sam, mode=mode, calibration_images=calibration_images, inplace=not calibration_images)
+
+
@@ -8,7 +8,7 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 
-from typing import Any, Dict, List, Tuple, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from .tiny_vit_sam import TinyViT
 from .image_encoder import ImageEncoderViT
@@ -51,6 +51,27 @@ class Sam(nn.Module):
     def device(self) -> Any:
         return self.pixel_mean.device
 
+    def prepare_for_inference(self, compile_encoder: bool = False, compile_mode: Optional[str] = None) -> "Sam":
+        """
+        Switch the model to eval mode and apply the inference-only
+        optimizations of the image encoder, if it has any (see
+        TinyViT.prepare_for_inference).
+
+        Arguments:
+          compile_encoder (bool): Whether to also compile the image encoder
+            with torch.compile.
+          compile_mode (str or None): The torch.compile mode.
+
+        Returns:
+          (Sam): The model itself.
+        """
+        self.eval()
+        if hasattr(self.image_encoder, "prepare_for_inference"):
+            self.image_encoder.prepare_for_inference()
+        if compile_encoder:
+            self.image_encoder.compile(mode=compile_mode)
+        return self
+
     @torch.no_grad()
     def forward(
         self,
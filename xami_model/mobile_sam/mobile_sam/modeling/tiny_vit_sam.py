@@ -37,7 +37,8 @@ class Conv2d_BN(torch.nn.Sequential):
         b = bn.bias - bn.running_mean * bn.weight / \
             (bn.running_var + bn.eps)**0.5
         m = torch.nn.Conv2d(w.size(1) * self.c.groups, w.size(
-            0), w.shape[2:], stride=self.c.stride, padding=self.c.padding, dilation=self.c.dilation, groups=self.c.groups)
+            0), w.shape[2:], stride=self.c.stride, padding=self.c.padding, dilation=self.c.dilation, groups=self.c.groups,
+            device=c.weight.device, dtype=c.weight.dtype)
         m.weight.data.copy_(w)
         m.bias.data.copy_(b)
         return m
@@ -246,6 +247,7 @@ class Attention(torch.nn.Module):
         self.register_buffer('attention_bias_idxs',
                              torch.LongTensor(idxs).view(N, N),
                              persistent=False)
+        self.use_sdpa = False
 
     @torch.no_grad()
     def train(self, mode=True):
@@ -257,6 +259,12 @@ class Attention(torch.nn.Module):
                                  self.attention_biases[:, self.attention_bias_idxs],
                                  persistent=False)
 
+    @torch.no_grad()
+    def prepare_for_inference(self, use_sdpa=True):
+        """Freeze the attention bias table (with the current weights) and optionally use scaled_dot_product_attention."""
+        self.train(False)
+        self.use_sdpa = use_sdpa and hasattr(F, 'scaled_dot_product_attention')
+
     def forward(self, x):  # x (B,N,C)
         B, N, _ = x.shape
 
@@ -272,6 +280,12 @@ class Attention(torch.nn.Module):
         k = k.permute(0, 2, 1, 3)
         v = v.permute(0, 2, 1, 3)
 
+        if self.use_sdpa and not self.training:
+            x = F.scaled_dot_product_attention(
+                q, k, v, attn_mask=self.ab.to(q.dtype), scale=self.scale)
+            x = x.transpose(1, 2).reshape(B, N, self.dh)
+            return self.proj(x)
+
         attn = (
             (q @ k.transpose(-2, -1)) * self.scale
             +
@@ -597,6 +611,28 @@ class TinyViT(nn.Module):
     def no_weight_decay_keywords(self):
         return {'attention_biases'}
 
+    @torch.no_grad()
+    def prepare_for_inference(self, use_sdpa=True):
+        """
+        Convert the model to a faster, inference-only form: fuse every
+        Conv2d_BN into a single Conv2d, freeze the attention bias tables and
+        switch the attention to scaled_dot_product_attention.
+        The fused model can no longer be trained or load Conv2d_BN weights.
+        """
+        self.eval()
+        placement = {(p.device, p.dtype) for p in self.parameters()}
+        for name, module in list(self.named_modules()):
+            for child_name, child in list(module.named_children()):
+                if isinstance(child, Conv2d_BN):
+                    setattr(module, child_name, child.fuse())
+        # The fused convs must stay where the model was (e.g. prepared after .to('cuda') or .half())
+        if {(p.device, p.dtype) for p in self.parameters()} != placement:
+            raise RuntimeError("prepare_for_inference changed the device or dtype of the parameters")
+        for module in self.modules():
+            if isinstance(module, Attention):
+                module.prepare_for_inference(use_sdpa)
+        return self
+
     def forward_features(self, x):
         # x: (N, C, H, W)
         x = self.patch_embed(x)
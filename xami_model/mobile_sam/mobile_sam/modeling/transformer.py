@@ -6,12 +6,17 @@
 
 import torch
 from torch import Tensor, nn
+from torch.nn import functional as F
 
 import math
 from typing import Tuple, Type
 
 from .common import MLPBlock
 
+# Fused attention kernels (flash / memory-efficient) don't materialize the
+# B x N_heads x N_tokens x N_tokens attention maps. Available from PyTorch 2.0.
+USE_SDPA = hasattr(F, "scaled_dot_product_attention")
+
 
 class TwoWayTransformer(nn.Module):
     def __init__(
@@ -227,13 +232,16 @@ class Attention(nn.Module):
         v = self._separate_heads(v, self.num_heads)
 
         # Attention
-        _, _, _, c_per_head = q.shape
-        attn = q @ k.permute(0, 1, 3, 2)  # B x N_heads x N_tokens x N_tokens
-        attn = attn / math.sqrt(c_per_head)
-        attn = torch.softmax(attn, dim=-1)
+        if USE_SDPA:
+            out = F.scaled_dot_product_attention(q, k, v)
+        else:
+            _, _, _, c_per_head = q.shape
+            attn = q @ k.permute(0, 1, 3, 2)  # B x N_heads x N_tokens x N_tokens
+            attn = attn / math.sqrt(c_per_head)
+            attn = torch.softmax(attn, dim=-1)
 
-        # Get output
-        out = attn @ v
+            # Get output
+            out = attn @ v
         out = self._recombine_heads(out)
         out = self.out_proj(out)
 
@@ -9,7 +9,7 @@ import torch
 
 from ..mobile_sam.modeling import Sam
 
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple, Union
 
 from .utils.transforms import ResizeLongestSide
 
@@ -59,6 +59,38 @@ class SamPredictor:
 
         self.set_torch_image(input_image_torch, image.shape[:2])
 
+    def set_images(
+        self,
+        images: List[np.ndarray],
+        image_format: str = "RGB",
+    ) -> None:
+        """
+        Calculates the image embeddings for several images in a single
+        forward pass of the image encoder. Masks can then be predicted for
+        prompts of any of the images, together, with the 'predict_torch'
+        method and its image_indices argument.
+
+        Arguments:
+          images (list(np.ndarray)): The images for calculating masks, in HWC
+            uint8 format, with pixel values in [0, 255]. They can have
+            different sizes.
+          image_format (str): The color format of the images, in ['RGB', 'BGR'].
+        """
+        assert image_format in [
+            "RGB",
+            "BGR",
+        ], f"image_format must be in ['RGB', 'BGR'], is {image_format}."
+
+        transformed_images = []
+        for image in images:
+            if image_format != self.model.image_format:
+                image = image[..., ::-1]
+            input_image = self.transform.apply_image(image)
+            input_image_torch = torch.as_tensor(input_image, device=self.device)
+            transformed_images.append(input_image_torch.permute(2, 0, 1).contiguous()[None, :, :, :])
+
+        self.set_torch_images(transformed_images, [image.shape[:2] for image in images])
+
     @torch.no_grad()
     def set_torch_image(
         self,
@@ -81,13 +113,38 @@ class SamPredictor:
             and transformed_image.shape[1] == 3
             and max(*transformed_image.shape[2:]) == self.model.image_encoder.img_size
         ), f"set_torch_image input must be BCHW with long side {self.model.image_encoder.img_size}."
+        self.set_torch_images([transformed_image], [original_image_size])
+
+    @torch.no_grad()
+    def set_torch_images(
+        self,
+        transformed_images: List[torch.Tensor],
+        original_image_sizes: List[Tuple[int, ...]],
+    ) -> None:
+        """
+        Batched version of 'set_torch_image': the images are padded to the
+        encoder input size and encoded in a single forward pass.
+
+        Arguments:
+          transformed_images (list(torch.Tensor)): The input images, each with
+            shape 1x3xHxW, transformed with ResizeLongestSide.
+          original_image_sizes (list(tuple(int, int))): The sizes of the
+            images before transformation, in (H, W) format.
+        """
+        for transformed_image in transformed_images:
+            assert (
+                len(transformed_image.shape) == 4
+                and transformed_image.shape[1] == 3
+                and max(*transformed_image.shape[2:]) == self.model.image_encoder.img_size
+            ), f"set_torch_image input must be BCHW with long side {self.model.image_encoder.img_size}."
         self.reset_image()
 
-        self.original_size = original_image_size
-        self.input_size = tuple(transformed_image.shape[-2:])
-        #import pdb; pdb.set_trace()
-        input_image = self.model.preprocess(transformed_image)
-        self.features = self.model.image_encoder(input_image)
+        self.original_sizes = [tuple(size) for size in original_image_sizes]
+        self.input_sizes = [tuple(image.shape[-2:]) for image in transformed_images]
+        self.original_size = self.original_sizes[0]
+        self.input_size = self.input_sizes[0]
+        input_images = torch.cat([self.model.preprocess(image) for image in transformed_images], dim=0)
+        self.features = self.model.image_encoder(input_images)
         self.is_image_set = True
 
     def predict(
@@ -98,6 +155,7 @@ class SamPredictor:
         mask_input: Optional[np.ndarray] = None,
         multimask_output: bool = True,
         return_logits: bool = False,
+        image_index: int = 0,
     ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
         """
         Predict masks for the given input prompts, using the currently set image.
@@ -121,6 +179,8 @@ class SamPredictor:
             input prompts, multimask_output=False can give better results.
           return_logits (bool): If true, returns un-thresholded masks logits
             instead of a binary mask.
+          image_index (int): The image the prompts refer to, when several
+            images were set with 'set_images'.
 
         Returns:
           (np.ndarray): The output masks in CxHxW format, where C is the
@@ -135,17 +195,18 @@ class SamPredictor:
             raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
 
         # Transform input prompts
+        original_size = self.original_sizes[image_index]
         coords_torch, labels_torch, box_torch, mask_input_torch = None, None, None, None
         if point_coords is not None:
             assert (
                 point_labels is not None
             ), "point_labels must be supplied if point_coords is supplied."
-            point_coords = self.transform.apply_coords(point_coords, self.original_size)
+            point_coords = self.transform.apply_coords(point_coords, original_size)
             coords_torch = torch.as_tensor(point_coords, dtype=torch.float, device=self.device)
             labels_torch = torch.as_tensor(point_labels, dtype=torch.int, device=self.device)
             coords_torch, labels_torch = coords_torch[None, :, :], labels_torch[None, :]
         if box is not None:
-            box = self.transform.apply_boxes(box, self.original_size)
+            box = self.transform.apply_boxes(box, original_size)
             box_torch = torch.as_tensor(box, dtype=torch.float, device=self.device)
             box_torch = box_torch[None, :]
         if mask_input is not None:
@@ -159,6 +220,7 @@ class SamPredictor:
             mask_input_torch,
             multimask_output,
             return_logits=return_logits,
+            image_indices=None if self.features.shape[0] == 1 else torch.tensor([image_index], device=self.device),
         )
 
         masks_np = masks[0].detach().cpu().numpy()
@@ -175,7 +237,8 @@ class SamPredictor:
         mask_input: Optional[torch.Tensor] = None,
         multimask_output: bool = True,
         return_logits: bool = False,
-    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        image_indices: Optional[torch.Tensor] = None,
+    ) -> Tuple[Union[torch.Tensor, List[torch.Tensor]], torch.Tensor, torch.Tensor]:
         """
         Predict masks for the given input prompts, using the currently set image.
         Input prompts are batched torch tensors and are expected to already be
@@ -201,10 +264,16 @@ class SamPredictor:
             input prompts, multimask_output=False can give better results.
           return_logits (bool): If true, returns un-thresholded masks logits
             instead of a binary mask.
+          image_indices (torch.Tensor or None): When several images were set
+            with 'set_images', a length B array with the image of each
+            prompt, so that prompts of different images are decoded together.
+            Can be None if a single image is set.
 
         Returns:
           (torch.Tensor): The output masks in BxCxHxW format, where C is the
-            number of masks, and (H, W) is the original image size.
+            number of masks, and (H, W) is the original image size. If the
+            prompts refer to images of different sizes, a list of the B
+            CxHxW masks instead.
           (torch.Tensor): An array of shape BxC containing the model's
             predictions for the quality of each mask.
           (torch.Tensor): An array of shape BxCxHxW, where C is the number
@@ -214,6 +283,9 @@ class SamPredictor:
         if not self.is_image_set:
             raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
 
+        if image_indices is None and self.features.shape[0] > 1:
+            raise ValueError("image_indices must be given when several images are set.")
+
         if point_coords is not None:
             points = (point_coords, point_labels)
         else:
@@ -227,8 +299,9 @@ class SamPredictor:
         )
 
         # Predict masks
+        image_embeddings = self.features if image_indices is None else self.features[image_indices]
         low_res_masks, iou_predictions = self.model.mask_decoder(
-            image_embeddings=self.features,
+            image_embeddings=image_embeddings,
             image_pe=self.model.prompt_encoder.get_dense_pe(),
             sparse_prompt_embeddings=sparse_embeddings,
             dense_prompt_embeddings=dense_embeddings,
@@ -236,18 +309,43 @@ class SamPredictor:
         )
 
         # Upscale the masks to the original image resolution
-        masks = self.model.postprocess_masks(low_res_masks, self.input_size, self.original_size)
+        if image_indices is None:
+            masks = self.model.postprocess_masks(low_res_masks, self.input_size, self.original_size)
+        else:
+            masks = self._postprocess_indexed_masks(low_res_masks, image_indices)
 
         if not return_logits:
-            masks = masks > self.model.mask_threshold
+            if isinstance(masks, list):
+                masks = [mask > self.model.mask_threshold for mask in masks]
+            else:
+                masks = masks > self.model.mask_threshold
 
         return masks, iou_predictions, low_res_masks
 
+    def _postprocess_indexed_masks(
+        self, low_res_masks: torch.Tensor, image_indices: torch.Tensor
+    ) -> Union[torch.Tensor, List[torch.Tensor]]:
+        # Upscale the masks of each image at once, to its own original size
+        indices = image_indices.tolist()
+        upscaled = [None] * len(indices)
+        for index in set(indices):
+            positions = [i for i, image_index in enumerate(indices) if image_index == index]
+            image_masks = self.model.postprocess_masks(
+                low_res_masks[positions], self.input_sizes[index], self.original_sizes[index]
+            )
+            for position, mask in zip(positions, image_masks):
+                upscaled[position] = mask
+
+        if len(set(self.original_sizes[index] for index in indices)) <= 1:
+            return torch.stack(upscaled) if upscaled else low_res_masks
+        return upscaled
+
     def get_image_embedding(self) -> torch.Tensor:
         """
         Returns the image embeddings for the currently set image, with
         shape 1xCxHxW, where C is the embedding dimension and (H,W) are
         the embedding spatial dimension of SAM (typically C=256, H=W=64).
+        With several images set, the shape is BxCxHxW.
         """
         if not self.is_image_set:
             raise RuntimeError(
@@ -264,6 +362,8 @@ class SamPredictor:
         """Resets the currently set image."""
         self.is_image_set = False
         self.features = None
+        self.original_sizes = []
+        self.input_sizes = []
         self.orig_h = None
         self.orig_w = None
         self.input_h = None
@@ -9,8 +9,8 @@ import torch
 
 import math
 from copy import deepcopy
-from itertools import product
-from typing import Any, Dict, Generator, ItemsView, List, Tuple
+from itertools import chain, product
+from typing import Any, Dict, Generator, ItemsView, List, Optional, Tuple
 
 
 class MaskData:
@@ -113,24 +113,30 @@ def mask_to_rle_pytorch(tensor: torch.Tensor) -> List[Dict[str, Any]]:
     b, h, w = tensor.shape
     tensor = tensor.permute(0, 2, 1).flatten(1)
 
-    # Compute change indices
+    # Compute change indices, sorted by mask
     diff = tensor[:, 1:] ^ tensor[:, :-1]
-    change_indices = diff.nonzero()
+    change_indices = diff.nonzero().cpu().numpy()
+    first_values = tensor[:, 0].cpu().numpy()
+
+    # Bounds of the runs of all masks at once: for mask i, 0, its change
+    # indices + 1 and h * w, one mask after the other
+    n_changes = np.bincount(change_indices[:, 0], minlength=b)
+    starts = np.cumsum(n_changes + 2) - (n_changes + 2)
+    ends = starts + n_changes + 1
+    bounds = np.empty(int(n_changes.sum()) + 2 * b, dtype=np.int64)
+    is_change = np.ones(len(bounds), dtype=bool)
+    is_change[starts] = False
+    is_change[ends] = False
+    bounds[starts] = 0
+    bounds[ends] = h * w
+    bounds[is_change] = change_indices[:, 1] + 1
+    run_lengths = np.diff(bounds).tolist()
 
     # Encode run length
     out = []
     for i in range(b):
-        cur_idxs = change_indices[change_indices[:, 0] == i, 1]
-        cur_idxs = torch.cat(
-            [
-                torch.tensor([0], dtype=cur_idxs.dtype, device=cur_idxs.device),
-                cur_idxs + 1,
-                torch.tensor([h * w], dtype=cur_idxs.dtype, device=cur_idxs.device),
-            ]
-        )
-        btw_idxs = cur_idxs[1:] - cur_idxs[:-1]
-        counts = [] if tensor[i, 0] == 0 else [0]
-        counts.extend(btw_idxs.detach().cpu().tolist())
+        counts = [] if first_values[i] == 0 else [0]
+        counts.extend(run_lengths[starts[i] : ends[i]])
         out.append({"size": [h, w], "counts": counts})
     return out
 
@@ -138,19 +144,71 @@ def mask_to_rle_pytorch(tensor: torch.Tensor) -> List[Dict[str, Any]]:
 def rle_to_mask(rle: Dict[str, Any]) -> np.ndarray:
     """Compute a binary mask from an uncompressed RLE."""
     h, w = rle["size"]
-    mask = np.empty(h * w, dtype=bool)
-    idx = 0
-    parity = False
-    for count in rle["counts"]:
-        mask[idx : idx + count] = parity
-        idx += count
-        parity ^= True
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    # Runs alternate between False and True, starting with False
+    parity = (np.arange(len(counts)) % 2).astype(bool)
+    mask = np.repeat(parity, counts)
     mask = mask.reshape(w, h)
     return mask.transpose()  # Put in C order
 
 
+def rles_to_masks(
+    rles: List[Dict[str, Any]], out: Optional[np.ndarray] = None, chunk_size: int = 64
+) -> np.ndarray:
+    """
+    Computes the binary masks of many uncompressed RLEs of the same size
+    into one NxHxW array, decoding chunk_size RLEs per vectorized step.
+
+    Arguments:
+      rles (list(dict)): The uncompressed RLEs.
+      out (np.ndarray or None): A preallocated NxHxW boolean array to decode
+        into. If None, a new array is allocated.
+      chunk_size (int): The number of RLEs decoded at once, which bounds the
+        size of the temporary arrays.
+
+    Returns:
+      (np.ndarray): The NxHxW boolean masks.
+    """
+    if len(rles) == 0:
+        return out if out is not None else np.zeros((0, 0, 0), dtype=bool)
+    h, w = rles[0]["size"]
+    assert all(list(rle["size"]) == [h, w] for rle in rles), "All the RLEs must have the same size."
+    if out is None:
+        out = np.empty((len(rles), h, w), dtype=bool)
+
+    for start in range(0, len(rles), chunk_size):
+        chunk = rles[start : start + chunk_size]
+        lengths = np.array([len(rle["counts"]) for rle in chunk], dtype=np.int64)
+        counts = np.fromiter(
+            chain.from_iterable(rle["counts"] for rle in chunk),
+            dtype=np.int64,
+            count=int(lengths.sum()),
+        )
+        # Index of each run within its RLE, whose parity gives the run value
+        run_index = np.arange(len(counts)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        flat = np.repeat((run_index % 2).astype(bool), counts)
+        out[start : start + len(chunk)] = flat.reshape(len(chunk), w, h).transpose(0, 2, 1)
+    return out
+
+
 def area_from_rle(rle: Dict[str, Any]) -> int:
-    return sum(rle["counts"][1::2])
+    return int(np.sum(rle["counts"][1::2], dtype=np.int64))
+
+
+def areas_from_rles(rles: List[Dict[str, Any]]) -> np.ndarray:
+    """Computes the areas of many uncompressed RLEs at once."""
+    if len(rles) == 0:
+        return np.zeros(0, dtype=np.int64)
+    lengths = np.array([len(rle["counts"]) for rle in rles], dtype=np.int64)
+    counts = np.fromiter(
+        chain.from_iterable(rle["counts"] for rle in rles),
+        dtype=np.int64,
+        count=int(lengths.sum()),
+    )
+    run_index = np.arange(len(counts)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    # The foreground runs are the odd ones
+    rle_index = np.repeat(np.arange(len(rles)), lengths)
+    return np.bincount(rle_index, weights=counts * (run_index % 2), minlength=len(rles)).astype(np.int64)
 
 
 def calculate_stability_score(
@@ -234,6 +292,68 @@ def generate_crop_boxes(
     return crop_boxes, layer_idxs
 
 
+def generate_source_crop_boxes(
+    im_size: Tuple[int, ...], points: np.ndarray, n_layers: int, overlap_ratio: float
+) -> Tuple[List[List[int]], List[int]]:
+    """
+    Generates crop boxes around clusters of source points instead of
+    tiling the whole image. The ith layer uses crops of the same size as
+    generate_crop_boxes, centred on groups of the points: each point not
+    yet covered by a crop of the layer starts a new crop, centred on the
+    mean of the uncovered points within half a crop of it. Empty sky gets
+    no crops beyond the first (whole image) one.
+
+    Arguments:
+      im_size (tuple(int, int)): The image size, in (H, W) format.
+      points (np.ndarray): Nx2 source positions in pixels, in (X, Y) format.
+      n_layers (int): The number of crop layers.
+      overlap_ratio (float): As in generate_crop_boxes, sets the crop sizes.
+    """
+    crop_boxes, layer_idxs = [], []
+    im_h, im_w = im_size
+    short_side = min(im_h, im_w)
+
+    # Original image
+    crop_boxes.append([0, 0, im_w, im_h])
+    layer_idxs.append(0)
+
+    def crop_len(orig_len, n_crops, overlap):
+        return int(math.ceil((overlap * (n_crops - 1) + orig_len) / n_crops))
+
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    for i_layer in range(n_layers):
+        n_crops_per_side = 2 ** (i_layer + 1)
+        overlap = int(overlap_ratio * short_side * (2 / n_crops_per_side))
+        crop_w = crop_len(im_w, n_crops_per_side, overlap)
+        crop_h = crop_len(im_h, n_crops_per_side, overlap)
+
+        covered = np.zeros(len(points), dtype=bool)
+        for i in np.argsort(points[:, 1] * im_w + points[:, 0], kind="stable"):
+            if covered[i]:
+                continue
+            near = (
+                ~covered
+                & (np.abs(points[:, 0] - points[i, 0]) <= crop_w / 2)
+                & (np.abs(points[:, 1] - points[i, 1]) <= crop_h / 2)
+            )
+            cx, cy = points[near].mean(axis=0)
+            x0 = int(min(max(round(cx - crop_w / 2), 0), im_w - crop_w))
+            y0 = int(min(max(round(cy - crop_h / 2), 0), im_h - crop_h))
+            box = [x0, y0, min(x0 + crop_w, im_w), min(y0 + crop_h, im_h)]
+            covered |= (
+                (points[:, 0] >= box[0])
+                & (points[:, 0] < box[2])
+                & (points[:, 1] >= box[1])
+                & (points[:, 1] < box[3])
+            )
+            # The centred box always holds the point that started it
+            covered[i] = True
+            crop_boxes.append(box)
+            layer_idxs.append(i_layer + 1)
+
+    return crop_boxes, layer_idxs
+
+
 def uncrop_boxes_xyxy(boxes: torch.Tensor, crop_box: List[int]) -> torch.Tensor:
     x0, y0, _, _ = crop_box
     offset = torch.tensor([[x0, y0, x0, y0]], device=boxes.device)
@@ -300,6 +420,23 @@ def coco_encode_rle(uncompressed_rle: Dict[str, Any]) -> Dict[str, Any]:
     return rle
 
 
+def masks_to_rles(masks: np.ndarray) -> List[Dict[str, Any]]:
+    """
+    Encodes binary masks as COCO RLEs with string counts, which can be
+    serialized to JSON.
+
+    Arguments:
+      masks (np.ndarray): NxHxW boolean masks.
+
+    Returns:
+      list(dict(str, any)): N dicts {"size": [H, W], "counts": str}.
+    """
+    if len(masks) == 0:
+        return []
+    masks = torch.from_numpy(np.ascontiguousarray(masks))
+    return [coco_encode_rle(rle) for rle in mask_to_rle_pytorch(masks)]
+
+
 def batched_mask_to_box(masks: torch.Tensor) -> torch.Tensor:
     """
     Calculates boxes in XYXY format around masks. Return [0,0,0,0] for
@@ -0,0 +1,237 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import copy
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.ao import quantization as tq
+
+from typing import Any, Callable, Dict, List, Optional
+
+from ..modeling import Sam
+
+QUANTIZATION_MODES = ("dynamic", "static")
+
+
+class _QuantizedLinearWrapper(nn.Module):
+    """
+    Wraps an nn.Linear between quantization stubs so that eager mode static
+    quantization converts it to a quantized linear with float inputs/outputs.
+    """
+
+    def __init__(self, linear: nn.Linear) -> None:
+        super().__init__()
+        self.quant = tq.QuantStub()
+        self.linear = linear
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.dequant(self.linear(self.quant(x)))
+
+
+def _quantizable_modules(sam: Sam) -> List[nn.Module]:
+    # The image encoder (TinyViT attention and MLPs) and the mask decoder (its
+    # TwoWayTransformer, output hypernetwork and IoU head MLPs). The prompt
+    # encoder has no linear layers.
+    return [sam.image_encoder, sam.mask_decoder]
+
+
+def _wrap_linear_layers(module: nn.Module) -> None:
+    for name, child in list(module.named_children()):
+        if isinstance(child, nn.Linear):
+            setattr(module, name, _QuantizedLinearWrapper(child))
+        else:
+            _wrap_linear_layers(child)
+
+
+def _default_boxes(image_shape) -> np.ndarray:
+    # The whole image and its four quadrants, in XYXY format
+    h, w = image_shape[:2]
+    return np.array(
+        [
+            [0, 0, w, h],
+            [0, 0, w // 2, h // 2],
+            [w // 2, 0, w, h // 2],
+            [0, h // 2, w // 2, h],
+            [w // 2, h // 2, w, h],
+        ],
+        dtype=np.float32,
+    )
+
+
+@torch.no_grad()
+def predict_box_masks(
+    sam: Sam,
+    images: List[np.ndarray],
+    boxes: Optional[List[np.ndarray]] = None,
+    preprocess: Optional[Callable[[Sam, np.ndarray], torch.Tensor]] = None,
+) -> List[np.ndarray]:
+    """
+    Predicts one binary mask per box for each image, the way SamPredictor is
+    used at inference time.
+
+    Arguments:
+      sam (Sam): The model.
+      images (list(np.ndarray)): HWC uint8 images, in RGB format, or in the
+        format expected by preprocess.
+      boxes (list(np.ndarray) or None): For each image, an Nx4 array of XYXY
+        boxes in the original image frame. If None, the whole image and its
+        four quadrants are used.
+      preprocess (callable or None): preprocess(sam, image) returns the
+        1x3xSxS image encoder input of an image, for models used with another
+        normalization than SamPredictor.set_image (which is used if None).
+
+    Returns:
+      (list(np.ndarray)): For each image, the NxHxW boolean masks.
+    """
+    from ..predictor import SamPredictor
+
+    predictor = SamPredictor(sam)
+    all_masks = []
+    for i, image in enumerate(images):
+        image_boxes = boxes[i] if boxes is not None else _default_boxes(image.shape)
+        if preprocess is None:
+            predictor.set_image(image)
+        else:
+            predictor.reset_image()
+            predictor.original_sizes = [tuple(image.shape[:2])]
+            predictor.input_sizes = [
+                predictor.transform.get_preprocess_shape(
+                    image.shape[0], image.shape[1], sam.image_encoder.img_size
+                )
+            ]
+            predictor.original_size = predictor.original_sizes[0]
+            predictor.input_size = predictor.input_sizes[0]
+            predictor.features = sam.image_encoder(preprocess(sam, image))
+            predictor.is_image_set = True
+        transformed_boxes = predictor.transform.apply_boxes_torch(
+            torch.as_tensor(image_boxes, dtype=torch.float, device=predictor.device),
+            image.shape[:2],
+        )
+        masks, _, _ = predictor.predict_torch(
+            point_coords=None,
+            point_labels=None,
+            boxes=transformed_boxes,
+            multimask_output=False,
+        )
+        all_masks.append(masks[:, 0].cpu().numpy())
+    return all_masks
+
+
+def mask_iou_drift(
+    reference_masks: List[np.ndarray], masks: List[np.ndarray]
+) -> Dict[str, Any]:
+    """
+    Compares the masks of a quantized model with those of the fp32 model.
+
+    Returns:
+      (dict): The mean, minimum and per image mean mask IoU. Boxes for which
+        both masks are empty count as an IoU of 1.
+    """
+    ious = []
+    per_image = []
+    for ref, pred in zip(reference_masks, masks):
+        ref = ref.reshape(len(ref), -1)
+        pred = pred.reshape(len(pred), -1)
+        intersection = np.logical_and(ref, pred).sum(axis=1)
+        union = np.logical_or(ref, pred).sum(axis=1)
+        image_ious = np.where(union > 0, intersection / np.maximum(union, 1), 1.0)
+        ious.append(image_ious)
+        per_image.append(float(image_ious.mean()) if len(image_ious) else 1.0)
+    ious = np.concatenate(ious) if ious else np.ones(0)
+    return {
+        "mean_iou": float(ious.mean()) if len(ious) else 1.0,
+        "min_iou": float(ious.min()) if len(ious) else 1.0,
+        "per_image_mean_iou": per_image,
+    }
+
+
+def quantize_sam(
+    sam: Sam,
+    mode: str = "dynamic",
+    calibration_images: Optional[List[np.ndarray]] = None,
+    calibration_boxes: Optional[List[np.ndarray]] = None,
+    backend: Optional[str] = None,
+    inplace: bool = False,
+    verbose: bool = True,
+    preprocess: Optional[Callable[[Sam, np.ndarray], torch.Tensor]] = None,
+) -> Sam:
+    """
+    Quantizes the linear layers of the image encoder and mask decoder to int8
+    for CPU inference.
+
+    Arguments:
+      sam (Sam): The fp32 model.
+      mode (str): 'dynamic' quantizes the weights ahead of time and the
+        activations on the fly. 'static' also fixes the activation ranges with
+        a calibration pass over calibration_images.
+      calibration_images (list(np.ndarray) or None): HWC uint8 images, in
+        the format of predict_box_masks. Required for 'static'. When given,
+        the mask IoU of the quantized model against the fp32 model on these
+        images is reported.
+      calibration_boxes (list(np.ndarray) or None): Box prompts per image for
+        the calibration and the drift report, see predict_box_masks.
+      backend (str or None): The quantized engine, e.g. 'x86', 'fbgemm' or
+        'qnnpack'. Defaults to the current torch.backends.quantized.engine.
+      inplace (bool): Quantize sam itself instead of a copy. The drift report
+        needs the fp32 model, so it is skipped when inplace is True.
+      verbose (bool): Print the drift report.
+      preprocess (callable or None): Builds the image encoder input of the
+        calibration images, see predict_box_masks. It should match the
+        preprocessing used at inference, so that the activation ranges and
+        the drift are measured on the inputs the model will see.
+
+    Returns:
+      (Sam): The quantized model, on CPU and in eval mode. If calibration
+        images were given, the drift report is stored in its
+        quantization_report attribute.
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization mode {mode}, expected one of {QUANTIZATION_MODES}.")
+    if mode == "static" and not calibration_images:
+        raise ValueError("Static quantization needs calibration_images.")
+
+    if backend is not None:
+        torch.backends.quantized.engine = backend
+    engine = torch.backends.quantized.engine
+
+    reference = sam.to("cpu").eval()
+    model = reference if inplace else copy.deepcopy(reference)
+
+    if mode == "dynamic":
+        for module in _quantizable_modules(model):
+            tq.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    else:
+        qconfig = tq.get_default_qconfig(engine)
+        for module in _quantizable_modules(model):
+            _wrap_linear_layers(module)
+            for submodule in module.modules():
+                if isinstance(submodule, _QuantizedLinearWrapper):
+                    submodule.qconfig = qconfig
+            tq.prepare(module, inplace=True)
+        # Calibration pass to record the activation ranges
+        predict_box_masks(model, calibration_images, calibration_boxes, preprocess)
+        for module in _quantizable_modules(model):
+            tq.convert(module, inplace=True)
+    model.eval()
+
+    if calibration_images and not inplace:
+        report = mask_iou_drift(
+            predict_box_masks(reference, calibration_images, calibration_boxes, preprocess),
+            predict_box_masks(model, calibration_images, calibration_boxes, preprocess),
+        )
+        report["mode"] = mode
+        report["engine"] = engine
+        model.quantization_report = report
+        if verbose:
+            print(
+                f"Int8 {mode} quantization ({engine}): mask IoU vs fp32 "
+                f"mean {report['mean_iou']:.4f}, min {report['min_iou']:.4f} "
+                f"over {len(calibration_images)} images."
+            )
+
+    return model
@@ -1,26 +1,28 @@
 import numpy as np
 import cv2
-from PIL import Image
-import supervision as sv
-import matplotlib.pyplot as plt
 import torch
-from torchvision.transforms.functional import resize
 from typing import List, Dict, Any, Optional, Tuple
 import torch.nn as nn
 import numpy as np
-from scipy.optimize import linear_sum_assignment
 import os
 import re
+import hashlib
+from collections import OrderedDict
 from ..dataset import dataset_utils
-from ..losses import loss_utils
+from ..losses import loss_utils, metrics_utils
 
-def transform_image(model, transform, image, k, device):
+def transform_image(model, transform, image, k, device, pixel_stats=None):
     
+    from torchvision.transforms.functional import resize
     image_tensor = torch.from_numpy(image).to(device).float()  
-    mask_nonzero = image_tensor > 0
-    image_nonzero = image_tensor[mask_nonzero]
-    mean_ = image_nonzero.mean()
-    std_ = image_nonzero.std()
+    if pixel_stats is None:
+        mask_nonzero = image_tensor > 0
+        image_nonzero = image_tensor[mask_nonzero]
+        mean_ = image_nonzero.mean()
+        std_ = image_nonzero.std()
+    else:
+        # precomputed (mean, std) of the non-zero pixels, e.g. from a packed dataset
+        mean_, std_ = (torch.tensor(stat, dtype=torch.float32, device=device) for stat in pixel_stats)
     model.register_buffer("pixel_mean", mean_.repeat((3, 1, 1)), persistent=False)
     model.register_buffer("pixel_std", std_.repeat((3, 1, 1)), persistent=False)
     negative_mask = (image_tensor > 0).to(torch.float32)
@@ -188,52 +190,27 @@ def compute_iou(mask1, mask2):
     iou_score = np.sum(intersection) / np.sum(union) if np.sum(union) > 0 else 0
     return iou_score
 
-def compute_metrics(gt_masks, pred_masks, iou_threshold, image=None):
+def compute_metrics(gt_masks, pred_masks, iou_threshold, image=None, backend='numpy', device=None):
     """Compute the True Positive, False Positive, and False Negative BINARY masks for multiple segmentations."""
     
-    # if image is not None:
-    #     plt.imshow(image)
-    #     for mask in gt_masks:
-    #         dataset_utils.show_mask(mask[0], plt.gca())
-    #     plt.show()
-    #     plt.close()
-    
-    #     plt.imshow(image)
-    #     for mask in pred_masks:
-    #         dataset_utils.show_mask(mask, plt.gca())
-    #     plt.show()
-    #     plt.close()
-        
-    combined_gt_mask = np.zeros_like(gt_masks[0][0], dtype=bool)
-    combined_pred_mask = np.zeros_like(pred_masks[0], dtype=bool)
-    filtered_pred_masks = np.zeros_like(pred_masks, dtype=bool)
-    
     # print(gt_masks.shape, pred_masks.shape) # (N, 1, H, W), (N, H, W)
-    for i, pred_mask in enumerate(pred_masks):
-        max_iou = 0  # Max IoU for this pred_mask with any gt_mask
-        for gt_mask in gt_masks:
-            intersection = np.logical_and(gt_mask[0], pred_mask)
-            union = np.logical_or(gt_mask[0], pred_mask)
-            iou_score = np.sum(intersection) / np.sum(union) if np.sum(union) > 0 else 0
-            max_iou = max(max_iou, iou_score)  
-
-        if max_iou > iou_threshold: # take IoUs above threshold
-            filtered_pred_masks[i] = pred_mask
+    pred_masks = metrics_utils.to_bool_masks(pred_masks, backend, device)
+    keep = metrics_utils.filter_masks_by_iou(gt_masks, pred_masks, iou_threshold, backend, device)
 
-    for gt_mask in gt_masks:
-        combined_gt_mask = np.logical_or(combined_gt_mask, gt_mask)
+    combined_gt_mask = metrics_utils.union_mask(gt_masks, backend, device)
+    combined_pred_mask = metrics_utils.union_mask(pred_masks[keep], backend, device) # only the filtered pred masks
+    if combined_pred_mask is None:
+        combined_pred_mask = pred_masks[0] & False
 
-    for pred_mask in filtered_pred_masks:
-        combined_pred_mask = np.logical_or(combined_pred_mask, pred_mask.astype(bool))
-
-    true_positive_mask = np.logical_and(combined_gt_mask, combined_pred_mask)
-    false_negative_mask = np.logical_and(combined_gt_mask, np.logical_not(combined_pred_mask))
-    false_positive_mask = np.logical_and(combined_pred_mask, np.logical_not(combined_gt_mask))
+    true_positive_mask = combined_gt_mask & combined_pred_mask
+    false_negative_mask = combined_gt_mask & ~combined_pred_mask
+    false_positive_mask = combined_pred_mask & ~combined_gt_mask
 
     return true_positive_mask, false_positive_mask, false_negative_mask
 
 def instance_segmentation_loss(pred_masks, gt_masks):
 
+    from scipy.optimize import linear_sum_assignment
     pred_masks = [torch.tensor(mask, dtype=torch.float32) for mask in pred_masks]
     gt_masks = [torch.tensor(mask, dtype=torch.float32) for mask in gt_masks]
 
@@ -286,6 +263,10 @@ def instance_segmentation_loss(pred_masks, gt_masks):
 
 def amg_predict(any_sam_model, AMG, data_set_gt_masks, model_name,  IMAGE_PATH, use_negative=None, mask_on_negative=False, show_plot=False):
     
+    from PIL import Image
+    import supervision as sv
+    import matplotlib.pyplot as plt
+    from torchvision.transforms.functional import resize
     image_name = IMAGE_PATH.split("/")[-1]
     predicted_masks = []
     gt_image_masks = np.array([mask for key, mask in data_set_gt_masks.items() if key.startswith(image_name)])
@@ -383,24 +364,32 @@ def amg_predict(any_sam_model, AMG, data_set_gt_masks, model_name,  IMAGE_PATH,
             plt.close()
     return annotated_image, iou_assoc_loss
 
-def SAM_predictor(AMG, sam, IMAGE_PATH, mask_on_negative = None, img_grid_points=None):
+def SAM_predictor(AMG, sam, IMAGE_PATH, mask_on_negative = None, img_grid_points=None, source_centers=None):
     """
     This function infers the SAM (Segment Anything) and returns the annnotated image. 
     
     Args:
         IMAGE_PATH (str): The path to the image file.
         remove_masks_on_negative (bool, optional): If True, masks on negative detections are removed.
+        source_centers (list, optional): Normalized source centres, as returned by astronomy_utils.get_normalized_centers.
+            If given, SAM is prompted with the sources (plus a sparse background grid) instead of a dense point grid.
 
     Returns:
         tuple: A tuple containing the original image and the annotated image.
     """
+    import supervision as sv
     
     image_bgr = cv2.imread(IMAGE_PATH)
     image_rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB) # (H, W, C)
 
     annotated_image = None
     mask_generator = AMG(sam, points_per_side=None, point_grids=img_grid_points) if img_grid_points is not None else AMG(sam)
-    sam_result = mask_generator.generate(image_rgb)
+    if source_centers is not None:
+        # Undo the normalization of get_normalized_centers, which divides x by shape[0]-1 and y by shape[1]-1
+        source_points = np.array(source_centers, dtype=float).reshape(-1, 2) * (np.array(image_rgb.shape[:2]) - 1)
+        sam_result = mask_generator.generate(image_rgb, source_points=source_points)
+    else:
+        sam_result = mask_generator.generate(image_rgb)
     if mask_on_negative is not None:
         sam_result = remove_masks(sam_result=sam_result, 
                                             mask_on_negative=mask_on_negative, 
@@ -448,6 +437,8 @@ def MobileSAM_predict(image_path: str,
     - The prediction process involves normalizing the image based on its pixel mean and standard deviation.
     - The `mask_on_negative` parameter allows for further processing to remove certain masks based on the provided negative mask.
     """
+    from PIL import Image
+    import supervision as sv
     image = cv2.imread(image_path)
     image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB) # (H, W, C)
 
@@ -487,17 +478,75 @@ def MobileSAM_predict(image_path: str,
 
     return image, model_result
 
-def process_faint_masks(image, pred_masks, yolo_masks, predicted_classes, device, wt_threshold=0.6, wt_classes=[1.0, 4.0]):
-    wt_mask, _ = dataset_utils.isolate_background(image[:, :, 0], decomposition='db1', level=2, sigma=1)
-    wt_mask = torch.from_numpy(wt_mask).to(device)  # Ensure wavelet mask is on GPU
-
-    for i, low_res_mask in enumerate(pred_masks):
-        thresholded_mask = (low_res_mask > 0.5).to(torch.float32)
-        sum_thresholded_mask = torch.clamp(thresholded_mask.sum(), min=1)  # Avoid division by zero
-        wt_on_mask = wt_mask * thresholded_mask / sum_thresholded_mask
-        wt_count = wt_on_mask.sum()
-        if wt_count > wt_threshold and predicted_classes[i] in wt_classes:
-            pred_masks[i] = torch.from_numpy(yolo_masks[i]).float().to(device).unsqueeze(0)
+_wavelet_mask_cache = OrderedDict() # image digest -> wavelet background mask
+
+def wavelet_background_mask(image, device=None, cache_size=8):
+    """
+    Compute (or fetch from a small LRU cache) the wavelet background mask of an image, as used by process_faint_masks.
+
+    Args:
+    - image (np.ndarray): Image of shape (H, W, C); the mask is computed on the first channel.
+    - device (torch.device, optional): If given, the mask is returned as a float tensor on this device.
+    - cache_size (int): Number of image masks kept in the cache.
+
+    Returns:
+    - The (H, W) background mask.
+    """
+    channel = np.ascontiguousarray(image[:, :, 0])
+    key = hashlib.sha1(channel.tobytes()).hexdigest() + str(channel.shape) + str(channel.dtype)
+    
+    if key in _wavelet_mask_cache:
+        _wavelet_mask_cache.move_to_end(key)
+        wt_mask = _wavelet_mask_cache[key]
+    else:
+        wt_mask, _ = dataset_utils.isolate_background(channel, decomposition='db1', level=2, sigma=1)
+        _wavelet_mask_cache[key] = wt_mask
+        if len(_wavelet_mask_cache) > cache_size:
+            _wavelet_mask_cache.popitem(last=False)
+    
+    if device is not None:
+        return torch.from_numpy(wt_mask).to(device=device, dtype=torch.float32)
+    return wt_mask
+
+def process_faint_masks(image, pred_masks, yolo_masks, predicted_classes, device, wt_threshold=0.6, wt_classes=[1.0, 4.0], wt_mask=None):
+    """
+    Replace the predicted masks of faint sources by the detector (YOLO) masks.
+
+    A mask is replaced when its class is in wt_classes and the fraction of its pixels lying on the 
+    wavelet background mask of the image is above wt_threshold.
+
+    Args:
+    - image (np.ndarray): The image, used to compute the wavelet background mask if wt_mask is not given.
+    - pred_masks (torch.Tensor or list): Predicted masks, [N, 1, H, W] (or a list of N [1, H, W] masks).
+    - yolo_masks (list): N YOLO masks of shape (H, W).
+    - predicted_classes: The N predicted classes.
+    - wt_mask (torch.Tensor, optional): Precomputed background mask (see wavelet_background_mask).
+
+    Returns:
+    - pred_masks (torch.Tensor): The [N, 1, H, W] masks, with the faint masks replaced.
+    """
+    if len(pred_masks) == 0:
+        return pred_masks
+    if wt_mask is None:
+        wt_mask = wavelet_background_mask(image, device)
+    wt_mask = torch.as_tensor(wt_mask, device=device).to(torch.float32)
+    
+    if not isinstance(pred_masks, torch.Tensor):
+        pred_masks = torch.stack(list(pred_masks))
+    num_masks = pred_masks.shape[0]
+    
+    # Fraction of each thresholded mask on the background, for all masks at once
+    thresholded_masks = (pred_masks.detach() > 0.5).to(torch.float32).reshape(num_masks, -1)
+    sum_thresholded_masks = torch.clamp(thresholded_masks.sum(dim=1), min=1)  # Avoid division by zero
+    wt_counts = (thresholded_masks @ wt_mask.reshape(-1)) / sum_thresholded_masks
+    
+    classes = torch.tensor([float(c) for c in predicted_classes], device=wt_counts.device)
+    is_wt_class = torch.isin(classes, torch.tensor(wt_classes, dtype=classes.dtype, device=classes.device))
+    replace_indices = torch.nonzero((wt_counts > wt_threshold) & is_wt_class).flatten().tolist()
+    
+    if len(replace_indices) > 0:
+        replacements = torch.from_numpy(np.stack([np.asarray(yolo_masks[i]) for i in replace_indices])).float().to(device)
+        pred_masks[replace_indices] = replacements.reshape((len(replace_indices),) + tuple(pred_masks.shape[1:])).to(pred_masks.dtype)
             
     return pred_masks
 
@@ -582,18 +631,93 @@ def compute_indiv_metrics(pred_mask, gt_mask, iou_threshold=0.5):
     }
     return metrics
 
+class MaskScoreAccumulator:
+    """
+    Accumulates per-mask IoU and TP/FP/FN pixel counts for aligned predicted and ground truth masks.
+    
+    The counts are computed once per mask pair, batched and on the device of the masks, so that precision, 
+    recall, F1 score and accuracy can then be derived at every IoU threshold without revisiting the masks.
+    Metrics follow the same definitions as `compute_indiv_metrics`.
+    """
+    metric_names = ('iou', 'precision', 'recall', 'f1_score', 'accuracy')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._stats = [] # per-update tensors of shape [N, 5]: (iou, tp, fp, fn, gt_area)
+
+    @torch.no_grad()
+    def update(self, pred_masks, gt_masks):
+        """
+        Add the statistics of one image.
+
+        Args:
+        - pred_masks (torch.Tensor | np.ndarray): Predicted masks of shape [N, 1, H, W] or [N, H, W].
+        - gt_masks (torch.Tensor | np.ndarray): Ground truth masks of shape [N, H, W], aligned with pred_masks.
+        """
+        gt_masks = torch.as_tensor(gt_masks)
+        pred_masks = torch.as_tensor(pred_masks, device=gt_masks.device)
+        num_masks = gt_masks.shape[0]
+        if num_masks == 0:
+            return
+        
+        pred_flat = pred_masks[:num_masks].reshape(num_masks, -1) != 0
+        gt_flat = gt_masks.reshape(num_masks, -1) != 0
+
+        pred_area = pred_flat.sum(dim=1)
+        gt_area = gt_flat.sum(dim=1)
+        true_positive = (pred_flat & gt_flat).sum(dim=1)
+        union = pred_area + gt_area - true_positive
+        iou = torch.where(union > 0, true_positive.double() / union.clamp(min=1).double(), torch.zeros_like(union, dtype=torch.float64))
+
+        self._stats.append(torch.stack([
+            iou, 
+            true_positive.double(), 
+            (pred_area - true_positive).double(), 
+            (gt_area - true_positive).double(), 
+            gt_area.double()], dim=1))
+
+    def compute(self, thresholds):
+        """
+        Derive the metrics at all IoU thresholds from the accumulated statistics.
+
+        Args:
+        - thresholds (list[float]): IoU thresholds. A mask pair below the threshold scores 0 for every metric but IoU.
+
+        Returns:
+        - dict: {metric_name: (means, stds)} with one value per threshold for each metric in `metric_names`.
+        """
+        thresholds = np.asarray(thresholds, dtype=np.float64)
+        if len(self._stats) > 0:
+            stats = torch.cat(self._stats, dim=0).cpu().numpy()
+        else:
+            stats = np.zeros((0, 5))
+        iou, tp, fp, fn, gt_area = stats.T
+
+        def safe_divide(a, b):
+            return np.divide(a, b, out=np.zeros_like(a), where=b > 0)
+
+        precision = safe_divide(tp, tp + fp)
+        recall = safe_divide(tp, tp + fn)
+        f1 = safe_divide(2 * precision * recall, precision + recall)
+        accuracy = safe_divide(tp, gt_area)
+
+        above_threshold = iou[None, :] >= thresholds[:, None] # [T, N]
+        results = {}
+        for metric_name, values in zip(self.metric_names, (iou, precision, recall, f1, accuracy)):
+            if metric_name == 'iou':
+                per_threshold = np.broadcast_to(values, above_threshold.shape)
+            else:
+                per_threshold = np.where(above_threshold, values[None, :], 0.0)
+            results[metric_name] = (np.mean(per_threshold, axis=1), np.std(per_threshold, axis=1))
+            
+        return results
+
 def compute_scores(metric_name, all_pred_masks, all_gt_masks, thresholds):
-    means = []
-    stds = []
-    for threshold in thresholds:
-        all_metrics = []
-        for i, (pred_mask, gt_mask) in enumerate(zip(all_pred_masks, all_gt_masks)):
-            for mask_i in range(gt_mask.shape[0]):
-                metrics = compute_indiv_metrics(pred_mask[mask_i].detach().cpu().numpy(), gt_mask[mask_i].detach().cpu().numpy(), iou_threshold=threshold)
-                if metrics is not None:
-                    all_metrics.append(metrics)
-        values = [m[metric_name] for m in all_metrics]
-        means.append(np.mean(values))
-        stds.append(np.std(values))
-    
-    return metric_name, np.array(means), np.array(stds)
\ No newline at end of file
+    accumulator = MaskScoreAccumulator()
+    for pred_mask, gt_mask in zip(all_pred_masks, all_gt_masks):
+        accumulator.update(pred_mask, gt_mask)
+    means, stds = accumulator.compute(thresholds)[metric_name]
+    
+    return metric_name, means, stds
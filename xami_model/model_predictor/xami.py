@@ -1,16 +1,11 @@
-from pyparsing import with_class
 import torch
 import numpy as np
 from tqdm import tqdm
-from pycocotools import mask as maskUtils
-import matplotlib.pyplot as plt
 import cv2
 import torch.nn as nn
-from segment_anything.utils.transforms import ResizeLongestSide
-import matplotlib.patches as patches
+from ..mobile_sam.mobile_sam.utils.transforms import ResizeLongestSide
 import random 
 import torch.nn.functional as F
-import albumentations as A
 
 from ..losses import loss_utils
 from ..dataset import dataset_utils
@@ -36,6 +31,7 @@ class XAMI:
         wt_classes_ids=None, 
         apply_segm_CR=False,
         residualAttentionBlock=None):
+        import albumentations as A
         
         self.model = model
         self.device = device
@@ -65,6 +61,7 @@ class XAMI:
         input_image, 
         cr_transforms=[], 
         show_plot=True):
+        from pycocotools import mask as maskUtils
 
         boxes = []
         gt_rle_to_masks, mask_areas = [], []
@@ -129,13 +126,13 @@ class XAMI:
                 image_loss += cr_loss
      
         # del threshold_masks
-        del iou_predictions, pred_masks
+        del pred_masks
         # del gt_threshold_masks
         del rle_to_mask
         torch.cuda.empty_cache()
         
         if mode == 'validate':
-            return image_loss, gt_threshold_masks, threshold_masks>0.5
+            return image_loss, gt_threshold_masks, threshold_masks>0.5, iou_predictions.detach()
 
         return image_loss
     
@@ -250,7 +247,22 @@ class XAMI:
         mode,
         cr_transforms=[],
         scheduler=None,
+        score_accumulator=None,
+        image_reader=None,
+        map_evaluator=None,
+        gt_classes=None,
         ):
+        """
+        Runs one training or validation epoch over the dataloader.
+
+        In 'validate' mode the predicted and GT masks are returned for evaluation. If a 
+        `predictor_utils.MaskScoreAccumulator` is given as `score_accumulator`, the masks are 
+        accumulated into it instead and the returned mask lists are empty. If a `metrics_utils.StreamingMAP` 
+        is given as `map_evaluator`, each image's masks are also streamed into it, with their classes 
+        from `gt_classes` and the SAM IoU predictions as scores.
+        The images are read from `input_dir`, unless an `image_reader` (image_id -> BGR image, 
+        e.g. `PackedImageDataset.read_image`) is given.
+        """
         
         assert mode in ['train', 'validate'], "Mode must be 'train' or 'validate'"
         losses = []
@@ -264,7 +276,7 @@ class XAMI:
             for i in range(batch_size):
                 image_masks = [k for k in gt_masks.keys() if k.startswith(inputs['image_id'][i])]
                 input_image = torch.as_tensor(inputs['image'][i], dtype=torch.float, device=self.predictor.device) # (B, C, 1024, 1024)
-                image = cv2.imread(input_dir+inputs['image_id'][i])
+                image = image_reader(inputs['image_id'][i]) if image_reader is not None else cv2.imread(input_dir+inputs['image_id'][i])
                 original_image_size = image.shape[:-1]
                 input_size = (1024, 1024)
                 
@@ -274,7 +286,7 @@ class XAMI:
                 # RUN PREDICTION ON IMAGE
                 if len(image_masks)>0:
                     if mode == 'validate':
-                        image_loss, gt_threshold_masks, pred_masks = self.one_image_predict(
+                        image_loss, gt_threshold_masks, pred_masks, iou_predictions = self.one_image_predict(
                             mode, 
                             image_masks, 
                             gt_masks, 
@@ -285,8 +297,20 @@ class XAMI:
                             image, 
                             cr_transforms)
                         batch_loss = batch_loss+image_loss
-                        all_gt_masks.append(gt_threshold_masks)
-                        all_pred_masks.append(pred_masks)
+                        if score_accumulator is not None:
+                            score_accumulator.update(pred_masks, gt_threshold_masks)
+                        else:
+                            all_gt_masks.append(gt_threshold_masks)
+                            all_pred_masks.append(pred_masks)
+                        if map_evaluator is not None:
+                            # The prompts are the GT boxes, so each predicted mask has the class of its GT mask
+                            image_classes = [gt_classes[k] for k in image_masks]
+                            map_evaluator.update(
+                                pred_masks.cpu().numpy(), 
+                                gt_threshold_masks.cpu().numpy(), 
+                                image_classes, 
+                                image_classes, 
+                                iou_predictions.cpu().numpy())
                         all_image_ids.append(inputs['image_id'][i])
                     if mode == 'train':
                         batch_loss = batch_loss+(self.one_image_predict(mode, image_masks, gt_masks, gt_bboxes, image_embedding, 
@@ -321,7 +345,12 @@ class XAMI:
         image_files, 
         images_dir, 
         num_batches, 
-        optimizer=None):
+        optimizer=None,
+        map_evaluator=None):
+        """
+        Runs one detector+SAM epoch. If a `metrics_utils.StreamingMAP` is given as `map_evaluator`, 
+        each image's matched masks are streamed into it and are not buffered in the returned preds/gts lists.
+        """
         assert phase in ['train', 'val'], "Phase must be 'train' or 'val'"
         
         if phase == 'train':
@@ -408,8 +437,16 @@ class XAMI:
                     
                 # ious, iou_image_loss = predictor_utils.calculate_iou_loss(np.array(preds), np.array(gts), ious_match, mask_areas)
                 threshold_preds = np.array([preds[i][0]>0.5*1 for i in range(len(preds))])
-                all_preds.append(threshold_preds)
-                all_gts.append(gts)
+                if map_evaluator is not None:
+                    map_evaluator.update(
+                        threshold_preds, 
+                        [gt[0] for gt in gts], 
+                        pred_classes_match, 
+                        gt_classes_match, 
+                        [iou[0] for iou in ious_match])
+                else:
+                    all_preds.append(threshold_preds)
+                    all_gts.append(gts)
                 all_gt_cls.append(gt_classes_match)
                 all_pred_cls.append(pred_classes_match)
                 all_iou_scores.append(ious_match)
@@ -0,0 +1,265 @@
+"""
+Local HTTP inference server for XAMI.
+
+Loads the detector and SAM once and serves predictions over HTTP. Concurrent requests are coalesced into
+micro-batches, so that the detector and the SAM image encoder run once per batch instead of once per request.
+
+    python -m xami_model.serve --detr-checkpoint rtdetr.pt --sam-checkpoint mobile_sam.pt --device cuda:0
+
+Endpoints:
+  POST /predict   An encoded image (PNG, JPEG...) as the request body, or a JSON body {"path": "/path/to/image.png"}.
+                  The detector confidence can be passed as ?conf=0.3 (or "conf" in the JSON body).
+                  Returns {"masks": [COCO RLE, ...], "classes": [...], "class_names": [...], "scores": [...], "boxes": [...]}.
+  GET  /health    Liveness and model information.
+  GET  /metrics   Request, batch and latency counters in the Prometheus text format.
+"""
+import argparse
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import cv2
+import numpy as np
+import torch
+
+from .mobile_sam.mobile_sam.utils.amg import masks_to_rles
+
+class ServerMetrics:
+    """Thread-safe counters exposed by the /metrics endpoint."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.batched_images = 0
+        self.max_batch_size = 0
+        self.request_latency_sum = 0.0
+        self.inference_time_sum = 0.0
+
+    def record_batch(self, batch_size, inference_time):
+        with self._lock:
+            self.batches += 1
+            self.batched_images += batch_size
+            self.max_batch_size = max(self.max_batch_size, batch_size)
+            self.inference_time_sum += inference_time
+
+    def record_request(self, latency, error=False):
+        with self._lock:
+            self.requests += 1
+            self.errors += int(error)
+            self.request_latency_sum += latency
+
+    def to_prometheus(self, queue_size):
+        with self._lock:
+            lines = [
+                f"xami_uptime_seconds {time.time() - self.started:.3f}",
+                f"xami_requests_total {self.requests}",
+                f"xami_request_errors_total {self.errors}",
+                f"xami_request_latency_seconds_sum {self.request_latency_sum:.6f}",
+                f"xami_batches_total {self.batches}",
+                f"xami_batched_images_total {self.batched_images}",
+                f"xami_batch_size_max {self.max_batch_size}",
+                f"xami_batch_size_mean {self.batched_images / max(self.batches, 1):.3f}",
+                f"xami_inference_seconds_sum {self.inference_time_sum:.6f}",
+                f"xami_queue_size {queue_size}",
+            ]
+        return "\n".join(lines) + "\n"
+
+class MicroBatcher:
+    """
+    Collects the images of concurrent requests into batches for InferXami.run_predict_batch.
+
+    A batch is run as soon as it holds max_batch_size images, or max_latency_ms after its first image arrived.
+    Images with different detector confidences are run in separate batches.
+    """
+    def __init__(self, model, max_batch_size=8, max_latency_ms=10, metrics=None):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.metrics = metrics if metrics is not None else ServerMetrics()
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name='xami-batcher', daemon=True)
+        self._worker.start()
+
+    def submit(self, image, conf):
+        """Queue an image and return a Future resolved with its run_predict_batch output."""
+        future = Future()
+        self._queue.put((image, conf, future))
+        return future
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            by_conf = {}
+            for item in batch:
+                by_conf.setdefault(item[1], []).append(item)
+
+            for conf, items in by_conf.items():
+                start = time.time()
+                try:
+                    outputs = self.model.run_predict_batch([item[0] for item in items], yolo_conf=conf)
+                except Exception as e:
+                    for item in items:
+                        item[2].set_exception(e)
+                    continue
+                self.metrics.record_batch(len(items), time.time() - start)
+                for item, output in zip(items, outputs):
+                    item[2].set_result(output)
+
+def make_handler(model, batcher, default_conf=0.2, request_timeout=60):
+
+    class XamiRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):  # keep the server output quiet
+            pass
+
+        def _send(self, status, body, content_type='application/json'):
+            if not isinstance(body, bytes):
+                body = (json.dumps(body) if content_type == 'application/json' else body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+            if path == '/health':
+                self._send(200, {
+                    'status': 'ok',
+                    'device': str(model.device),
+                    'detector_checkpoint': model.detr_checkpoint,
+                    'sam_checkpoint': model.sam_checkpoint})
+            elif path == '/metrics':
+                self._send(200, batcher.metrics.to_prometheus(batcher.qsize()), content_type='text/plain; version=0.0.4')
+            else:
+                self._send(404, {'error': f'Unknown endpoint {path}'})
+
+        def _read_image(self, query):
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length)
+            conf = float(query.get('conf', [default_conf])[0])
+
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                request = json.loads(body)
+                if not isinstance(request, dict):
+                    raise ValueError('The JSON body must be an object, e.g. {"path": "/path/to/image.png"}')
+                conf = float(request.get('conf', conf))
+                image = cv2.imread(request['path'])
+                if image is None:
+                    raise ValueError(f"Cannot read the image {request['path']}")
+            else:
+                image = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR)
+                if image is None:
+                    raise ValueError('Cannot decode the uploaded image')
+            return image, conf
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != '/predict':
+                self._send(404, {'error': f'Unknown endpoint {url.path}'})
+                return
+
+            start = time.time()
+            try:
+                image, conf = self._read_image(parse_qs(url.query))
+            except (ValueError, KeyError) as e:
+                batcher.metrics.record_request(time.time() - start, error=True)
+                self._send(400, {'error': str(e)})
+                return
+
+            try:
+                output = batcher.submit(image, conf).result(timeout=request_timeout)
+            except Exception as e:
+                batcher.metrics.record_request(time.time() - start, error=True)
+                self._send(500, {'error': repr(e)})
+                return
+
+            classes = output['classes'].tolist()
+            self._send(200, {
+                'image_size': list(image.shape[:2]),
+                'masks': masks_to_rles(output['masks']),
+                'classes': classes,
+                'class_names': [model.classes[c][0] for c in classes],
+                'scores': output['scores'].tolist(),
+                'boxes': output['boxes'].tolist()})
+            batcher.metrics.record_request(time.time() - start)
+
+    return XamiRequestHandler
+
+def serve(model, host='127.0.0.1', port=8080, max_batch_size=8, max_latency_ms=10, default_conf=0.2):
+    """
+    Serve an InferXami model until interrupted.
+
+    Args:
+        model (InferXami): The loaded model.
+        host (str): The address to bind.
+        port (int): The port to bind.
+        max_batch_size (int): Maximum number of images per micro-batch.
+        max_latency_ms (float): How long a batch waits for more requests after its first one.
+        default_conf (float): Detector confidence threshold when the request doesn't give one.
+    """
+    batcher = MicroBatcher(model, max_batch_size=max_batch_size, max_latency_ms=max_latency_ms)
+    server = ThreadingHTTPServer((host, port), make_handler(model, batcher, default_conf=default_conf))
+    print(f"Serving XAMI on http://{host}:{port} (max batch size {max_batch_size}, max latency {max_latency_ms} ms)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='XAMI local inference server with dynamic request batching.')
+    parser.add_argument('--detr-checkpoint', required=True, help='The detector (RT-DETR, or YOLO with --use-detr-masks) checkpoint.')
+    parser.add_argument('--sam-checkpoint', required=True, help='The MobileSAM checkpoint.')
+    parser.add_argument('--device', default='cuda:0' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--model-type', default='vit_t')
+    parser.add_argument('--use-detr-masks', action='store_true', help='Use the YOLO masks for faint sources.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch-size', type=int, default=8)
+    parser.add_argument('--max-latency-ms', type=float, default=10)
+    parser.add_argument('--conf', type=float, default=0.2, help='Default detector confidence threshold.')
+    parser.add_argument('--warmup-runs', type=int, default=3)
+    parser.add_argument('--compile-mode', default=None)
+    parser.add_argument('--embedding-cache-size', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    from .inference.xami_inference import InferXami
+    model = InferXami(
+        args.device,
+        args.detr_checkpoint,
+        args.sam_checkpoint,
+        model_type=args.model_type,
+        use_detr_masks=args.use_detr_masks,
+        warmup_batch_sizes=tuple(sorted({1, args.max_batch_size})),
+        warmup_runs=args.warmup_runs,
+        compile_mode=args.compile_mode,
+        embedding_cache_size=args.embedding_cache_size)
+    serve(model, args.host, args.port, args.max_batch_size, args.max_latency_ms, args.conf)
+
+if __name__ == "__main__":
+    main()
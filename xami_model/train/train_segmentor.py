@@ -10,10 +10,12 @@ import matplotlib.pyplot as plt
 from datetime import datetime
 from pycocotools import mask as maskUtils
 from torch.utils.data import DataLoader
-from segment_anything.utils.transforms import ResizeLongestSide
+from torchmetrics.detection import MeanAveragePrecision
+from xami_model.mobile_sam.mobile_sam.utils.transforms import ResizeLongestSide
 
-from xami_model.dataset import dataset_utils, load_dataset
+from xami_model.dataset import dataset_utils, load_dataset, packed_dataset
 from xami_model.model_predictor import xami, predictor_utils
+from xami_model.losses import metrics_utils
 from xami_model.mobile_sam.mobile_sam import sam_model_registry, SamPredictor
 
 # For reproducibility
@@ -49,6 +51,8 @@ def main(config):
     batch_size = int(config['initial_batch_size'])
     mobile_sam_checkpoint = config['mobile_sam_checkpoint']
     model_type = config['model_type']
+    # Optional directory written by `python -m xami_model.dataset.packed_dataset`, with the packed train/ and valid/ splits
+    packed_dir = config.get('packed_dir')
     the_time = datetime.now()
     # Create working directory
     work_dir = predictor_utils.get_next_directory_name(work_dir)
@@ -65,20 +69,29 @@ def main(config):
     json_train_path = os.path.join(train_dir, '_annotations.coco.json')
     json_valid_path = os.path.join(valid_dir, '_annotations.coco.json')
 
-    with open(json_train_path) as f1, open(json_valid_path) as f2:
-        train_data_in = json.load(f1)
-        valid_data_in = json.load(f2)
+    if packed_dir is None:
+        with open(json_train_path) as f1, open(json_valid_path) as f2:
+            train_data_in = json.load(f1)
+            valid_data_in = json.load(f2)
 
-    training_image_paths = [os.path.join(train_dir, image['file_name']) for image in train_data_in['images']]
-    val_image_paths = [os.path.join(valid_dir, image['file_name']) for image in valid_data_in['images']]
+        training_image_paths = [os.path.join(train_dir, image['file_name']) for image in train_data_in['images']]
+        val_image_paths = [os.path.join(valid_dir, image['file_name']) for image in valid_data_in['images']]
 
-    train_data = dataset_utils.load_json(json_train_path)
-    valid_data = dataset_utils.load_json(json_valid_path)
-    
-    train_gt_masks, train_bboxes, train_classes, train_class_categories = dataset_utils.get_coords_and_masks_from_json(
-        train_dir, train_data) 
-    val_gt_masks, val_bboxes, val_classes, val_class_categories = dataset_utils.get_coords_and_masks_from_json(
-        valid_dir, valid_data)
+        train_data = dataset_utils.load_json(json_train_path)
+        valid_data = dataset_utils.load_json(json_valid_path)
+        
+        train_gt_masks, train_bboxes, train_classes, train_class_categories = dataset_utils.get_coords_and_masks_from_json(
+            train_dir, train_data) 
+        val_gt_masks, val_bboxes, val_classes, val_class_categories = dataset_utils.get_coords_and_masks_from_json(
+            valid_dir, valid_data)
+    else:
+        # Images, masks and boxes come from the memory-mapped shards: no per-image file opens or polygon rasterization
+        packed_train = packed_dataset.PackedImageDataset(os.path.join(packed_dir, 'train'))
+        packed_valid = packed_dataset.PackedImageDataset(os.path.join(packed_dir, 'valid'))
+        training_image_paths = [os.path.join(train_dir, file_name) for file_name in packed_train.file_names]
+        val_image_paths = [os.path.join(valid_dir, file_name) for file_name in packed_valid.file_names]
+        train_gt_masks, train_bboxes, train_classes, train_class_categories = packed_train.gt_annotations()
+        val_gt_masks, val_bboxes, val_classes, val_class_categories = packed_valid.gt_annotations()
 
     # Initialize model
     model = sam_model_registry[model_type](checkpoint=mobile_sam_checkpoint)
@@ -94,8 +107,15 @@ def main(config):
 
     # Prepare data loaders
     transform = ResizeLongestSide(xami_model_instance.model.image_encoder.img_size)
-    train_set = load_dataset.ImageDataset(training_image_paths, xami_model_instance.model, transform, device) 
-    val_set = load_dataset.ImageDataset(val_image_paths, xami_model_instance.model, transform, device) 
+    if packed_dir is None:
+        train_set = load_dataset.ImageDataset(training_image_paths, xami_model_instance.model, transform, device) 
+        val_set = load_dataset.ImageDataset(val_image_paths, xami_model_instance.model, transform, device) 
+        train_image_reader, val_image_reader = None, None
+    else:
+        for packed_set in (packed_train, packed_valid):
+            packed_set.model, packed_set.transform, packed_set.device = xami_model_instance.model, transform, device
+        train_set, val_set = packed_train, packed_valid
+        train_image_reader, val_image_reader = packed_train.read_image, packed_valid.read_image
     train_dataloader = DataLoader(train_set, batch_size=batch_size, shuffle=True)
     val_dataloader = DataLoader(val_set, batch_size=batch_size, shuffle=False)
 
@@ -146,6 +166,9 @@ def main(config):
     print(f"🚀  Training started.\n")
 
     iou_eval_thresholds = [0.5, 0.75, 0.9]
+    score_accumulator = predictor_utils.MaskScoreAccumulator()
+    # Updated per image during validation: only the RLEs of the masks are kept, not the dense masks of the split
+    map_evaluator = metrics_utils.StreamingMAP(MeanAveragePrecision(iou_type='segm'))
     
     for epoch in range(num_epochs):
         # Train
@@ -158,14 +181,17 @@ def main(config):
             optimizer, 
             mode='train',
             cr_transforms=cr_transforms,
-            scheduler=scheduler)
+            scheduler=scheduler,
+            image_reader=train_image_reader)
         
         train_losses.append(epoch_loss)
         
         # Validate
         xami_model_instance.model.eval()
         with torch.no_grad():
-            epoch_val_loss, all_image_ids, all_gt_masks, all_pred_masks =  xami_model_instance.train_validate_step(
+            score_accumulator.reset()
+            map_evaluator.reset()
+            epoch_val_loss, all_image_ids, _, _ =  xami_model_instance.train_validate_step(
                 val_dataloader, 
                 valid_dir, 
                 val_gt_masks, 
@@ -173,19 +199,29 @@ def main(config):
                 optimizer, 
                 mode='validate',
                 cr_transforms=[],
-                scheduler=None)
+                scheduler=None,
+                score_accumulator=score_accumulator,
+                image_reader=val_image_reader,
+                map_evaluator=map_evaluator,
+                gt_classes=val_classes)
             
             valid_losses.append(epoch_val_loss)
-            p_metric_name, p_means, p_stds = predictor_utils.compute_scores('precision', all_pred_masks, all_gt_masks, iou_eval_thresholds)
-            r_metric_name, r_means, r_stds = predictor_utils.compute_scores('recall', all_pred_masks, all_gt_masks, iou_eval_thresholds)
-            f_metric_name, f_means, f_stds = predictor_utils.compute_scores('f1_score', all_pred_masks, all_gt_masks, iou_eval_thresholds)
-            a_metric_name, a_means, a_stds = predictor_utils.compute_scores('accuracy', all_pred_masks, all_gt_masks, iou_eval_thresholds)
+            # IoU and TP/FP/FN counts are computed once per mask during validation; all metrics derive from them
+            scores = score_accumulator.compute(iou_eval_thresholds)
+            p_means, p_stds = scores['precision']
+            r_means, r_stds = scores['recall']
+            f_means, f_stds = scores['f1_score']
+            a_means, a_stds = scores['accuracy']
             print('Precision', p_means, 'Recall', r_means, 'F1-score', f_means, 'Accuracy', a_means)
+            map_metrics = map_evaluator.compute()
+            valid_map, valid_map50 = float(map_metrics['map']), float(map_metrics['map_50'])
+            print('mAP', valid_map, 'mAP50', valid_map50)
         
         # Logging
         if wandb_track:
             wandb.log({'epoch training loss': epoch_loss, 'epoch validation loss': epoch_val_loss})
             wandb.log({'Precision': p_means, 'Recall': r_means, 'F1-score': f_means, 'Accuracy': a_means})
+            wandb.log({'valid/mAP': valid_map, 'valid/mAP50': valid_map50})
 
         print(f'EPOCH: {epoch}. Training loss: {epoch_loss}')
         print(f'EPOCH: {epoch}. Validation loss: {epoch_val_loss}.')
@@ -1 +1,3 @@
-from .yolo_predictor_utils import *
\ No newline at end of file
+from .._lazy import lazy_star_exports
+
+__getattr__, __dir__ = lazy_star_exports(__name__, ('yolo_predictor_utils',))
@@ -1,5 +1,4 @@
 from typing import Any, Generator, List
-import matplotlib.pyplot as plt
 import numpy as np
 import os
 from ..dataset import dataset_utils
@@ -40,6 +39,7 @@ def get_classes_from_image(yolo_dataset_path, image_location):
     return class_ids
 
 def show_anns(anns):
+    import matplotlib.pyplot as plt
     if len(anns) == 0:
         return
     ax = plt.gca()